@@ -0,0 +1,116 @@
+"""Replay benchmark for the event-sourced inventory.
+
+Generates a year of synthetic shop activity, stores it in the in-memory storage
+backend and measures how fast the state is rebuilt from the event log, with and
+without a mid-year snapshot. Nothing connects to Discord or MongoDB.
+
+    python bench_event_replay.py [--days 365] [--events-per-day 300] [--seed 1]
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import time
+
+# sonnet.py reads these at import time
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ["STORAGE_BACKEND"] = "memory"
+
+import sonnet
+from sonnet import InventoryEvent, InventoryState, MemoryBackend, apply_inventory_event, rebuild_inventory
+
+logging.getLogger().setLevel(logging.WARNING) # Keep the bot's startup logging out of the results
+
+
+def generate_events(days: int, events_per_day: int, seed: int) -> list:
+    """A plausible mix of adds, sales, removals, payouts and admin events, valid at every step."""
+    rng = random.Random(seed)
+    items = list(sonnet.shop_data.predefined_prices)
+    prices = dict(sonnet.shop_data.predefined_prices)
+    users = [f"user{n:02d}" for n in range(25)]
+    state = InventoryState(predefined_prices=dict(prices))
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    events = []
+
+    def emit(event):
+        apply_inventory_event(state, event)
+        events.append(event)
+
+    for day in range(days):
+        date = (start + datetime.timedelta(days=day)).date().isoformat()
+        for n in range(events_per_day):
+            ts = (start + datetime.timedelta(days=day, seconds=n * 86400 // events_per_day)).isoformat()
+            item, user, roll = rng.choice(items), rng.choice(users), rng.random()
+            stocked = sum(e["quantity"] for e in state.items.get(item, []))
+            mine = sum(e["quantity"] for e in state.items.get(item, []) if e["person"] == user)
+            if roll < 0.35 and stocked:
+                emit(InventoryEvent("sale", item=item, user="customer", quantity=rng.randint(1, min(stocked, 20)),
+                                    price=state.predefined_prices[item], ts=ts))
+            elif roll < 0.45 and mine:
+                emit(InventoryEvent("remove", item=item, user=user, quantity=rng.randint(1, mine), ts=ts))
+            elif roll < 0.52 and state.user_earnings.get(user, 0) > 0:
+                emit(InventoryEvent("payout", user=user, amount=state.user_earnings[user] // 2, ts=ts))
+            elif roll < 0.54:
+                emit(InventoryEvent("set", item=item, user=user, quantity=rng.randint(0, 50),
+                                    price=state.predefined_prices[item], date=date, ts=ts))
+            elif roll < 0.545:
+                new_price = max(1, int(state.predefined_prices[item] * rng.uniform(0.9, 1.1)))
+                emit(InventoryEvent("price_change", item=item, price=new_price, update_existing=rng.random() < 0.5, ts=ts))
+            elif roll < 0.546:
+                emit(InventoryEvent("clear", item=item, user=user, ts=ts))
+            else:
+                emit(InventoryEvent("add", item=item, user=user, quantity=rng.randint(1, 100),
+                                    price=state.predefined_prices[item], date=date, ts=ts))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--events-per-day", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    events = generate_events(args.days, args.events_per_day, args.seed)
+    print(f"Generated {len(events):,} events ({args.days} days) in {time.perf_counter() - started:.2f}s")
+
+    # 1. Reducer only: the floor for any rebuild
+    base_prices = dict(sonnet.shop_data.predefined_prices)
+    state = InventoryState(predefined_prices=dict(base_prices))
+    started = time.perf_counter()
+    for event in events:
+        apply_inventory_event(state, event)
+    elapsed = time.perf_counter() - started
+    print(f"Reducer replay:          {len(events) / elapsed:>12,.0f} events/s ({elapsed:.2f}s)")
+
+    # 2. Full rebuild through the storage backend (load + decode + apply)
+    storage = MemoryBackend()
+    storage.store_event_snapshot({"seq": 0, "events_applied": 0, "state": {"predefined_prices": base_prices}}, keep=2)
+    docs = [event.to_doc() for event in events]
+    for i in range(0, len(docs), 500):
+        storage.append_events(docs[i:i + 500])
+    started = time.perf_counter()
+    rebuilt, last_seq, applied = rebuild_inventory(storage)
+    elapsed = time.perf_counter() - started
+    print(f"Rebuild from genesis:    {applied / elapsed:>12,.0f} events/s ({elapsed:.2f}s, {applied:,} events to seq {last_seq:,})")
+    assert rebuilt.items == state.items and rebuilt.user_earnings == state.user_earnings, "rebuild diverged from live state"
+
+    # 3. Rebuild after a mid-year snapshot: only the second half is replayed
+    half = len(events) // 2
+    mid_state = InventoryState(predefined_prices=dict(base_prices))
+    for event in events[:half]:
+        apply_inventory_event(mid_state, event)
+    storage.store_event_snapshot({"seq": half, "events_applied": half, "state": {
+        "items": mid_state.items, "user_earnings": mid_state.user_earnings, "predefined_prices": mid_state.predefined_prices
+    }}, keep=2)
+    started = time.perf_counter()
+    rebuilt, last_seq, applied = rebuild_inventory(storage)
+    elapsed = time.perf_counter() - started
+    print(f"Rebuild from snapshot:   {applied / elapsed:>12,.0f} events/s ({elapsed:.2f}s, {applied:,} events to seq {last_seq:,})")
+    assert rebuilt.items == state.items and rebuilt.user_earnings == state.user_earnings, "snapshot rebuild diverged"
+
+
+if __name__ == "__main__":
+    main()
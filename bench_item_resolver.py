@@ -0,0 +1,120 @@
+"""Benchmark for the bulk-input item resolver.
+
+Generates thousands of lines of bulk add/remove text the way people type it (item IDs,
+display names, swapped words, typos, abbreviations, "qty item" and "item: qty") and
+compares the old per-line regex + substring scan with ItemResolver.parse_bulk, for both
+speed and how many lines resolve to the intended item. Nothing connects to Discord.
+
+    python bench_item_resolver.py [--lines 5000] [--seed 1]
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import time
+
+# sonnet.py reads these at import time
+os.environ.setdefault("BOT_TOKEN", "benchmark")
+os.environ["STORAGE_BACKEND"] = "memory"
+
+import sonnet
+from sonnet import ItemResolver
+
+logging.getLogger().setLevel(logging.WARNING) # Keep the bot's startup logging out of the results
+
+
+def typo(rng: random.Random, text: str) -> str:
+    """Drop, double or swap one letter."""
+    i = rng.randrange(1, len(text) - 1)
+    kind = rng.random()
+    if kind < 0.4:
+        return text[:i] + text[i + 1:]
+    if kind < 0.7:
+        return text[:i] + text[i] + text[i:]
+    return text[:i - 1] + text[i] + text[i - 1] + text[i + 1:]
+
+
+def generate_lines(count: int, seed: int) -> list:
+    """[(line, intended item)] in the shapes seen in real bulk input."""
+    rng = random.Random(seed)
+    items = list(sonnet.shop_data.item_list)
+    names = sonnet.shop_data.display_names
+    lines = []
+    for _ in range(count):
+        item = rng.choice(items)
+        display = names.get(item, item)
+        roll = rng.random()
+        if roll < 0.30:
+            name = item
+        elif roll < 0.55:
+            name = rng.choice([display, display.lower(), display.upper()])
+        elif roll < 0.70:
+            name = "_".join(reversed(display.lower().split())) # "whacky_bud" style
+        elif roll < 0.85:
+            name = typo(rng, rng.choice([item, display]))
+        else:
+            name = rng.choice([display.split()[0], item.split("_")[-1]]) # Partial, often ambiguous
+        qty = rng.randint(1, 500)
+        line = rng.choice([f"{name}: {qty}", f"{name} {qty}", f"{qty} {name}", f"{qty}x {name}"])
+        lines.append((line, item))
+    return lines
+
+
+def legacy_parse(line: str, items: list):
+    """The parsing the bulk modals did before ItemResolver, for comparison."""
+    match = re.match(r'([a-z_]+)[:\s]+(\d+)', line, re.IGNORECASE)
+    if not match:
+        match = re.match(r'(\d+)[:\s]+([a-z_]+)', line, re.IGNORECASE)
+        if not match:
+            return None
+        item_name = match.group(2).lower()
+    else:
+        item_name = match.group(1).lower()
+    if item_name in items:
+        return item_name
+    matches = [i for i in items if item_name in i]
+    return matches[0] if len(matches) == 1 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    lines = generate_lines(args.lines, args.seed)
+    items = list(sonnet.shop_data.item_list)
+    print(f"Generated {len(lines):,} lines over {len(items)} items")
+
+    started = time.perf_counter()
+    legacy_hits = sum(legacy_parse(line, items) == item for line, item in lines)
+    elapsed = time.perf_counter() - started
+    print(f"Legacy parser:   {len(lines) / elapsed:>10,.0f} lines/s, {legacy_hits / len(lines):6.1%} resolved correctly")
+
+    resolver = ItemResolver()
+    started = time.perf_counter()
+    resolver.rebuild(items, sonnet.shop_data.display_names)
+    print(f"Alias index built in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    for label in ("cold cache", "warm cache"):
+        started = time.perf_counter()
+        hits = wrong = 0
+        for line, item in lines:
+            parsed, _ = resolver.parse_bulk(line)
+            if parsed:
+                hits += parsed[0][0] == item
+                wrong += parsed[0][0] != item
+        elapsed = time.perf_counter() - started
+        print(f"ItemResolver ({label}): {len(lines) / elapsed:>10,.0f} lines/s, {hits / len(lines):6.1%} resolved correctly, {wrong / len(lines):5.1%} resolved to the wrong item")
+
+    # One modal submission: the 1500-character input limit holds roughly 80 lines
+    text = "\n".join(line for line, _ in lines[:80])
+    started = time.perf_counter()
+    ItemResolver().rebuild(items, sonnet.shop_data.display_names)
+    resolver.parse_bulk(text)
+    print(f"80-line submission incl. index build: {(time.perf_counter() - started) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@ import os
 from dotenv import load_dotenv
 import logging
 import asyncio
-from typing import Dict, List, Optional, Union, Any, Literal
+from typing import Dict, List, Optional, Union, Any, Literal, Tuple, Set, Callable, Awaitable, Iterator, Iterable
 import traceback
 try:
     import nacl  # Try to import but don't fail if missing
@@ -22,7 +22,22 @@ from pymongo import MongoClient
 import pymongo
 import schedule
 from threading import Thread
+import threading
 import time
+import socket
+import copy
+import sqlite3
+import hashlib
+import gzip
+import csv
+import io
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+import uuid
+from collections import OrderedDict, Counter
+import heapq
+import bisect
+import itertools
 
 # Define intents first
 intents = discord.Intents.default()
@@ -61,13 +76,176 @@ STOCK_CHANNEL_ID = int(os.getenv('STOCK_CHANNEL_ID', 0))
 if not STOCK_CHANNEL_ID:
     logger.warning("⚠️ STOCK_CHANNEL_ID not set or invalid. Stock updates will be disabled.")
 
+# Where shop data lives: "mongo" (default, supports several instances), "sqlite" or "memory"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo").strip().lower()
+if STORAGE_BACKEND not in ("mongo", "sqlite", "memory"):
+    logger.critical(f"❌ Unknown STORAGE_BACKEND '{STORAGE_BACKEND}' (expected mongo, sqlite or memory)")
+    raise ValueError("STORAGE_BACKEND must be one of: mongo, sqlite, memory")
+
 MONGO_URI = os.getenv("MONGO_URI")
-if not MONGO_URI:
-    logger.critical("❌ MONGO_URI not found in environment variables! Bot requires MongoDB.")
+if STORAGE_BACKEND == "mongo" and not MONGO_URI:
+    logger.critical("❌ MONGO_URI not found in environment variables! The mongo storage backend requires it.")
     raise ValueError("MONGO_URI environment variable is required")
 
 APP_ENV = os.getenv("APP_ENV", "production")
 DB_NAME = "NCHBot" if APP_ENV == "production" else "NCHBot_dev"
+SQLITE_PATH = os.getenv("SQLITE_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", f"{DB_NAME}.sqlite3")
+
+# Guilds to sync slash commands to directly (instant propagation, for development).
+# Empty = global sync. FORCE_COMMAND_SYNC=1 syncs even if the command tree hash is unchanged.
+SYNC_GUILD_IDS = [int(g) for g in os.getenv("SYNC_GUILD_IDS", "").replace(" ", "").split(",") if g.isdigit()]
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1"
+
+# Leader election for singleton jobs (backups, stock board) when several instances run
+LEADER_LEASE_SECONDS = int(os.getenv("LEADER_LEASE_SECONDS", 30))
+LEADER_RENEW_SECONDS = max(1, LEADER_LEASE_SECONDS // 3)
+
+# Local snapshot of the MongoDB state for warm starts (one file per database)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", f"snapshot_{DB_NAME}.json.gz")
+SNAPSHOT_FORMAT = 2 # Bump when the snapshot layout changes; older files are ignored
+# Changes not yet confirmed by remote storage (replayed after an outage or crash)
+JOURNAL_PATH = os.getenv("JOURNAL_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", f"journal_{DB_NAME}.jsonl")
+
+# Stock board layout: "packed" fits all categories into as few messages as possible;
+# "category" gives every slot its own message, edited only when its categories change.
+# STOCK_BOARD_GROUPS groups categories into slots, e.g. "bud,bag,joint;tebex;fish,misc"
+# (default: one slot per category).
+STOCK_BOARD_LAYOUT = os.getenv("STOCK_BOARD_LAYOUT", "packed").strip().lower()
+if STOCK_BOARD_LAYOUT not in ("packed", "category"):
+    logger.critical(f"❌ Unknown STOCK_BOARD_LAYOUT '{STOCK_BOARD_LAYOUT}' (expected packed or category)")
+    raise ValueError("STOCK_BOARD_LAYOUT must be one of: packed, category")
+STOCK_BOARD_GROUPS = [[c for c in group.replace(" ", "").split(",") if c] for group in os.getenv("STOCK_BOARD_GROUPS", "").split(";")]
+STOCK_BOARD_GROUPS = [group for group in STOCK_BOARD_GROUPS if group]
+
+# Low-stock alerts: one digest of threshold crossings per interval to this channel (0 = off)
+LOW_STOCK_ALERT_CHANNEL_ID = int(os.getenv("LOW_STOCK_ALERT_CHANNEL_ID", 0))
+LOW_STOCK_ALERT_MINUTES = max(1, int(os.getenv("LOW_STOCK_ALERT_MINUTES", 15)))
+# Statements (/statement): CSV parts of at most this size, at most STATEMENT_MAX_PARTS per export
+STATEMENT_PART_BYTES = int(float(os.getenv("STATEMENT_PART_MB", 8)) * 1024 * 1024)
+STATEMENT_MAX_PARTS = 10 # Attachments Discord allows on one message
+# Sale digests: contributors who opt in (/saledigest) get one DM per interval with what sold
+SALE_DIGEST_MINUTES = max(1, int(os.getenv("SALE_DIGEST_MINUTES", 60)))
+
+############### METRICS ###############
+
+class BotMetrics:
+    """Process-local counters, gauges and timings (shown by /botstats)."""
+    def __init__(self):
+        self._lock = threading.Lock() # Updated from the scheduler and watcher threads too
+        self.counters: Dict[str, int] = {}
+        self.gauges: Dict[str, float] = {}
+        self.timings: Dict[str, List[float]] = {} # name: [count, total_seconds, max_seconds]
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            stats = self.timings.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": {name: {"count": c, "avg": (t / c if c else 0.0), "max": m} for name, (c, t, m) in self.timings.items()}
+            }
+
+metrics = BotMetrics()
+
+
+class StartupTimer:
+    """Measures startup phases so cold-start time can be tracked (logged and in /botstats)."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {} # phase: duration in seconds
+        self.milestones: Dict[str, float] = {} # milestone: seconds since process start
+
+    @contextmanager
+    def phase(self, name: str):
+        phase_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - phase_start
+            self.phases[name] = duration
+            metrics.set_gauge(f"startup.{name}_ms", round(duration * 1000))
+            logger.info(f"⏱️ Startup phase '{name}' took {duration * 1000:.0f} ms")
+
+    def mark(self, milestone: str) -> None:
+        elapsed = time.perf_counter() - self.started
+        self.milestones[milestone] = elapsed
+        metrics.set_gauge(f"startup.{milestone}_at_ms", round(elapsed * 1000))
+        logger.info(f"⏱️ Startup milestone '{milestone}' reached after {elapsed * 1000:.0f} ms")
+
+    def summary(self) -> str:
+        parts = [f"{name}={secs * 1000:.0f}ms" for name, secs in self.phases.items()]
+        parts += [f"{name}@{secs * 1000:.0f}ms" for name, secs in self.milestones.items()]
+        return ", ".join(parts)
+
+startup_timer = StartupTimer()
+
+
+class LRUCache:
+    """Small least-recently-used cache; hits and misses are counted as cache.<name>.hits/misses.
+
+    With `ttl` (seconds) an entry also expires that long after it was last put.
+    """
+    def __init__(self, name: str, maxsize: int, ttl: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._expires: Dict[Any, float] = {}
+
+    def _expired(self, key: Any) -> bool:
+        if self.ttl is None or self._expires.get(key, 0) > time.monotonic():
+            return False
+        self.discard(key)
+        metrics.incr(f"cache.{self.name}.expired")
+        return True
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key in self._data and not self._expired(key):
+            self._data.move_to_end(key)
+            metrics.incr(f"cache.{self.name}.hits")
+            return self._data[key]
+        metrics.incr(f"cache.{self.name}.misses")
+        return default
+
+    def peek(self, key: Any, default: Any = None) -> Any:
+        """Look up without counting a hit or refreshing the entry's position."""
+        if key in self._data and not self._expired(key):
+            return self._data[key]
+        return default
+
+    def put(self, key: Any, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.ttl is not None:
+            self._expires[key] = time.monotonic() + self.ttl
+        while len(self._data) > self.maxsize:
+            evicted, _ = self._data.popitem(last=False)
+            self._expires.pop(evicted, None)
+
+    def discard(self, key: Any) -> bool:
+        self._expires.pop(key, None)
+        return self._data.pop(key, None) is not None
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._expires.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
 
 ############### UI CLASSES ###############
 
@@ -142,70 +320,18 @@ class BulkAddModal(discord.ui.Modal, title="Bulk Add Items"):
         try:
             await interaction.response.defer(ephemeral=True)
 
-            items_text = self.items_input.value.strip()
-            items_to_add = []
-            errors = []
-
-            for item_entry in re.split(r'[,\n]', items_text):
-                item_entry = item_entry.strip()
-                if not item_entry:
-                    continue
-
-                match = re.match(r'([a-z_]+)[:\s]+(\d+)', item_entry, re.IGNORECASE)
-                if not match:
-                    match = re.match(r'(\d+)[:\s]+([a-z_]+)', item_entry, re.IGNORECASE)
-                    if match:
-                        quantity_str, item_name = match.groups()
-                        item_name = item_name.lower()
-                    else:
-                        errors.append(f"Invalid format: `{item_entry}`")
-                        continue
-                else:
-                    item_name, quantity_str = match.groups()
-                    item_name = item_name.lower()
-
-                try:
-                    quantity = int(quantity_str)
-                    if quantity <= 0:
-                         errors.append(f"Quantity must be positive for `{item_name}`: {quantity_str}")
-                         continue
-                except ValueError:
-                    errors.append(f"Invalid quantity for `{item_name}`: {quantity_str}")
-                    continue
-
-                original_input_name = item_name # Keep original for error messages if needed
-                if not shop_data.is_valid_item(item_name):
-                    matches = [i for i in shop_data.get_all_items() if item_name in i]
-                    if len(matches) == 1:
-                        item_name = matches[0]
-                        logger.info(f"Bulk Add: Matched input '{original_input_name}' to item '{item_name}'")
-                    else:
-                        errors.append(f"Unknown item or ambiguous match: `{original_input_name}`")
-                        continue
-
-                items_to_add.append((item_name, quantity))
+            items_to_add, errors = shop_data.item_resolver.parse_bulk(self.items_input.value.strip())
 
             if not items_to_add:
                 await interaction.followup.send("❌ No valid items found to add.", ephemeral=True)
                 return
 
-            user = str(interaction.user)
-            total_added_count = 0
-            total_value = 0
-            total_quantity_added = 0
-
-            for item_name, quantity in items_to_add:
-                price = shop_data.predefined_prices.get(item_name, 0)
-                value = price * quantity
-                shop_data.add_item(item_name, quantity, user)
-                shop_data.add_to_history("add_bulk", item_name, quantity, price, user)
-                total_added_count += 1
-                total_value += value
-                total_quantity_added += quantity
-
-            # Save and update stock message
-            shop_data.save_data()
+            result = shop_data.apply_stock_batch(shop_data.user_key(interaction.user), items_to_add, "add_bulk")
+            if not result.applied:
+                await interaction.followup.send("❌ Nothing was added:\n" + "\n".join(f"- {e}" for e in result.errors + errors), ephemeral=True)
+                return
             await update_stock_message()
+            total_added_count, total_quantity_added, total_value = result.item_types, result.total_quantity, result.total_value
 
             confirmation = f"✅ Added {total_added_count} types of items ({total_quantity_added:,} total) worth ${total_value:,} to stock!"
             if errors:
@@ -233,85 +359,18 @@ class BulkRemoveModal(discord.ui.Modal, title="Bulk Remove Items"):
         try:
             await interaction.response.defer(ephemeral=True)
 
-            items_text = self.items_input.value.strip()
-            items_to_remove = []
-            errors = []
-            user = str(interaction.user)
-
-            for item_entry in re.split(r'[,\n]', items_text):
-                item_entry = item_entry.strip()
-                if not item_entry:
-                    continue
-
-                # Support both item:qty and qty item formats
-                match = re.match(r'([a-z_]+)[:\s]+(\d+)', item_entry, re.IGNORECASE)
-                if not match:
-                    match = re.match(r'(\d+)[:\s]+([a-z_]+)', item_entry, re.IGNORECASE)
-                    if match:
-                        quantity_str, item_name = match.groups()
-                        item_name = item_name.lower()
-                    else:
-                        errors.append(f"Invalid format: `{item_entry}`")
-                        continue
-                else:
-                    item_name, quantity_str = match.groups()
-                    item_name = item_name.lower()
-
-                try:
-                    quantity = int(quantity_str)
-                    if quantity <= 0:
-                         errors.append(f"Quantity must be positive for `{item_name}`: {quantity_str}")
-                         continue
-                except ValueError:
-                    errors.append(f"Invalid quantity for `{item_name}`: {quantity_str}")
-                    continue
-
-                original_input_name = item_name
-                if not shop_data.is_valid_item(item_name):
-                    matches = [i for i in shop_data.get_all_items() if item_name in i]
-                    if len(matches) == 1:
-                        item_name = matches[0]
-                        logger.info(f"Bulk Remove: Matched input '{original_input_name}' to item '{item_name}'")
-                    else:
-                        errors.append(f"Unknown item or ambiguous match: `{original_input_name}`")
-                        continue
-
-                user_quantity = shop_data.get_user_quantity(item_name, user)
-                if user_quantity < quantity:
-                    display_name = shop_data.display_names.get(item_name, item_name)
-                    errors.append(f"Not enough `{display_name}` (Have: {user_quantity}, Need: {quantity})")
-                    continue
-
-                items_to_remove.append((item_name, quantity))
-
-            if not items_to_remove:
+            parsed, errors = shop_data.item_resolver.parse_bulk(self.items_input.value.strip())
+            if not parsed:
                 await interaction.followup.send("❌ No valid items found to remove based on your input and current stock.", ephemeral=True)
                 return
 
-            total_removed_count = 0
-            total_value = 0
-            total_quantity_removed = 0
-            actually_removed_items = [] # Track items successfully removed
-
-            for item_name, quantity in items_to_remove:
-                price = shop_data.predefined_prices.get(item_name, 0)
-                value = price * quantity # Indicative value
-                removed_successfully = shop_data.remove_item(item_name, quantity, user)
-
-                if removed_successfully:
-                    shop_data.add_to_history("remove_bulk", item_name, quantity, 0, user) # Price 0 for removal history
-                    total_removed_count += 1
-                    total_value += value
-                    total_quantity_removed += quantity
-                    actually_removed_items.append(item_name)
-                else:
-                    display_name = shop_data.display_names.get(item_name, item_name)
-                    errors.append(f"Failed removal for {quantity}x `{display_name}` (Insufficient stock during operation?)")
-
-            if actually_removed_items: # Only save and update if something changed
-                 # Save and update stock message
-                 shop_data.save_data()
-                 await update_stock_message()
+            # All or nothing: one line without enough stock cancels the whole removal
+            result = shop_data.apply_stock_batch(shop_data.user_key(interaction.user), [(item_name, -quantity) for item_name, quantity in parsed], "remove_bulk")
+            if not result.applied:
+                await interaction.followup.send("❌ Nothing was removed:\n" + "\n".join(f"- {e}" for e in result.errors + errors), ephemeral=True)
+                return
+            await update_stock_message()
+            total_removed_count, total_quantity_removed, total_value = result.item_types, result.total_quantity, result.total_value
 
             confirmation = f"✅ Removed {total_removed_count} types of items ({total_quantity_removed:,} total) worth approx. ${total_value:,} from your stock!"
             if errors:
@@ -473,25 +532,15 @@ class BulkConfirmButton(discord.ui.Button):
                 await interaction.followup.send("❌ No items with quantity > 0 selected!", ephemeral=True)
                 return
 
-            user = str(interaction.user)
-            total_added_count = 0
-            total_value = 0
-            total_quantity_added = 0
-            added_items_details = []
-
-            for item_name, quantity in selected_items:
-                price = shop_data.predefined_prices.get(item_name, 0)
-                value = price * quantity
-                shop_data.add_item(item_name, quantity, user)
-                shop_data.add_to_history("add_bulk_visual", item_name, quantity, price, user)
-                total_added_count += 1
-                total_value += value
-                total_quantity_added += quantity
-                display_name = shop_data.display_names.get(item_name, item_name)
-                added_items_details.append(f"• {display_name}: {quantity:,} (${value:,})") # Added commas
+            result = shop_data.apply_stock_batch(shop_data.user_key(interaction.user), selected_items, "add_bulk_visual")
+            if not result.applied:
+                await interaction.followup.send("❌ Nothing was added:\n" + "\n".join(f"- {e}" for e in result.errors), ephemeral=True)
+                return
+            await update_stock_message() # After the save, so the board never shows unsaved stock
 
-            await update_stock_message()
-            shop_data.save_data()
+            total_added_count, total_quantity_added, total_value = result.item_types, result.total_quantity, result.total_value
+            added_items_details = [f"• {shop_data.display_names.get(item_name, item_name)}: {quantity:,} (${value:,})"
+                                   for item_name, quantity, value in result.lines]
 
             embed = discord.Embed(
                 title="✅ Items Added to Stock (Visual Bulk Add)",
@@ -542,7 +591,7 @@ class RemoveQuantityModal(discord.ui.Modal):
                 await interaction.followup.send("❌ Quantity must be positive.", ephemeral=True)
                 return
 
-            user = str(interaction.user)
+            user = shop_data.user_key(interaction.user)
             display_name = shop_data.display_names.get(self.internal_name, self.internal_name)
 
             total_user_quantity = shop_data.get_user_quantity(self.internal_name, user)
@@ -628,7 +677,7 @@ class RemoveCategoryView(discord.ui.View):
     async def show_category_items(self, interaction: discord.Interaction, category: str):
         # This interaction *must* be responded to, either with items or no items message
         view = discord.ui.View(timeout=180)
-        user = str(interaction.user)
+        user = shop_data.user_key(interaction.user)
         items_in_category = shop_data.item_categories.get(category, [])
         found_items = False
 
@@ -682,7 +731,7 @@ class QuantityModal(discord.ui.Modal):
 
             display_name = shop_data.display_names.get(self.internal_name, self.internal_name)
             price = shop_data.predefined_prices.get(self.internal_name, 0)
-            user = str(interaction.user)
+            user = shop_data.user_key(interaction.user)
             
             # Add the item to stock
             shop_data.add_item(self.internal_name, quantity, user)
@@ -777,7 +826,7 @@ class TemplateSelectView(discord.ui.View):
             #    await interaction.response.send_message("❌ You cannot use this menu.", ephemeral=True)
             #    return
 
-            user_str = str(interaction.user) # Use the interacting user
+            user_str = shop_data.user_key(interaction.user) # Use the interacting user
             templates = shop_data.get_user_templates(user_str)
 
             if template_name not in templates:
@@ -864,13 +913,8 @@ class TemplateVisualCategoryView(discord.ui.View):
                 return
 
             user = self.user_id_str
-            original_items = shop_data.user_templates.get(user, {}).get(self.template_name, {}).copy()
-            new_template_data = {item: qty for item, qty in self.selected_items.items() if qty > 0}
-
-            if user not in shop_data.user_templates:
-                shop_data.user_templates[user] = {}
-            shop_data.user_templates[user][self.template_name] = new_template_data
-            shop_data.save_data()
+            original_items = shop_data.get_user_templates(user).get(self.template_name, {}).copy()
+            shop_data.save_template(user, self.template_name, self.selected_items)
 
             logger.info(f"User '{user}' saved template '{self.template_name}'")
 
@@ -904,37 +948,22 @@ class TemplateConfirmView(discord.ui.View):
         await interaction.response.defer(ephemeral=True)
         
         try:
-            user = str(interaction.user)
+            user = shop_data.user_key(interaction.user)
             template = shop_data.get_user_templates(user).get(self.template_name, {})
 
             if not template:
                 await interaction.followup.send(f"❌ Template '{self.template_name}' not found or empty.", ephemeral=True)
                 return
 
-            added_items_count = 0
-            total_value_added = 0
-            total_quantity_added = 0
-            item_details = []
-
-            for item, quantity in template.items():
-                if quantity <= 0 or not shop_data.is_valid_item(item):
-                    continue
+            deltas = [(item, quantity) for item, quantity in template.items() if quantity > 0 and shop_data.is_valid_item(item)]
+            result = shop_data.apply_stock_batch(user, deltas, "add_template") if deltas else None
 
-                price = shop_data.predefined_prices.get(item, 0)
-                value = quantity * price
-                
-                shop_data.add_item(item, quantity, user)
-                shop_data.add_to_history("add_template", item, quantity, price, user)
-                
-                display_name = shop_data.display_names.get(item, item)
-                item_details.append(f"{display_name}: {quantity:,} (${value:,})")
-                added_items_count += 1
-                total_value_added += value
-                total_quantity_added += quantity
-
-            if added_items_count > 0:
-                shop_data.save_data()
+            if result and not result.applied:
+                await interaction.followup.send("❌ Template not applied:\n" + "\n".join(f"- {e}" for e in result.errors), ephemeral=True)
+            elif result:
                 await update_stock_message()
+                added_items_count, total_quantity_added, total_value_added = result.item_types, result.total_quantity, result.total_value
+                item_details = [f"{shop_data.display_names.get(item, item)}: {quantity:,} (${value:,})" for item, quantity, value in result.lines]
 
                 embed = discord.Embed(
                     title=f"✅ Applied Template: {self.template_name}",
@@ -979,7 +1008,7 @@ class TemplateNameModal(discord.ui.Modal):
                  await interaction.response.send_message("❌ Template name cannot be empty.", ephemeral=True)
                  return
 
-            user = str(interaction.user)
+            user = shop_data.user_key(interaction.user)
 
             # Check for name collision only when creating or renaming to a different name
             if template_name != self.existing_name and template_name in shop_data.get_user_templates(user):
@@ -988,10 +1017,7 @@ class TemplateNameModal(discord.ui.Modal):
 
             # If editing, update the name in the data store first (if changed)
             if self.is_edit and self.existing_name and template_name != self.existing_name:
-                 if user in shop_data.user_templates and self.existing_name in shop_data.user_templates[user]:
-                      shop_data.user_templates[user][template_name] = shop_data.user_templates[user].pop(self.existing_name)
-                      shop_data.save_data() # Save name change
-                 else:
+                 if not shop_data.rename_template(user, self.existing_name, template_name): # Saves the name change
                       await interaction.response.send_message(f"❌ Error renaming: Original template '{self.existing_name}' not found.", ephemeral=True)
                       return
 
@@ -1000,8 +1026,8 @@ class TemplateNameModal(discord.ui.Modal):
             template_view.user_id_str = user # Pass user ID
 
             # If editing, load existing items
-            if self.is_edit or template_name in shop_data.user_templates.get(user, {}):
-                 template_items = shop_data.user_templates.get(user, {}).get(template_name, {})
+            if self.is_edit or template_name in shop_data.get_user_templates(user):
+                 template_items = shop_data.get_user_templates(user).get(template_name, {})
                  template_view.selected_items = template_items.copy() # Load existing
 
             # Create initial embed for the editor
@@ -1085,15 +1111,9 @@ class TemplateItemQuantityModal(discord.ui.Modal):
                  await interaction.followup.send("❌ Quantity must be positive.", ephemeral=True)
                  return
 
-            user = str(interaction.user)
+            user = shop_data.user_key(interaction.user)
 
-            if user not in shop_data.user_templates:
-                shop_data.user_templates[user] = {}
-            if self.template_name not in shop_data.user_templates[user]:
-                shop_data.user_templates[user][self.template_name] = {}
-
-            shop_data.user_templates[user][self.template_name][self.internal_name] = quantity
-            shop_data.save_data()
+            shop_data.set_template_item(user, self.template_name, self.internal_name, quantity)
 
             display_name = shop_data.display_names.get(self.internal_name, self.internal_name)
             price = shop_data.predefined_prices.get(self.internal_name, 0)
@@ -1224,11 +1244,9 @@ class TemplateDeleteView(discord.ui.View):
                  await interaction.response.edit_message(content="No template selected.", embed=None, view=None)
                  return
 
-            user = str(interaction.user)
+            user = shop_data.user_key(interaction.user)
 
-            if user in shop_data.user_templates and template_name in shop_data.user_templates[user]:
-                del shop_data.user_templates[user][template_name]
-                shop_data.save_data()
+            if shop_data.delete_template(user, template_name):
                 logger.info(f"User '{user}' deleted template '{template_name}'")
                 await interaction.response.edit_message(
                     content=f"✅ Template **{template_name}** deleted successfully.",
@@ -1328,7 +1346,7 @@ class TemplateVisualCategoryView(discord.ui.View):
              return embed
 
         # Get the items currently stored in the *data* for this template
-        user_templates = shop_data.user_templates.get(self.user_id_str, {})
+        user_templates = shop_data.get_user_templates(self.user_id_str)
         # Use self.selected_items which holds the state of *this editing session*
         current_selection = self.selected_items
 
@@ -1405,16 +1423,11 @@ class TemplateVisualCategoryView(discord.ui.View):
             user = self.user_id_str # Use the stored user ID
 
             # Get the state of the template *before* this editing session started
-            original_items = shop_data.user_templates.get(user, {}).get(self.template_name, {}).copy()
+            original_items = shop_data.get_user_templates(user).get(self.template_name, {}).copy()
 
-            # Prepare the new template data from the current selection state
+            # Save the updated or new template from the current selection state
             new_template_data = {item: qty for item, qty in self.selected_items.items() if qty > 0}
-
-            # Save the updated or new template
-            if user not in shop_data.user_templates:
-                shop_data.user_templates[user] = {}
-            shop_data.user_templates[user][self.template_name] = new_template_data
-            shop_data.save_data()
+            shop_data.save_template(user, self.template_name, new_template_data)
 
             logger.info(f"User '{user}' saved template '{self.template_name}'")
 
@@ -1702,6 +1715,62 @@ class CategoryView(discord.ui.View):
         await self._handle_category(interaction, 'misc', "🧩 Add Misc Items", COLORS['INFO'])
 
 
+STOCK_EMBED_CACHE_SIZE = 64 # Rendered /stock embeds kept, across filters, view modes and inventory versions
+stock_embed_cache = LRUCache("stock_embed", STOCK_EMBED_CACHE_SIZE)
+
+
+def render_stock_embed(category_filter: str, compact_mode: bool) -> discord.Embed:
+    """Build the /stock embed for a category (or 'all') from the inventory aggregate."""
+    embed = discord.Embed(
+        title="📊 Current Shop Stock",
+        color=COLORS['INFO'],
+        timestamp=datetime.datetime.now() # When the figures were rendered
+    )
+
+    total_value = 0
+    any_stock = False
+
+    # Determine categories to display (sorted for consistent order)
+    if category_filter != 'all':
+        categories_to_show = [category_filter]
+    else:
+        categories_to_show = sorted(shop_data.item_categories)
+
+    for cat in categories_to_show:
+        totals = shop_data.aggregate.category(cat)
+        content = []
+        for row in totals.rows:
+            if compact_mode:
+                status = "⚠️" if row.status == "low" else ""
+                content.append(f"{row.display_name}: {row.quantity:,} (${row.value:,}) {status}".strip())
+            else:
+                # Only show warnings/highs to reduce clutter
+                status = {"low": "⚠️ LOW", "high": "📈 HIGH"}.get(row.status, "")
+                # Format for alignment
+                formatted_price = f"${row.price:,}" if row.price else "N/A"
+                formatted_value = f"${row.value:,}" if row.price else "N/A"
+                content.append(f"`{row.display_name[:15]:<15} {row.quantity:>5,} @ {formatted_price:>8} = {formatted_value:>10} {status}`")
+
+        if totals.rows:
+            any_stock = True
+            total_value += totals.value
+            category_title = f"{totals.emoji} {cat.upper()}"
+            name = f"{category_title}: ${totals.value:,}" if compact_mode else f"{category_title} (${totals.value:,})"
+            value_str = "\n".join(content)
+            if len(value_str) > 1020: value_str = value_str[:1020] + "..." # Truncate if needed
+            embed.add_field(name=name, value=value_str, inline=False)
+        elif category_filter != 'all': # Only show "no stock" if filtering specifically
+             embed.add_field(name=f"{totals.emoji} {cat.upper()}", value="No stock in this category.", inline=False)
+
+    if any_stock:
+        embed.description = f"💰 **Total Value:** ${total_value:,}"
+    else:
+        embed.description = "No items currently in stock across all categories."
+
+    embed.set_footer(text=f"{'Compact' if compact_mode else 'Standard'} View • /quickadd, /add, /template")
+    return embed
+
+
 class StockView(discord.ui.View):
     # This view is sent ephemerally, so timeout is less critical but keep it reasonable
     def __init__(self):
@@ -1711,84 +1780,24 @@ class StockView(discord.ui.View):
         # This interaction must respond or edit the original response
         original_message = interaction.message
         try:
-            user = str(interaction.user)
+            user = shop_data.user_key(interaction.user)
             # Load preference *within* the function to get the latest
             compact_mode = shop_data.get_user_preference(user, "compact_view", False)
-
-            embed = discord.Embed(
-                title="📊 Current Shop Stock",
-                color=COLORS['INFO'],
-                timestamp=datetime.datetime.now()
-            )
-
-            total_value = 0
-            any_stock = False
-
-            # Determine categories to display
-            categories_to_show = []
-            if category_filter and category_filter != 'all':
-                 if category_filter in shop_data.item_categories:
-                      categories_to_show = [(category_filter, shop_data.item_categories[category_filter])]
-                 else:
-                      # Handle invalid category filter? Show error or default to all? Default to all.
-                      categories_to_show = sorted(shop_data.item_categories.items())
-            else:
-                 categories_to_show = sorted(shop_data.item_categories.items()) # Sort for consistent order
-
-            for cat, category_items in categories_to_show:
-                content = []
-                category_value = 0
-                category_has_stock = False
-
-                # Sort items within category
-                sorted_items = sorted(category_items, key=lambda x: shop_data.display_names.get(x, x))
-
-                for item_name in sorted_items:
-                    qty = shop_data.get_total_quantity(item_name)
-                    if qty > 0:
-                        any_stock = True
-                        category_has_stock = True
-                        price = shop_data.predefined_prices.get(item_name, 0)
-                        value = qty * price
-                        category_value += value
-                        display_name = shop_data.display_names.get(item_name, item_name)
-                        low_threshold = shop_data.low_stock_thresholds.get(cat, 0) # Get from shop_data
-
-                        if compact_mode:
-                            status = "⚠️" if low_threshold > 0 and qty <= low_threshold else ""
-                            content.append(f"{display_name}: {qty:,} (${value:,}) {status}".strip())
-                        else:
-                            status = ""
-                            if low_threshold > 0: # Only show status if threshold is set
-                                if qty <= low_threshold: status = "⚠️ LOW"
-                                elif qty >= low_threshold * 3: status = "📈 HIGH"
-                                # else: status = "✅ OK" # Reduce clutter, only show warnings/highs
-                            # Format for alignment
-                            formatted_price = f"${price:,}" if price else "N/A"
-                            formatted_value = f"${value:,}" if price else "N/A"
-                            content.append(f"`{display_name[:15]:<15} {qty:>5,} @ {formatted_price:>8} = {formatted_value:>10} {status}`")
-
-                if category_has_stock:
-                    total_value += category_value
-                    category_title = f"{shop_data.category_emojis.get(cat, '📦')} {cat.upper()}" # Get emoji from shop_data
-                    name = f"{category_title}: ${category_value:,}" if compact_mode else f"{category_title} (${category_value:,})"
-                    value_str = "\n".join(content)
-                    if len(value_str) > 1020: value_str = value_str[:1020] + "..." # Truncate if needed
-                    embed.add_field(name=name, value=value_str, inline=False)
-                elif category_filter and category_filter != 'all': # Only show "no stock" if filtering specifically
-                     embed.add_field(name=f"{shop_data.category_emojis.get(cat, '📦')} {cat.upper()}", value="No stock in this category.", inline=False)
-
-
-            if any_stock:
-                embed.description = f"💰 **Total Value:** ${total_value:,}"
-            else:
-                embed.description = "No items currently in stock across all categories."
+            if category_filter not in shop_data.item_categories:
+                category_filter = 'all' # No filter, 'all' or an unknown category
+
+            # Identical between inventory changes, so repeated clicks reuse the rendered embed
+            cache_key = (category_filter, compact_mode, shop_data.aggregate.version)
+            embed = stock_embed_cache.get(cache_key)
+            if embed is None:
+                started = time.perf_counter()
+                embed = render_stock_embed(category_filter, compact_mode)
+                metrics.observe("stock_embed.render", time.perf_counter() - started)
+                stock_embed_cache.put(cache_key, embed)
 
             # Add toggle button view
             toggle_view = StockViewToggle(compact_mode)
 
-            embed.set_footer(text=f"{'Compact' if compact_mode else 'Standard'} View • /quickadd, /add, /template")
-
             # Decide how to respond: send new or edit existing
             if interaction.type == discord.InteractionType.component: # If button was clicked
                  await interaction.response.edit_message(embed=embed, view=toggle_view)
@@ -1849,7 +1858,7 @@ class StockViewToggle(discord.ui.View):
     @discord.ui.button(label="Toggle View Mode", style=discord.ButtonStyle.secondary, custom_id="stock_toggle_view") # Initial label is placeholder
     async def toggle_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         try:
-            user = str(interaction.user)
+            user = shop_data.user_key(interaction.user)
             new_mode = not self.compact_mode
             shop_data.set_user_preference(user, "compact_view", new_mode) # Saves automatically
 
@@ -1905,7 +1914,7 @@ class TemplateEditSelectView(discord.ui.View):
             #    await interaction.response.send_message("❌ You cannot use this menu.", ephemeral=True)
             #    return
 
-            user_str = str(interaction.user)
+            user_str = shop_data.user_key(interaction.user)
             templates = shop_data.get_user_templates(user_str)
 
             if template_name not in templates:
@@ -1951,15 +1960,1629 @@ class TemplateEditSelectView(discord.ui.View):
 # --- END OF PASTED UI CLASSES ---
 
 
+############### STORAGE BACKENDS ###############
+
+# Exceptions a backend may raise for transient storage failures
+STORAGE_ERRORS = (pymongo.errors.PyMongoError, sqlite3.Error)
+BALANCE_OPS_KEPT = 200 # Recent operation ids kept on each balance document to make retried increments no-ops
+CLAIM_RETENTION_DAYS = 7 # How long StorageBackend.claim remembers a key (webhook sales)
+STATEMENT_BATCH_SIZE = 500 # Events fetched per round trip when streaming a statement
+EARNINGS_FIELDS = ["balance", "version", "earned", "earned_daily"] # What the bot reads from earnings documents (not the op ids)
+
+
+class StorageBackend:
+    """Document store behind ShopData (selected with STORAGE_BACKEND).
+
+    Documents look like MongoDB's: a dict with an `_id`, an integer `version` and JSON
+    fields, grouped in collections ('items', 'settings', 'leases', 'backups').
+    """
+    name = "base"
+    is_remote = False # Network storage: worth keeping a local warm-start snapshot
+    supports_change_stream = False # Can follow writes made by other instances
+
+    def connect(self) -> None:
+        """Check the store is reachable (blocking)."""
+        raise NotImplementedError
+
+    def load(self, collection: str, ids: Optional[List[str]] = None, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """All documents of `collection` (or just `ids`), optionally only `_id` plus `fields`."""
+        raise NotImplementedError
+
+    def get(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def apply_change(self, collection: str, doc_id: str, fields: Dict[str, Any], version: int) -> bool:
+        """Compare-and-set: write `fields` and bump the version only if the document is still at `version` (0 = never written)."""
+        raise NotImplementedError
+
+    def set_fields(self, collection: str, doc_id: str, fields: Dict[str, Any]) -> None:
+        """Unversioned upsert of top-level fields (bookkeeping documents only)."""
+        raise NotImplementedError
+
+    def unset_fields(self, collection: str, doc_id: str, paths: List[str]) -> None:
+        """Remove (dotted) fields without bumping the version. Only for data no reader depends on."""
+        raise NotImplementedError
+
+    def append_history(self, entries: List[Dict[str, Any]], limit: int) -> Optional[int]:
+        """Append to the sale history document, keeping the last `limit` entries. Returns its new version."""
+        raise NotImplementedError
+
+    def store_backup(self, entry: Dict[str, Any], retention_days: int) -> int:
+        """Keep a backup copy in the store and prune older ones of the same type. Returns how many were pruned."""
+        raise NotImplementedError
+
+    def increment_balance(self, collection: str, doc_id: str, amount: int, op: str,
+                          min_balance: Optional[int] = None,
+                          counters: Optional[Dict[str, float]] = None) -> Optional[Dict[str, Any]]:
+        """Atomically add `amount` to the document's `balance`, at most once per `op` id.
+
+        With `min_balance`, the change only happens if the balance stays at or above it (and
+        the document must already exist). `counters` ({dotted field: delta}) are incremented
+        in the same write. Returns the document after the change, or None if the guard
+        refused it.
+        """
+        raise NotImplementedError
+
+    def claim(self, key: str, holder_id: str) -> bool:
+        """Insert-only marker: True for the first caller to claim `key`, False for every later one.
+
+        Claims are kept CLAIM_RETENTION_DAYS, far longer than any duplicate delivery.
+        """
+        raise NotImplementedError
+
+    def acquire_lease(self, name: str, holder_id: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+        """Take or renew lease `name`. Returns the lease document, or None while someone else holds it."""
+        raise NotImplementedError
+
+    def release_lease(self, name: str, holder_id: str) -> None:
+        raise NotImplementedError
+
+    def append_events(self, events: List[Dict[str, Any]]) -> None:
+        """Add events to the append-only log, numbering them with the next `seq`. Re-appending an event id is a no-op."""
+        raise NotImplementedError
+
+    def load_events(self, after_seq: int = 0) -> List[Dict[str, Any]]:
+        """Events with `seq` greater than `after_seq`, oldest first."""
+        raise NotImplementedError
+
+    def stream_user_events(self, user: str, start: str, end: str) -> Iterator[Dict[str, Any]]:
+        """Events by `user` or with a sale credit for them, `start` <= ts < `end`, oldest first. Lazily fetched."""
+        raise NotImplementedError
+
+    def store_event_snapshot(self, snapshot: Dict[str, Any], keep: int) -> None:
+        """Save a snapshot of the event-sourced state (at `snapshot['seq']`), keeping only the newest `keep`."""
+        raise NotImplementedError
+
+    def latest_event_snapshot(self) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def watch(self, pipeline: List[Dict[str, Any]], resume_after=None):
+        raise NotImplementedError(f"The {self.name} backend has no change stream")
+
+    def rewrite(self, collection: str, docs: List[Dict[str, Any]], delete_ids: Optional[List[Any]] = None) -> None:
+        """Replace whole documents and delete others, unconditionally. For one-off maintenance jobs only."""
+        raise NotImplementedError
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Items and settings as plain data, for backups."""
+        items = {}
+        for doc in self.load("items"):
+            if isinstance(doc.get("_id"), str) and isinstance(doc.get("entries"), list):
+                items[doc["_id"]] = doc["entries"]
+        settings = {}
+        for doc in self.load("settings"):
+            if isinstance(doc.get("_id"), str) and doc.get("data") is not None: # Allow various data types
+                settings[doc["_id"]] = doc["data"]
+        # Earnings live one document per user; backups keep the old single-mapping shape
+        earnings = {doc["_id"]: doc.get("balance", 0) for doc in self.load("earnings", fields=["balance"])}
+        if earnings:
+            settings["user_earnings"] = earnings
+        profiles = self.load("user_profiles", fields=["templates", "preferences"])
+        if profiles:
+            settings["user_templates"] = {doc["_id"]: doc["templates"] for doc in profiles if doc.get("templates")}
+            settings["user_preferences"] = {doc["_id"]: doc["preferences"] for doc in profiles if doc.get("preferences")}
+        return {"items": items, "settings": settings}
+
+    @staticmethod
+    def _project(doc: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+        if fields is None:
+            return doc
+        return {"_id": doc["_id"], **{field: doc[field] for field in fields if field in doc}}
+
+
+class MongoBackend(StorageBackend):
+    """MongoDB: the only backend that supports several bot instances (change streams, server-clock leases)."""
+    name = "mongo"
+    is_remote = True
+    supports_change_stream = True
+
+    def __init__(self, uri: str, db_name: str):
+        logger.info(f"MongoDB URI check: ...@{uri.split('@')[-1].split('/')[0]}")
+        # MongoClient connects lazily, so creating it here doesn't block; connect() does the I/O
+        self.client = MongoClient(uri, serverSelectionTimeoutMS=10000)
+        self.db = self.client[db_name]
+        self._events_indexed = False
+        self._events_ts_indexed = False
+        self._claims_indexed = False
+
+    def connect(self) -> None:
+        self.client.admin.command('ping') # More reliable connection test
+
+    def load(self, collection: str, ids: Optional[List[str]] = None, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        query = {} if ids is None else {"_id": {"$in": list(ids)}}
+        projection = None if fields is None else {field: 1 for field in fields}
+        return list(self.db[collection].find(query, projection))
+
+    def get(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        return self.db[collection].find_one({"_id": doc_id})
+
+    def apply_change(self, collection: str, doc_id: str, fields: Dict[str, Any], version: int) -> bool:
+        update = {"$set": {**fields, "version": version + 1}}
+        try:
+            if version:
+                result = self.db[collection].update_one({"_id": doc_id, "version": version}, update)
+                return result.matched_count == 1
+            # Unversioned: the document is new or predates versioning ({"version": None} matches a missing field)
+            result = self.db[collection].update_one({"_id": doc_id, "version": None}, update, upsert=True)
+            return result.matched_count == 1 or result.upserted_id is not None
+        except pymongo.errors.DuplicateKeyError:
+            return False # Someone else created the document first
+
+    def set_fields(self, collection: str, doc_id: str, fields: Dict[str, Any]) -> None:
+        self.db[collection].update_one({"_id": doc_id}, {"$set": fields}, upsert=True)
+
+    def claim(self, key: str, holder_id: str) -> bool:
+        if not self._claims_indexed:
+            self.db.claims.create_index("at", expireAfterSeconds=CLAIM_RETENTION_DAYS * 86400) # MongoDB deletes old claims
+            self._claims_indexed = True
+        try:
+            # The unique _id makes this atomic across instances: exactly one insert succeeds
+            self.db.claims.insert_one({"_id": key, "holder": holder_id, "at": datetime.datetime.now(datetime.timezone.utc)})
+            return True
+        except pymongo.errors.DuplicateKeyError:
+            return False
+
+    def unset_fields(self, collection: str, doc_id: str, paths: List[str]) -> None:
+        if paths:
+            self.db[collection].update_one({"_id": doc_id}, {"$unset": {path: "" for path in paths}})
+
+    def append_history(self, entries: List[Dict[str, Any]], limit: int) -> Optional[int]:
+        # $push is atomic, so concurrent writers never clobber each other's entries
+        doc = self.db.settings.find_one_and_update(
+            {"_id": "sale_history"},
+            {
+                "$push": {"data": {"$each": entries, "$slice": -limit}},
+                "$inc": {"version": 1}
+            },
+            projection={"version": 1},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        return doc.get("version") if doc else None
+
+    def store_backup(self, entry: Dict[str, Any], retention_days: int) -> int:
+        # Limit size? MongoDB has document size limits (16MB). Check size if data can be huge.
+        self.db.backups.insert_one(entry)
+        cutoff_date = entry["timestamp_utc"] - datetime.timedelta(days=retention_days)
+        delete_result = self.db.backups.delete_many({
+            "backup_type": entry["backup_type"],
+            "timestamp_utc": {"$lt": cutoff_date}
+        })
+        return delete_result.deleted_count
+
+    def acquire_lease(self, name: str, holder_id: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+        # Expiry is checked against the MongoDB server clock ($$NOW), so clock skew between hosts doesn't matter
+        try:
+            return self.db.leases.find_one_and_update(
+                {"_id": name, "$expr": {"$or": [
+                    {"$eq": ["$holder", holder_id]},
+                    {"$lt": ["$expires_at", "$$NOW"]}
+                ]}},
+                [{"$set": {
+                    "term": {"$cond": [
+                        {"$eq": ["$holder", holder_id]},
+                        "$term",
+                        {"$add": [{"$ifNull": ["$term", 0]}, 1]}
+                    ]},
+                    "holder": holder_id,
+                    "expires_at": {"$add": ["$$NOW", ttl_seconds * 1000]},
+                    "renewed_at": "$$NOW"
+                }}],
+                upsert=True,
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return None # Lease exists and is held by another live instance
+
+    def release_lease(self, name: str, holder_id: str) -> None:
+        self.db.leases.update_one({"_id": name, "holder": holder_id}, [{"$set": {"expires_at": "$$NOW"}}])
+
+    def increment_balance(self, collection: str, doc_id: str, amount: int, op: str,
+                          min_balance: Optional[int] = None,
+                          counters: Optional[Dict[str, float]] = None) -> Optional[Dict[str, Any]]:
+        # One conditional $inc: the balance check and the change happen in a single server-side step
+        query = {"_id": doc_id, "ops": {"$ne": op}}
+        if min_balance is not None:
+            query["balance"] = {"$gte": min_balance - amount}
+        try:
+            doc = self.db[collection].find_one_and_update(
+                query,
+                {
+                    "$inc": {"balance": amount, "version": 1, **(counters or {})},
+                    "$push": {"ops": {"$each": [op], "$slice": -BALANCE_OPS_KEPT}}
+                },
+                upsert=min_balance is None,
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        except pymongo.errors.DuplicateKeyError:
+            doc = None # The op was already applied (the upsert collided with the existing document)
+        if doc is not None:
+            return doc
+        # Refused, or a retry of an op that already went through
+        current = self.db[collection].find_one({"_id": doc_id})
+        return current if current and op in current.get("ops", []) else None
+
+    def append_events(self, events: List[Dict[str, Any]]) -> None:
+        if not events:
+            return
+        if not self._events_indexed:
+            self.db.events.create_index("seq")
+            self._events_indexed = True
+        # Reserve a block of sequence numbers, then insert; upserting on the event id makes replays harmless
+        counter = self.db.counters.find_one_and_update(
+            {"_id": "events"},
+            {"$inc": {"seq": len(events)}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        first_seq = counter["seq"] - len(events) + 1
+        self.db.events.bulk_write([
+            pymongo.UpdateOne({"_id": event["id"]}, {"$setOnInsert": {**event, "seq": first_seq + i}}, upsert=True)
+            for i, event in enumerate(events)
+        ])
+
+    def load_events(self, after_seq: int = 0) -> List[Dict[str, Any]]:
+        return list(self.db.events.find({"seq": {"$gt": after_seq}}, {"_id": 0}).sort("seq", 1))
+
+    def stream_user_events(self, user: str, start: str, end: str) -> Iterator[Dict[str, Any]]:
+        if not self._events_ts_indexed:
+            self.db.events.create_index("ts")
+            self._events_ts_indexed = True
+        query = {"ts": {"$gte": start, "$lt": end}, "$or": [{"user": user}, {f"credits.{user}": {"$exists": True}}]}
+        # The cursor fetches a batch at a time, so only one batch is ever held here
+        yield from self.db.events.find(query, {"_id": 0}).sort("ts", 1).batch_size(STATEMENT_BATCH_SIZE)
+
+    def store_event_snapshot(self, snapshot: Dict[str, Any], keep: int) -> None:
+        self.db.event_snapshots.replace_one({"_id": snapshot["seq"]}, snapshot, upsert=True)
+        stale = [doc["_id"] for doc in self.db.event_snapshots.find({}, {"_id": 1}).sort("_id", -1).skip(keep)]
+        if stale:
+            self.db.event_snapshots.delete_many({"_id": {"$in": stale}})
+
+    def latest_event_snapshot(self) -> Optional[Dict[str, Any]]:
+        return next(iter(self.db.event_snapshots.find().sort("_id", -1).limit(1)), None)
+
+    def watch(self, pipeline: List[Dict[str, Any]], resume_after=None):
+        return self.db.watch(pipeline, full_document="updateLookup", resume_after=resume_after)
+
+    def rewrite(self, collection: str, docs: List[Dict[str, Any]], delete_ids: Optional[List[Any]] = None) -> None:
+        requests = [pymongo.ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs]
+        requests += [pymongo.DeleteOne({"_id": doc_id}) for doc_id in delete_ids or []]
+        for i in range(0, len(requests), 500): # Keep each round trip well under the 16MB message limit
+            self.db[collection].bulk_write(requests[i:i + 500], ordered=False)
+
+
+class LocalDocumentBackend(StorageBackend):
+    """Shared logic for single-host backends that read-modify-write whole documents in a transaction."""
+
+    def _transaction(self):
+        """Context manager holding the backend's write lock/transaction."""
+        raise NotImplementedError
+
+    def _read(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _read_many(self, collection: str, ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _write(self, collection: str, doc: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def _delete(self, collection: str, doc_ids: List[str]) -> None:
+        raise NotImplementedError
+
+    def load(self, collection: str, ids: Optional[List[str]] = None, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        with self._transaction():
+            docs = self._read_many(collection, ids)
+        return [self._project(doc, fields) for doc in docs]
+
+    def get(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        with self._transaction():
+            return self._read(collection, doc_id)
+
+    def apply_change(self, collection: str, doc_id: str, fields: Dict[str, Any], version: int) -> bool:
+        with self._transaction():
+            doc = self._read(collection, doc_id)
+            current = doc.get("version") if doc else None
+            if current != (version or None):
+                return False
+            self._write(collection, {**(doc or {"_id": doc_id}), **copy.deepcopy(fields), "version": version + 1})
+            return True
+
+    def claim(self, key: str, holder_id: str) -> bool:
+        now = time.time()
+        with self._transaction():
+            if self._read("claims", key) is not None:
+                return False
+            self._write("claims", {"_id": key, "holder": holder_id, "at": now})
+            self._claims_written = getattr(self, "_claims_written", 0) + 1
+            if self._claims_written % 100 == 0: # Prune now and then rather than reading every claim each time
+                cutoff = now - CLAIM_RETENTION_DAYS * 86400
+                self._delete("claims", [doc["_id"] for doc in self._read_many("claims") if doc.get("at", 0) < cutoff])
+        return True
+
+    def set_fields(self, collection: str, doc_id: str, fields: Dict[str, Any]) -> None:
+        with self._transaction():
+            doc = self._read(collection, doc_id) or {"_id": doc_id}
+            doc.update(copy.deepcopy(fields))
+            self._write(collection, doc)
+
+    def unset_fields(self, collection: str, doc_id: str, paths: List[str]) -> None:
+        with self._transaction():
+            doc = self._read(collection, doc_id)
+            if doc is None or not paths:
+                return
+            for path in paths:
+                *parents, leaf = path.split(".")
+                target = doc
+                for key in parents:
+                    target = target.get(key) if isinstance(target, dict) else None
+                if isinstance(target, dict):
+                    target.pop(leaf, None)
+            self._write(collection, doc)
+
+    def append_history(self, entries: List[Dict[str, Any]], limit: int) -> Optional[int]:
+        with self._transaction():
+            doc = self._read("settings", "sale_history") or {"_id": "sale_history", "data": []}
+            doc["data"] = ((doc.get("data") or []) + copy.deepcopy(entries))[-limit:]
+            doc["version"] = doc.get("version", 0) + 1
+            self._write("settings", doc)
+            return doc["version"]
+
+    def store_backup(self, entry: Dict[str, Any], retention_days: int) -> int:
+        cutoff = (entry["timestamp_utc"] - datetime.timedelta(days=retention_days)).isoformat()
+        with self._transaction():
+            self._write("backups", {**entry, "_id": entry["timestamp_utc"].isoformat()})
+            expired = [
+                doc["_id"] for doc in self._read_many("backups")
+                if doc.get("backup_type") == entry["backup_type"] and doc["_id"] < cutoff
+            ]
+            self._delete("backups", expired)
+        return len(expired)
+
+    def append_events(self, events: List[Dict[str, Any]]) -> None:
+        if not events:
+            return
+        with self._transaction():
+            counter = self._read("counters", "events") or {"_id": "events", "seq": 0}
+            for event in events:
+                if self._read("events", event["id"]) is None:
+                    counter["seq"] += 1
+                    self._write("events", {**event, "_id": event["id"], "seq": counter["seq"]})
+            self._write("counters", counter)
+
+    def load_events(self, after_seq: int = 0) -> List[Dict[str, Any]]:
+        with self._transaction():
+            docs = self._read_many("events")
+        events = [{k: v for k, v in doc.items() if k != "_id"} for doc in docs if doc.get("seq", 0) > after_seq]
+        return sorted(events, key=lambda event: event["seq"])
+
+    def store_event_snapshot(self, snapshot: Dict[str, Any], keep: int) -> None:
+        with self._transaction():
+            self._write("event_snapshots", {**snapshot, "_id": f"{snapshot['seq']:012d}"}) # Zero-padded so ids sort by seq
+            snapshot_ids = sorted(doc["_id"] for doc in self._read_many("event_snapshots"))
+            self._delete("event_snapshots", snapshot_ids[:-keep])
+
+    def latest_event_snapshot(self) -> Optional[Dict[str, Any]]:
+        with self._transaction():
+            docs = self._read_many("event_snapshots")
+        return max(docs, key=lambda doc: doc["seq"]) if docs else None
+
+    def acquire_lease(self, name: str, holder_id: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+        now = time.time() # One host, one clock
+        with self._transaction():
+            doc = self._read("leases", name) or {"_id": name, "term": 0}
+            if doc.get("holder") not in (None, holder_id) and doc.get("expires_at", 0) >= now:
+                return None
+            if doc.get("holder") != holder_id:
+                doc["term"] = doc.get("term", 0) + 1
+            doc.update({"holder": holder_id, "expires_at": now + ttl_seconds, "renewed_at": now})
+            self._write("leases", doc)
+            return doc
+
+    def release_lease(self, name: str, holder_id: str) -> None:
+        with self._transaction():
+            doc = self._read("leases", name)
+            if doc and doc.get("holder") == holder_id:
+                doc["expires_at"] = time.time()
+                self._write("leases", doc)
+
+    def rewrite(self, collection: str, docs: List[Dict[str, Any]], delete_ids: Optional[List[Any]] = None) -> None:
+        with self._transaction():
+            for doc in docs:
+                self._write(collection, doc)
+            self._delete(collection, list(delete_ids or []))
+
+    def increment_balance(self, collection: str, doc_id: str, amount: int, op: str,
+                          min_balance: Optional[int] = None,
+                          counters: Optional[Dict[str, float]] = None) -> Optional[Dict[str, Any]]:
+        with self._transaction():
+            doc = self._read(collection, doc_id)
+            if doc and op in doc.get("ops", []):
+                return doc
+            if min_balance is not None and (doc is None or doc.get("balance", 0) + amount < min_balance):
+                return None
+            doc = doc or {"_id": doc_id, "balance": 0, "version": 0}
+            doc["balance"] = doc.get("balance", 0) + amount
+            doc["version"] = doc.get("version", 0) + 1
+            doc["ops"] = (doc.get("ops", []) + [op])[-BALANCE_OPS_KEPT:]
+            for path, delta in (counters or {}).items():
+                *parents, leaf = path.split(".")
+                target = doc
+                for key in parents:
+                    target = target.setdefault(key, {})
+                target[leaf] = target.get(leaf, 0) + delta
+            self._write(collection, doc)
+            return doc
+
+
+class MemoryBackend(LocalDocumentBackend):
+    """Keeps everything in process memory; nothing survives a restart. For tests and benchmarks."""
+    name = "memory"
+
+    def __init__(self):
+        self._collections: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.RLock()
+
+    def connect(self) -> None:
+        logger.warning("⚠️ Using in-memory storage: data is lost when the bot stops.")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield
+
+    def _read(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        doc = self._collections.get(collection, {}).get(doc_id)
+        return copy.deepcopy(doc) if doc is not None else None
+
+    def _read_many(self, collection: str, ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        docs = self._collections.get(collection, {})
+        if ids is not None:
+            return [copy.deepcopy(docs[doc_id]) for doc_id in ids if doc_id in docs]
+        return [copy.deepcopy(doc) for doc in docs.values()]
+
+    def _write(self, collection: str, doc: Dict[str, Any]) -> None:
+        self._collections.setdefault(collection, {})[doc["_id"]] = copy.deepcopy(doc)
+
+    def _delete(self, collection: str, doc_ids: List[str]) -> None:
+        for doc_id in doc_ids:
+            self._collections.get(collection, {}).pop(doc_id, None)
+
+    def stream_user_events(self, user: str, start: str, end: str) -> Iterator[Dict[str, Any]]:
+        # The log is in this process already; only the matching events are copied
+        with self._lock:
+            matches = [doc for doc in self._collections.get("events", {}).values() if start <= doc.get("ts", "") < end
+                       and (doc.get("user") == user or user in (doc.get("credits") or {}))]
+            matches = copy.deepcopy(sorted(matches, key=lambda doc: doc["ts"]))
+        for doc in matches:
+            yield {k: v for k, v in doc.items() if k != "_id"}
+
+
+class SQLiteBackend(LocalDocumentBackend):
+    """A single SQLite file in WAL mode: no network round trips, one host only."""
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock() # One connection shared by the loop and worker threads
+
+    def connect(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # Autocommit mode: transactions are opened explicitly in _transaction()
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer
+            conn.execute("PRAGMA synchronous=NORMAL") # Safe against crashes in WAL mode, fsyncs only at checkpoints
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "collection TEXT NOT NULL, id TEXT NOT NULL, body TEXT NOT NULL, PRIMARY KEY (collection, id))"
+            )
+            # Lets statements read one user's events in time order without loading the whole log
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS events_by_ts ON documents (json_extract(body, '$.ts')) WHERE collection = 'events'"
+            )
+            self._conn = conn
+            logger.info(f"🗄️ Using SQLite storage: {self.path}")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            if self._conn is None:
+                self.connect()
+            self._conn.execute("BEGIN IMMEDIATE") # Also serialises writers in other processes on this file
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _read(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn.execute("SELECT body FROM documents WHERE collection = ? AND id = ?", (collection, doc_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _read_many(self, collection: str, ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        if ids is None:
+            rows = self._conn.execute("SELECT body FROM documents WHERE collection = ?", (collection,)).fetchall()
+        else:
+            ids = list(ids)
+            if not ids:
+                return []
+            placeholders = ", ".join("?" * len(ids))
+            rows = self._conn.execute(
+                f"SELECT body FROM documents WHERE collection = ? AND id IN ({placeholders})", (collection, *ids)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _write(self, collection: str, doc: Dict[str, Any]) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO documents (collection, id, body) VALUES (?, ?, ?)",
+            (collection, doc["_id"], json.dumps(doc, default=str))
+        )
+
+    def stream_user_events(self, user: str, start: str, end: str) -> Iterator[Dict[str, Any]]:
+        # Own read-only connection: WAL gives it a consistent snapshot, and the shared one
+        # (and its lock) stays free for the bot while the cursor is read row by row
+        if self._conn is None:
+            self.connect() # Creates the file, table and index
+        conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, timeout=10, check_same_thread=False)
+        try:
+            cursor = conn.execute(
+                "SELECT body FROM documents INDEXED BY events_by_ts WHERE collection = 'events'" # Rows come in ts order, no sort buffer
+                " AND json_extract(body, '$.ts') >= ? AND json_extract(body, '$.ts') < ?"
+                " AND (json_extract(body, '$.user') = ? OR json_type(body, '$.credits.\"' || ? || '\"') IS NOT NULL)"
+                " ORDER BY json_extract(body, '$.ts')",
+                (start, end, user, user)
+            )
+            for (body,) in cursor:
+                doc = json.loads(body)
+                doc.pop("_id", None)
+                yield doc
+        finally:
+            conn.close()
+
+    def _delete(self, collection: str, doc_ids: List[str]) -> None:
+        self._conn.executemany("DELETE FROM documents WHERE collection = ? AND id = ?", [(collection, doc_id) for doc_id in doc_ids])
+
+
+def create_storage_backend() -> StorageBackend:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteBackend(SQLITE_PATH)
+    if STORAGE_BACKEND == "memory":
+        return MemoryBackend()
+    return MongoBackend(MONGO_URI, DB_NAME)
+
+
 ############### DATA CLASS ###############
+
+# Settings documents written with optimistic versioning. The attribute on ShopData
+# has the same name as the document _id in the 'settings' collection.
+VERSIONED_SETTINGS = ["predefined_prices"]
+# Earnings are one document per user in the 'earnings' collection, changed only with
+# StorageBackend.increment_balance: a credit or payout is a single O(1) write.
+# Templates, preferences and the last display name seen ("identity") are one 'user_profiles'
+# document per user, loaded on first use into a TTL cache and written field by field.
+PROFILE_FIELDS = ("templates", "preferences", "identity")
+LEGACY_PROFILE_SETTINGS = {"user_templates": "templates", "user_preferences": "preferences"} # Old settings doc: profile field
+PROFILE_CACHE_SIZE = 512
+PROFILE_CACHE_TTL = 30 * 60 # Seconds an idle user's profile stays in memory
+SALE_HISTORY_LIMIT = 1000
+LOT_COMPACTION_HOURS = 1 # Saves compact the items they write; this catches everything else
+MAX_WRITE_ATTEMPTS = 3
+
+
+class ConcurrentUpdateError(RuntimeError):
+    """Raised when a versioned write keeps losing the race against another bot instance."""
+
+
+def _lot_key(entry: Dict[str, Any]) -> tuple:
+    return (entry.get('person'), entry.get('date'), entry.get('price'))
+
+
+def compact_lots(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merge lots with the same person, date and price, keeping FIFO order and totals.
+
+    Sales and removals take the oldest date first, then list order, so a lot is only
+    folded into an earlier one when no other lot of the same date sits between them.
+    Empty lots are dropped.
+    """
+    compacted = []
+    last_lot_of_date: Dict[Any, Dict[str, Any]] = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or entry.get('quantity', 0) <= 0:
+            continue
+        previous = last_lot_of_date.get(entry.get('date'))
+        if previous is not None and _lot_key(previous) == _lot_key(entry):
+            previous['quantity'] += entry['quantity']
+            continue
+        lot = dict(entry)
+        compacted.append(lot)
+        last_lot_of_date[entry.get('date')] = lot
+    return compacted
+
+
+def merge_lots(base: List[Dict[str, Any]], local: List[Dict[str, Any]], remote: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Three-way merge of an item's stock lots.
+
+    Applies the quantity changes made locally since `base` (the last state both sides
+    agreed on) on top of `remote`, so an add in one process and a sale in another both survive.
+    """
+    def totals(entries):
+        result: Dict[tuple, int] = {}
+        for entry in entries:
+            if isinstance(entry, dict):
+                key = _lot_key(entry)
+                result[key] = result.get(key, 0) + entry.get('quantity', 0)
+        return result
+
+    delta = totals(local)
+    for key, qty in totals(base).items():
+        delta[key] = delta.get(key, 0) - qty
+
+    merged = [dict(entry) for entry in remote if isinstance(entry, dict)]
+    for key, change in delta.items():
+        if change > 0:
+            # New (or grown) lot: append so the remote FIFO order stays intact
+            person, date, price = key
+            merged.append({"person": person, "quantity": change, "date": date, "price": price})
+        elif change < 0:
+            remaining = -change
+            for entry in merged:
+                if remaining <= 0:
+                    break
+                if _lot_key(entry) == key and entry.get('quantity', 0) > 0:
+                    taken = min(entry['quantity'], remaining)
+                    entry['quantity'] -= taken
+                    remaining -= taken
+            if remaining > 0:
+                logger.error(f"❌ Merge conflict: {remaining} units of lot {key} were already removed by another instance")
+
+    return [entry for entry in merged if entry.get('quantity', 0) > 0]
+
+
+def merge_mapping(base: Any, local: Any, remote: Any) -> Dict[str, Any]:
+    """Three-way merge of a settings mapping: keys changed locally win, the rest follow remote."""
+    base = base if isinstance(base, dict) else {}
+    local = local if isinstance(local, dict) else {}
+    merged = copy.deepcopy(remote) if isinstance(remote, dict) else {}
+
+    for key in set(base) | set(local):
+        if key in local and key in base and local[key] == base[key]:
+            continue # Untouched locally
+        if key not in local:
+            merged.pop(key, None) # Deleted locally
+            continue
+
+        local_value = local[key]
+        base_value = base.get(key)
+        remote_value = merged.get(key)
+        if isinstance(local_value, dict) and isinstance(base_value, dict) and isinstance(remote_value, dict):
+            merged[key] = merge_mapping(base_value, local_value, remote_value)
+        else:
+            merged[key] = copy.deepcopy(local_value)
+    return merged
+
+
+# --- User keys ---
+# Users are stored under their Discord ID (as a decimal string: it is also a JSON/dict key).
+# Data from before that is keyed by username; rekey_*() rewrite it given {username: id}.
+NON_USER_KEYS = {"customer", "all", "unknown"} # Placeholders used in history and events
+
+
+def rekey_lots(entries: Any, mapping: Dict[str, str]) -> int:
+    """Rename `person` on stock lots in place. Returns how many lots changed."""
+    changed = 0
+    for entry in entries if isinstance(entries, list) else []:
+        if isinstance(entry, dict) and entry.get("person") in mapping:
+            entry["person"] = mapping[entry["person"]]
+            changed += 1
+    return changed
+
+
+def rekey_mapping(data: Dict[str, Any], mapping: Dict[str, str]) -> int:
+    """Rename user keys of a {user: value} dict in place; colliding numbers add up, dicts merge."""
+    changed = 0
+    for old_key in [key for key in data if key in mapping]:
+        value, new_key = data.pop(old_key), mapping[old_key]
+        existing = data.get(new_key)
+        if isinstance(existing, (int, float)) and isinstance(value, (int, float)):
+            value = existing + value
+        elif isinstance(existing, dict) and isinstance(value, dict):
+            value = {**value, **existing} # The ID-keyed entry is newer
+        data[new_key] = value
+        changed += 1
+    return changed
+
+
+def rekey_history(entries: Any, mapping: Dict[str, str]) -> int:
+    changed = 0
+    for entry in entries if isinstance(entries, list) else []:
+        if isinstance(entry, dict) and entry.get("user") in mapping:
+            entry["user"] = mapping[entry["user"]]
+            changed += 1
+    return changed
+
+
+def rekey_snapshot(data: Dict[str, Any], mapping: Dict[str, str]) -> int:
+    """Rekey a backup (storage.snapshot() shape) or event snapshot state in place. Returns how many values changed."""
+    changed = sum(rekey_lots(entries, mapping) for entries in (data.get("items") or {}).values())
+    settings = data.get("settings") if isinstance(data.get("settings"), dict) else data # Event snapshot state is flat
+    for key in ("user_earnings", "user_templates", "user_preferences"):
+        if isinstance(settings.get(key), dict):
+            changed += rekey_mapping(settings[key], mapping)
+    changed += rekey_history(settings.get("sale_history"), mapping)
+    return changed
+
+
+# --- Event-sourced inventory ---
+# Every change to stock, prices or earnings is an InventoryEvent. ShopData applies it to
+# its live state with apply_inventory_event() and appends it to the event log, so the
+# state can be rebuilt from the latest event snapshot plus the events after it.
+EVENT_SNAPSHOT_HOURS = 6
+EVENT_SNAPSHOTS_KEPT = 3
+
+
+@dataclass
+class InventoryEvent:
+    """One change to stock, prices or earnings."""
+    type: Literal["add", "remove", "sale", "set", "clear", "price_change", "payout"]
+    item: Optional[str] = None # None = every item (clear)
+    user: Optional[str] = None # None = every user (clear)
+    quantity: int = 0
+    price: int = 0 # Per item (add/set/sale/price_change)
+    amount: float = 0 # Payout amount
+    date: Optional[str] = None # Lot date for add/set
+    update_existing: bool = False # price_change: also reprice lots in stock
+    ts: str = field(default_factory=lambda: datetime.datetime.now(datetime.timezone.utc).isoformat())
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    seq: Optional[int] = None # Assigned by the event log
+
+    def to_doc(self) -> Dict[str, Any]:
+        doc = asdict(self)
+        doc.pop("seq")
+        return doc
+
+    @classmethod
+    def from_doc(cls, doc: Dict[str, Any]) -> "InventoryEvent":
+        return cls(**{key: doc[key] for key in cls.__dataclass_fields__ if key in doc})
+
+
+@dataclass
+class InventoryState:
+    """The part of ShopData that events change; what event snapshots store."""
+    items: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+    user_earnings: Dict[str, float] = field(default_factory=dict)
+    predefined_prices: Dict[str, int] = field(default_factory=dict)
+
+
+def _remove_user_lots(entries: List[Dict[str, Any]], user: str, quantity: int) -> int:
+    """Take `quantity` from `user`'s lots, oldest first. Returns how many were removed."""
+    user_lots = [e for e in entries if isinstance(e, dict) and e.get('person') == user and e.get('quantity', 0) > 0]
+    user_lots.sort(key=lambda e: e.get('date', '9999-99-99'))
+    removed = 0
+    for lot in user_lots:
+        if removed >= quantity:
+            break
+        take = min(lot['quantity'], quantity - removed)
+        lot['quantity'] -= take
+        removed += take
+    return removed
+
+
+def _sell_lots(entries: List[Dict[str, Any]], quantity: int, price_each: int) -> Dict[str, float]:
+    """Sell FIFO across all contributors. Returns what each one earned (their share of the sale value)."""
+    lots = [e for e in entries if isinstance(e, dict) and e.get('quantity', 0) > 0 and e.get('person')]
+    lots.sort(key=lambda e: e.get('date', '9999-99-99'))
+    sold = []
+    remaining = quantity
+    for lot in lots:
+        if remaining <= 0:
+            break
+        take = min(lot['quantity'], remaining)
+        lot['quantity'] -= take
+        remaining -= take
+        sold.append((lot['person'], take))
+
+    total_sold = quantity - remaining
+    credits: Dict[str, float] = {}
+    for person, take in sold:
+        credits[person] = credits.get(person, 0) + quantity * price_each * (take / total_sold)
+    return credits
+
+
+def apply_inventory_event(state, event: InventoryEvent) -> Dict[str, float]:
+    """Apply one event to `state` (ShopData or InventoryState). Returns earnings credited by a sale.
+
+    Deterministic and free of validation: callers check stock and balances before
+    creating an event, so replaying the log always reproduces the same state.
+    """
+    items = state.items
+    if event.type == "add":
+        items.setdefault(event.item, []).append({
+            "person": event.user, "quantity": event.quantity, "date": event.date, "price": event.price
+        })
+    elif event.type == "remove":
+        _remove_user_lots(items.get(event.item, []), event.user, event.quantity)
+    elif event.type == "sale":
+        credits = _sell_lots(items.get(event.item, []), event.quantity, event.price)
+        for user, amount in credits.items():
+            state.user_earnings[user] = state.user_earnings.get(user, 0) + amount
+        items[event.item] = [e for e in items.get(event.item, []) if e.get('quantity', 0) > 0]
+        return credits
+    elif event.type == "set":
+        items[event.item] = [e for e in items.get(event.item, []) if e.get('person') != event.user]
+        if event.quantity > 0:
+            items[event.item].append({
+                "person": event.user, "quantity": event.quantity, "date": event.date, "price": event.price
+            })
+    elif event.type == "clear":
+        for item_name in ([event.item] if event.item else list(items)):
+            if item_name not in items:
+                continue
+            if event.user:
+                items[item_name] = [e for e in items[item_name] if e.get('person') != event.user]
+            else:
+                items[item_name] = []
+            if not items[item_name]:
+                del items[item_name]
+    elif event.type == "price_change":
+        state.predefined_prices[event.item] = event.price
+        if event.update_existing:
+            for entry in items.get(event.item, []):
+                if isinstance(entry, dict):
+                    entry["price"] = event.price
+    elif event.type == "payout":
+        state.user_earnings[event.user] = state.user_earnings.get(event.user, 0) - event.amount
+    else:
+        raise ValueError(f"Unknown inventory event type: {event.type}")
+    return {}
+
+
+def rebuild_inventory(storage: "StorageBackend") -> Tuple[InventoryState, int, int]:
+    """Rebuild state from the latest event snapshot plus every later event.
+
+    Returns (state, last applied seq, number of events replayed). Blocking.
+    """
+    snapshot = storage.latest_event_snapshot()
+    state = InventoryState(**copy.deepcopy(snapshot["state"])) if snapshot else InventoryState()
+    last_seq = snapshot["seq"] if snapshot else 0
+    events = storage.load_events(last_seq)
+    for doc in events:
+        apply_inventory_event(state, InventoryEvent.from_doc(doc))
+    return state, (events[-1]["seq"] if events else last_seq), len(events)
+
+
+# --- Inventory aggregate ---
+# Per-item, per-category and per-user stock figures derived from the lots. Every read path
+# goes through shop_data.aggregate instead of summing raw lots itself.
+
+@dataclass(frozen=True)
+class StockRow:
+    item: str
+    display_name: str
+    quantity: int
+    price: int
+    value: int
+    status: str # "low", "high", "ok", or "" if the category has no threshold
+
+
+@dataclass(frozen=True)
+class CategoryTotals:
+    category: str
+    emoji: str
+    rows: Tuple[StockRow, ...] # Stocked items only, sorted by display name
+    quantity: int
+    value: int
+
+
+class InventoryAggregate:
+    """Versioned read model of the inventory, shared by the board, /stock, /userinfo and /analytics.
+
+    Mutations only mark items dirty (invalidate); the next read recomputes just those items
+    from their lots and reuses everything else. `version` goes up on every change, so it can
+    key caches of rendered output.
+    """
+
+    def __init__(self, shop: "ShopData"):
+        self._shop = shop
+        self.version = 0
+        self._rebuild = True
+        self._dirty: Set[str] = set()
+        self._item_category: Dict[str, str] = {}
+        self._quantities: Dict[str, int] = {} # item: total qty
+        self._item_holdings: Dict[str, Dict[Optional[str], int]] = {} # item: {person: qty}
+        self._user_holdings: Dict[Optional[str], Dict[str, int]] = {} # person: {item: qty}
+        self._rows: Dict[str, StockRow] = {}
+        self._categories: Dict[str, CategoryTotals] = {}
+        self._totals: Optional[Tuple[int, int]] = None
+
+    def invalidate(self, item_name: Optional[str] = None) -> None:
+        """Mark one item's lots as changed, or everything (prices, thresholds, a reload) with no name."""
+        self.version += 1
+        self._totals = None
+        if item_name is None:
+            self._rebuild = True
+        else:
+            self._dirty.add(item_name)
+
+    def _sync(self) -> None:
+        if self._rebuild:
+            shop = self._shop
+            self._item_category = {item: cat for cat, items in shop.item_categories.items() for item in items}
+            self._quantities, self._item_holdings, self._user_holdings = {}, {}, {}
+            self._rows, self._categories = {}, {}
+            self._dirty = set(shop.items)
+            self._rebuild = False
+        if not self._dirty:
+            return
+        started = time.perf_counter()
+        for item_name in self._dirty:
+            self._refresh_item(item_name)
+        metrics.incr("aggregate.items_refreshed", len(self._dirty))
+        metrics.observe("aggregate.refresh", time.perf_counter() - started)
+        self._dirty.clear()
+
+    def _refresh_item(self, item_name: str) -> None:
+        holdings: Dict[Optional[str], int] = {}
+        for entry in self._shop.items.get(item_name, []):
+            if isinstance(entry, dict) and entry.get('quantity', 0):
+                person = entry.get('person')
+                holdings[person] = holdings.get(person, 0) + entry['quantity']
+        holdings = {person: qty for person, qty in holdings.items() if qty}
+
+        for person in self._item_holdings.pop(item_name, {}):
+            user_items = self._user_holdings.get(person, {})
+            user_items.pop(item_name, None)
+            if not user_items:
+                self._user_holdings.pop(person, None)
+        if holdings:
+            self._item_holdings[item_name] = holdings
+            for person, qty in holdings.items():
+                self._user_holdings.setdefault(person, {})[item_name] = qty
+            self._quantities[item_name] = sum(holdings.values())
+        else:
+            self._quantities.pop(item_name, None)
+
+        self._rows.pop(item_name, None)
+        self._categories.pop(self._item_category.get(item_name), None)
+
+    def quantity(self, item_name: str) -> int:
+        self._sync()
+        return self._quantities.get(item_name, 0)
+
+    def user_quantity(self, item_name: str, user: str) -> int:
+        self._sync()
+        return self._item_holdings.get(item_name, {}).get(user, 0)
+
+    def sellable(self, item_name: str) -> int:
+        """Stock that belongs to a contributor (lots without a person can't be sold)."""
+        self._sync()
+        return sum(qty for person, qty in self._item_holdings.get(item_name, {}).items() if person)
+
+    def user_holdings(self, user: str) -> Dict[str, int]:
+        """{item: qty} for everything `user` currently has in stock."""
+        self._sync()
+        return dict(self._user_holdings.get(user, {}))
+
+    def contributors(self) -> Dict[str, int]:
+        """{user: value of their stock at current prices} for everyone with stock."""
+        self._sync()
+        prices = self._shop.predefined_prices
+        return {person: sum(qty * prices.get(item, 0) for item, qty in items.items())
+                for person, items in self._user_holdings.items() if person}
+
+    def category_of(self, item_name: str) -> Optional[str]:
+        self._sync()
+        return self._item_category.get(item_name)
+
+    def stocked_items(self) -> Dict[str, int]:
+        """{item: qty} for every item with stock."""
+        self._sync()
+        return {item: qty for item, qty in self._quantities.items() if qty > 0}
+
+    def row(self, item_name: str) -> StockRow:
+        self._sync()
+        row = self._rows.get(item_name)
+        if row is None:
+            shop = self._shop
+            qty = self._quantities.get(item_name, 0)
+            price = shop.predefined_prices.get(item_name, 0)
+            threshold = shop.low_stock_thresholds.get(self._item_category.get(item_name), 0)
+            status = ""
+            if threshold > 0: # Only flag items whose category has a threshold set
+                status = "low" if qty <= threshold else "high" if qty >= threshold * 3 else "ok"
+            row = StockRow(item_name, shop.display_names.get(item_name, item_name), qty, price, qty * price, status)
+            self._rows[item_name] = row
+        return row
+
+    def category(self, category: str) -> CategoryTotals:
+        self._sync()
+        totals = self._categories.get(category)
+        if totals is None:
+            shop = self._shop
+            rows = sorted((self.row(item) for item in shop.item_categories.get(category, [])), key=lambda r: r.display_name)
+            rows = tuple(r for r in rows if r.quantity > 0)
+            totals = CategoryTotals(category, shop.category_emojis.get(category, "📦"), rows,
+                                    sum(r.quantity for r in rows), sum(r.value for r in rows))
+            self._categories[category] = totals
+        return totals
+
+    def totals(self) -> Tuple[int, int]:
+        """(items in stock, stock value) across every item."""
+        self._sync()
+        if self._totals is None:
+            rows = [self.row(item) for item, qty in self._quantities.items() if qty > 0]
+            self._totals = (sum(r.quantity for r in rows), sum(r.value for r in rows))
+        return self._totals
+
+
+# --- Low-stock alerts ---
+LOW_STOCK_RECOVERY_FACTOR = 1.2 # A low item counts as restocked only above threshold × this
+
+
+class StockAlertEngine:
+    """Per-item low-stock state, updated on every stock change, with hysteresis.
+
+    An item turns low at or below its category threshold and only recovers above
+    threshold × LOW_STOCK_RECOVERY_FACTOR, so sales around the threshold don't flap.
+    `notified` is the state the last digest reported; it is persisted, so a restart
+    only reports what changed since.
+    """
+
+    def __init__(self, shop: "ShopData"):
+        self._shop = shop
+        self.primed = False
+        self.primed_term: Optional[int] = None # Leader term whose saved state `notified` came from
+        self.low: Set[str] = set()
+        self.notified: Set[str] = set()
+
+    def prime(self, notified: List[str]) -> None:
+        """Start tracking: take the persisted notified state and evaluate every item once."""
+        self.notified = set(notified)
+        self.low = set()
+        self.primed = True
+        self.observe()
+
+    def observe(self, item_name: Optional[str] = None) -> None:
+        """Re-evaluate one item after its stock changed (every item with no name). O(1) per item."""
+        if not self.primed:
+            return # prime() evaluates everything
+        shop = self._shop
+        for item in [item_name] if item_name else list(shop.predefined_prices):
+            qty = shop.aggregate.quantity(item)
+            threshold = shop.low_stock_thresholds.get(shop.aggregate.category_of(item), 0)
+            if threshold <= 0:
+                is_low = False
+            elif item in self.low:
+                is_low = qty <= threshold * LOW_STOCK_RECOVERY_FACTOR
+            else:
+                is_low = qty <= threshold
+            if is_low != (item in self.low):
+                (self.low.add if is_low else self.low.discard)(item)
+                metrics.incr("alerts.crossings")
+
+    def pending(self) -> Tuple[List[str], List[str]]:
+        """(items gone low, items restocked) since the last digest. Crossings that undid themselves cancel out."""
+        return sorted(self.low - self.notified), sorted(self.notified - self.low)
+
+    def mark_notified(self, went_low: List[str], restocked: List[str]) -> None:
+        self.notified = (self.notified | set(went_low)) - set(restocked)
+
+
+# --- Earnings leaderboard ---
+
+LEADERBOARD_WINDOWS = {"all": None, "30d": 30, "7d": 7} # Window: days (None = all time)
+LEADERBOARD_DAYS_KEPT = max(days for days in LEADERBOARD_WINDOWS.values() if days) # Older earned_daily keys are pruned
+
+
+class EarningsLeaderboard:
+    """Sale earnings per user, ranked for each window in LEADERBOARD_WINDOWS.
+
+    Fed from earnings documents, whose `earned` (all time) and `earned_daily` (per UTC day)
+    counters are incremented in the same write as each sale credit. Every window keeps a
+    ranking sorted by amount that is updated per user as their document changes, so the
+    top K is a slice (O(K)) however many users there are. The day windows are re-ranked
+    once when the UTC day rolls over.
+    """
+
+    def __init__(self):
+        self._earned: Dict[str, float] = {} # user: all-time sale earnings
+        self._daily: Dict[str, Dict[str, float]] = {} # user: {"YYYY-MM-DD": earned that day}, longest window only
+        self._scores: Dict[str, Dict[str, float]] = {window: {} for window in LEADERBOARD_WINDOWS}
+        self._rankings: Dict[str, List[Tuple[float, str]]] = {window: [] for window in LEADERBOARD_WINDOWS} # (-amount, user), ascending
+        self._day: Optional[datetime.date] = None
+
+    @staticmethod
+    def _cutoff(today: datetime.date, days: int) -> str:
+        return (today - datetime.timedelta(days=days - 1)).isoformat()
+
+    def _score(self, user: str, days: Optional[int]) -> float:
+        if days is None:
+            return self._earned.get(user, 0)
+        cutoff = self._cutoff(self._day, days)
+        return sum(amount for day, amount in self._daily.get(user, {}).items() if day >= cutoff)
+
+    def _rank(self, window: str, user: str, score: float) -> None:
+        scores, ranking = self._scores[window], self._rankings[window]
+        old = scores.pop(user, None)
+        if old is not None:
+            del ranking[bisect.bisect_left(ranking, (-old, user))]
+        if score > 0:
+            scores[user] = score
+            bisect.insort(ranking, (-score, user))
+
+    def _roll(self) -> None:
+        """Re-rank the day windows when the UTC day changed since the last call."""
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        if today == self._day:
+            return
+        self._day = today
+        oldest = self._cutoff(today, LEADERBOARD_DAYS_KEPT)
+        for user, daily in self._daily.items():
+            for day in [day for day in daily if day < oldest]:
+                del daily[day]
+        for window, days in LEADERBOARD_WINDOWS.items():
+            if days:
+                scores = {user: self._score(user, days) for user in self._daily}
+                self._scores[window] = {user: score for user, score in scores.items() if score > 0}
+                self._rankings[window] = sorted((-score, user) for user, score in self._scores[window].items())
+
+    def update(self, user: str, doc: Dict[str, Any]) -> None:
+        """Take a user's counters from their (newer) earnings document."""
+        self._roll()
+        self._earned[user] = doc.get("earned", 0)
+        oldest = self._cutoff(self._day, LEADERBOARD_DAYS_KEPT)
+        daily = {day: amount for day, amount in (doc.get("earned_daily") or {}).items() if day >= oldest}
+        if daily:
+            self._daily[user] = daily
+        else:
+            self._daily.pop(user, None)
+        for window, days in LEADERBOARD_WINDOWS.items():
+            self._rank(window, user, self._score(user, days))
+
+    def counters(self, user: str) -> Dict[str, Any]:
+        """The user's counters in earnings document form (for snapshots)."""
+        return {"earned": self._earned.get(user, 0), "earned_daily": dict(self._daily.get(user, {}))}
+
+    def top(self, window: str, k: int) -> List[Tuple[str, float]]:
+        """[(user, amount)] for the `k` highest earners in `window`, highest first."""
+        self._roll()
+        return [(user, -negative) for negative, user in self._rankings[window][:k]]
+
+    def position(self, window: str, user: str) -> Optional[Tuple[int, float]]:
+        """(1-based rank, amount) of `user` in `window`, or None if they earned nothing in it."""
+        self._roll()
+        score = self._scores[window].get(user)
+        if score is None:
+            return None
+        return bisect.bisect_left(self._rankings[window], (-score, user)) + 1, score
+
+    def size(self, window: str) -> int:
+        """How many users earned something in `window`."""
+        self._roll()
+        return len(self._scores[window])
+
+
+# --- Item search ---
+
+class ItemSearchIndex:
+    """Precomputed item lookup for autocomplete, rebuilt only when the catalog changes.
+
+    Matches rank prefix > word start > substring (over display names and item IDs); within
+    a tier the user's recently used items come first, then items they have in stock.
+    Candidates come from the word-prefix and n-gram maps, so only items that can match are
+    ranked. Ranked matches are cached per query.
+    """
+    RECENT_PER_USER = 10
+    NGRAM = 3 # Substrings up to this length are indexed; longer queries intersect their n-grams
+
+    def __init__(self, cache_size: int = 256):
+        self._items: List[str] = []
+        self._positions: Dict[str, int] = {} # item: catalog position
+        self._names: Dict[str, Tuple[str, str]] = {} # item: (display name, item ID), normalized
+        self._haystacks: Dict[str, str] = {} # item: "display name item id", normalized
+        self._word_prefixes: Dict[str, Set[str]] = {} # prefix of any word: items
+        self._ngrams: Dict[str, Set[str]] = {} # substring of the haystack, 1 to NGRAM characters: items
+        self._cache = LRUCache("autocomplete", cache_size)
+        self._recent: Dict[str, "OrderedDict[str, None]"] = {} # user: recently used items, newest last
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(re.split(r"[^a-z0-9]+", text.lower())).strip()
+
+    def rebuild(self, item_ids: List[str], display_names: Dict[str, str]) -> None:
+        names, haystacks, word_prefixes, ngrams = {}, {}, {}, {}
+        for item_id in item_ids:
+            names[item_id] = (self.normalize(display_names.get(item_id, item_id)), self.normalize(item_id))
+            haystack = haystacks[item_id] = " ".join(names[item_id])
+            for word in set(haystack.split()):
+                for end in range(1, len(word) + 1):
+                    word_prefixes.setdefault(word[:end], set()).add(item_id)
+            for size in range(1, self.NGRAM + 1):
+                for start in range(len(haystack) - size + 1):
+                    ngrams.setdefault(haystack[start:start + size], set()).add(item_id)
+        # Swap everything in at once (startup loading runs off the event loop)
+        self._items, self._names, self._haystacks = list(item_ids), names, haystacks
+        self._positions = {item_id: position for position, item_id in enumerate(item_ids)}
+        self._word_prefixes, self._ngrams = word_prefixes, ngrams
+        self._cache.clear()
+
+    def note_use(self, user: str, item_id: str) -> None:
+        recent = self._recent.setdefault(user, OrderedDict())
+        recent[item_id] = None
+        recent.move_to_end(item_id)
+        while len(recent) > self.RECENT_PER_USER:
+            recent.popitem(last=False)
+
+    @staticmethod
+    def _intersect(index: Dict[str, Set[str]], keys: List[str]) -> Set[str]:
+        """Items under every key of `index`, starting from the smallest set."""
+        sets = sorted((index.get(key, set()) for key in keys), key=len)
+        result = set(sets[0]) if sets else set()
+        for items in sets[1:]:
+            if not result:
+                break
+            result &= items
+        return result
+
+    def _ranked(self, query: str) -> List[Tuple[int, int, str]]:
+        """[(tier, catalog position, item)] for a normalized query, cached."""
+        ranked = self._cache.get(query)
+        if ranked is None:
+            if not query:
+                ranked = [(0, position, item_id) for position, item_id in enumerate(self._items)]
+            else:
+                # A name starting with the query also has every query word as a word prefix, so tiers 0 and 1 share candidates
+                prefixed = self._intersect(self._word_prefixes, query.split())
+                ranked = [(0 if any(name.startswith(query) for name in self._names[item_id]) else 1, self._positions[item_id], item_id)
+                          for item_id in prefixed]
+                if len(query) <= self.NGRAM:
+                    substrings = self._ngrams.get(query, set()) - prefixed # Indexed exactly
+                else:
+                    grams = [query[start:start + self.NGRAM] for start in range(len(query) - self.NGRAM + 1)]
+                    substrings = {item_id for item_id in self._intersect(self._ngrams, grams) - prefixed
+                                  if query in self._haystacks[item_id]}
+                ranked += [(2, self._positions[item_id], item_id) for item_id in substrings]
+                ranked.sort()
+            self._cache.put(query, ranked)
+        return ranked
+
+    def search(self, query: str, user: Optional[str] = None, holdings: Optional[Dict[str, int]] = None, limit: int = 25) -> List[str]:
+        recent = list(self._recent.get(user, ())) if user else []
+        recency = {item_id: len(recent) - i for i, item_id in enumerate(recent)} # Newest gets the biggest boost
+        holdings = holdings or {}
+        ranked = self._ranked(self.normalize(query))
+        if recency or holdings:
+            ranked = sorted(ranked, key=lambda r: (r[0], -recency.get(r[2], 0), holdings.get(r[2], 0) <= 0, r[1]))
+        return [item_id for _, _, item_id in ranked[:limit]]
+
+
+# --- Item resolver (bulk text input) ---
+
+_BULK_QTY_FIRST = re.compile(r"^(\d+)\s*x?\s*[:\s]\s*(.+)$", re.IGNORECASE) # "25 joint_khalifakush", "3x Old Bud"
+_BULK_NAME_FIRST = re.compile(r"^(.+?)\s*[:\s]\s*x?(\d+)$", re.IGNORECASE) # "whacky_bud:10", "Sour Diesel Bud 5"
+
+
+def bounded_edit_distance(a: str, b: str, limit: int) -> int:
+    """Edit distance with adjacent transpositions, or limit + 1 as soon as it must exceed `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(prev[j] + 1, row[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], prev2[j - 2] + 1)
+        if min(row) > limit:
+            return limit + 1
+        prev2, prev = prev, row
+    return min(prev[-1], limit + 1)
+
+
+class ItemResolver:
+    """Maps free-text item names from bulk input to item IDs.
+
+    Tries, in order: an exact alias (item ID, display name, either with words in any
+    order, display-name initials), unique word-prefix matches, a unique substring of an
+    item ID, then the closest alias within a small edit distance. Anything that still
+    matches several items is reported as ambiguous rather than guessed.
+    """
+    TOKEN_SYNONYMS = {"bagof": "bag", "bags": "bag", "buds": "bud", "joints": "joint", "jointof": "joint"}
+    STOPWORDS = {"of", "x"}
+
+    def __init__(self, cache_size: int = 2048):
+        self._items: List[str] = []
+        self._aliases: Dict[str, Set[str]] = {} # alias key: items
+        self._token_sets: Dict[str, List[Set[str]]] = {} # item: token sets of its ID and display name
+        self._fuzzy_keys: Dict[int, List[tuple]] = {} # length: [(compact alias key, its letter counts, item)]
+        self._cache = LRUCache("item_resolver", cache_size)
+
+    @classmethod
+    def tokens(cls, text: str) -> List[str]:
+        words = re.split(r"[^a-z0-9]+", text.lower())
+        return [cls.TOKEN_SYNONYMS.get(w, w) for w in words if w and w not in cls.STOPWORDS]
+
+    @classmethod
+    def key(cls, text: str) -> str:
+        """Order-insensitive alias key: "Whacky Bud", "whacky_bud" and "bud whacky" all match."""
+        return " ".join(sorted(cls.tokens(text)))
+
+    def rebuild(self, item_ids: List[str], display_names: Dict[str, str]) -> None:
+        aliases: Dict[str, Set[str]] = {}
+        token_sets: Dict[str, List[Set[str]]] = {}
+        for item_id in item_ids:
+            display_name = display_names.get(item_id, item_id)
+            forms = [item_id, display_name]
+            name_tokens = self.tokens(display_name)
+            if len(name_tokens) > 1:
+                forms.append("".join(word[0] for word in name_tokens)) # "Sour Diesel Bud" -> "sdb"
+            for form in forms:
+                aliases.setdefault(self.key(form), set()).add(item_id)
+            token_sets[item_id] = [set(self.tokens(item_id)), set(name_tokens)]
+        fuzzy_keys: Dict[int, List[tuple]] = {} # length: [(compact alias key, its letter counts, item)]
+        for alias, items in aliases.items():
+            compact = alias.replace(" ", "")
+            if len(compact) > 3: # Initials are too short to fuzz
+                fuzzy_keys.setdefault(len(compact), []).extend((compact, Counter(compact), item_id) for item_id in items)
+        self._items, self._aliases, self._token_sets, self._fuzzy_keys = list(item_ids), aliases, token_sets, fuzzy_keys
+        self._cache.clear()
+
+    def resolve(self, name: str) -> Tuple[Optional[str], Optional[str]]:
+        """(item ID, None) on a match, else (None, error message)."""
+        query = self.key(name)
+        cached = self._cache.get(query)
+        if cached is None:
+            cached = self._resolve(query)
+            self._cache.put(query, cached)
+        item_id, candidates = cached
+        if item_id:
+            return item_id, None
+        if candidates:
+            return None, f"Ambiguous item `{name}` (could be: {', '.join(sorted(candidates)[:5])})"
+        return None, f"Unknown item: `{name}`"
+
+    def _resolve(self, query: str) -> Tuple[Optional[str], List[str]]:
+        if not query:
+            return None, []
+        exact = self._aliases.get(query, set())
+        if len(exact) == 1:
+            return next(iter(exact)), []
+        if exact:
+            return None, list(exact)
+
+        words = query.split()
+        prefixed = [item_id for item_id, token_sets in self._token_sets.items()
+                    if any(all(any(t.startswith(w) for t in tokens) for w in words) for tokens in token_sets)]
+        if len(prefixed) == 1:
+            return prefixed[0], []
+
+        compact = query.replace(" ", "")
+        substring = [item_id for item_id in self._items if compact in item_id.replace("_", "")]
+        if len(substring) == 1:
+            return substring[0], []
+        if prefixed or substring:
+            return None, prefixed or substring
+
+        limit = 1 if len(compact) <= 5 else 2
+        best, closest = limit + 1, set()
+        letters = Counter(compact)
+        candidates = [key for length in range(len(compact) - limit, len(compact) + limit + 1) for key in self._fuzzy_keys.get(length, ())]
+        for alias, alias_letters, item_id in candidates:
+            # Each edit changes at most one letter on each side, so this is a cheap lower bound
+            if max(sum((letters - alias_letters).values()), sum((alias_letters - letters).values())) > min(limit, best):
+                continue
+            distance = bounded_edit_distance(compact, alias, min(limit, best))
+            if distance < best:
+                best, closest = distance, {item_id}
+            elif distance == best and distance <= limit:
+                closest.add(item_id)
+        if len(closest) == 1:
+            return next(iter(closest)), []
+        return None, list(closest)
+
+    def parse_bulk(self, text: str) -> Tuple[List[Tuple[str, int]], List[str]]:
+        """Parse "item: qty" / "qty item" entries (comma or newline separated) into [(item ID, qty)] and errors."""
+        entries, errors = [], []
+        for item_entry in re.split(r"[,\n]", text):
+            item_entry = item_entry.strip()
+            if not item_entry:
+                continue
+            match = _BULK_QTY_FIRST.match(item_entry)
+            if match:
+                quantity_str, item_name = match.groups()
+            else:
+                match = _BULK_NAME_FIRST.match(item_entry)
+                if not match:
+                    errors.append(f"Invalid format: `{item_entry}`")
+                    continue
+                item_name, quantity_str = match.groups()
+
+            quantity = int(quantity_str)
+            if quantity <= 0:
+                errors.append(f"Quantity must be positive for `{item_name}`: {quantity_str}")
+                continue
+
+            item_id, error = self.resolve(item_name)
+            if error:
+                errors.append(error)
+                continue
+            entries.append((item_id, quantity))
+        return entries, errors
+
+
+# --- Batch stock changes ---
+
+@dataclass
+class StockBatchResult:
+    """Outcome of ShopData.apply_stock_batch: applied lines, or the errors that stopped it."""
+    applied: bool
+    lines: List[Tuple[str, int, int]] = field(default_factory=list) # (item, quantity change, value at current price)
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def item_types(self) -> int:
+        return len(self.lines)
+
+    @property
+    def total_quantity(self) -> int:
+        return sum(abs(qty) for _, qty, _ in self.lines)
+
+    @property
+    def total_value(self) -> int:
+        return sum(value for _, _, value in self.lines)
+
+
+class WriteAheadJournal:
+    """Local write-ahead journal for changes that haven't reached the storage backend yet.
+
+    save_data() journals every changed document (with the base it was edited from) in
+    one fsynced append before writing to storage, so a storage outage or crash never
+    loses an acknowledged change. Records are dropped once their write succeeds; the
+    file only ever holds what is still outstanding (latest record per document).
+    """
+    def __init__(self, path: str, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self.pending: Dict[tuple, Dict[str, Any]] = {} # (collection, doc_id): latest outstanding record
+        self._seq = 0
+        self._dirty = False # File holds records that are no longer pending
+        if enabled:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning("⚠️ Skipping torn record at the end of the write-ahead journal")
+                        self._dirty = True # Rewrite without it, or the next append would land on the same line
+                        break # Only the last line can be torn (crash mid-append)
+                    self.pending[(record["collection"], record["doc_id"])] = record
+                    self._seq = max(self._seq, record.get("seq", 0))
+        except FileNotFoundError:
+            return
+        self.compact()
+        if self.pending:
+            logger.warning(f"📒 Write-ahead journal has {len(self.pending)} change(s) that never reached storage; they will be replayed")
+        self._update_metrics()
+
+    def record(self, changes: List[Dict[str, Any]], instance_id: str) -> Dict[tuple, str]:
+        """Append `changes` (dicts with collection, doc_id, base, base_version, data) in one fsync.
+
+        Returns the op id of each record, which is stored on the written document so a
+        replay can tell whether the write had already landed.
+        """
+        if not self.enabled or not changes:
+            return {}
+        ops = {}
+        lines = []
+        for change in changes:
+            self._seq += 1
+            record = {**change, "seq": self._seq, "op": f"{instance_id}:{self._seq}", "ts": time.time()}
+            key = (record["collection"], record["doc_id"])
+            if key in self.pending:
+                self._dirty = True # Superseded record stays in the file until compaction
+            self.pending[key] = record
+            ops[key] = record["op"]
+            lines.append(json.dumps(record, separators=(",", ":"), default=str))
+
+        started = time.perf_counter()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno()) # Group commit: one fsync for everything this save changed
+        metrics.observe("journal.fsync", time.perf_counter() - started)
+        metrics.incr("journal.records", len(lines))
+        metrics.incr("journal.fsyncs")
+        metrics.set_gauge("journal.last_batch_size", len(lines))
+        self._update_metrics()
+        return ops
+
+    def resolve(self, collection: str, doc_id: str) -> None:
+        """The change to this document reached storage."""
+        if self.pending.pop((collection, doc_id), None) is not None:
+            self._dirty = True
+
+    def reset(self) -> None:
+        """Forget all outstanding records (the caller is about to journal their merged state)."""
+        self.pending.clear()
+        self._dirty = True
+
+    def compact(self) -> None:
+        """Rewrite the file to hold only outstanding records (or remove it when there are none)."""
+        if not self.enabled or not self._dirty:
+            return
+        if not self.pending:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        else:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for record in sorted(self.pending.values(), key=lambda r: r["seq"]):
+                    f.write(json.dumps(record, separators=(",", ":"), default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        self._dirty = False
+        self._update_metrics()
+
+    def replay_lag(self) -> float:
+        """Seconds since the oldest outstanding change was journaled."""
+        if not self.pending:
+            return 0.0
+        return max(0.0, time.time() - min(record["ts"] for record in self.pending.values()))
+
+    def _update_metrics(self) -> None:
+        metrics.set_gauge("journal.pending_records", len(self.pending))
+        metrics.set_gauge("journal.replay_lag_seconds", round(self.replay_lag(), 1))
+        try:
+            metrics.set_gauge("journal.bytes", os.path.getsize(self.path))
+        except OSError:
+            metrics.set_gauge("journal.bytes", 0)
+
+
 class ShopData:
     def __init__(self):
         self.items: Dict[str, List[Dict[str, Any]]] = {}
-        self.user_earnings: Dict[str, int] = {}
+        self.user_earnings: Dict[str, float] = {} # Read-through cache: stored balance plus credits not yet written
         self.sale_history: List[Dict[str, Any]] = []
         self.stock_message_ids: List[int] = []
-        self.user_templates: Dict[str, Dict[str, Dict[str, int]]] = {} # user_id_str: {template_name: {item: qty}}
-        self.user_preferences: Dict[str, Dict[str, Any]] = {} # user_id_str: {pref_name: value}
+        self.stock_board_slots: Dict[str, int] = {} # Partitioned board: slot key: message id, in display order
+        # Per-user profiles: {"version", "data": {"templates": {name: {item: qty}}, "preferences": {pref: value}}, "base": last stored data}
+        self.profile_cache = LRUCache("profiles", PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+        self._seen_names = LRUCache("seen_names", PROFILE_CACHE_SIZE) # user ID: display name, saved with their next write
+        self._dirty_profiles: Dict[str, Dict[str, Any]] = {} # Changed profiles, pinned in memory until written
         self.low_stock_thresholds: Dict[str, int] = {} # category: threshold
         self.category_emojis: Dict[str, str] = {} # category: emoji
 
@@ -1967,34 +3590,74 @@ class ShopData:
         self._default_thresholds = {'bud': 30, 'joint': 100, 'bag': 100, 'tebex': 10, 'fish': 10, 'misc': 10}
         self._default_emojis = {'bud': '🥦', 'joint': '🚬', 'bag': '🛍️', 'tebex': '💎', 'fish': '🐟', 'misc': '🧩'}
 
+        # Multi-instance bookkeeping: the version and content of every document as last
+        # seen in MongoDB, so saves only write what changed and can rebase on remote edits.
+        self.instance_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._item_versions: Dict[str, int] = {}
+        self._persisted_items: Dict[str, List[Dict[str, Any]]] = {}
+        self._settings_versions: Dict[str, int] = {}
+        self._persisted_settings: Dict[str, Any] = {}
+        self._pending_history: List[Dict[str, Any]] = [] # History entries not yet pushed to MongoDB
+        self._pending_events: List[Dict[str, Any]] = [] # Inventory events not yet in the event log
+        self._earnings_versions: Dict[str, int] = {}
+        self._persisted_earnings: Dict[str, float] = {} # Balance of each earnings document as last seen
+        self._pending_earnings: List[Dict[str, Any]] = [] # Sale credits not yet written: {"op", "user", "amount"}
+        self._change_stream_thread: Optional[Thread] = None
+        self._change_stream_resume_token = None
+        self._on_remote_change = None
+        self._journal_replay_task: Optional[asyncio.Task] = None
+
         logger.info(f"🌍 Running in {APP_ENV.upper()} environment")
-        logger.info(f"🗄️ Using database: {DB_NAME}")
-        logger.info(f"MongoDB URI check: ...@{MONGO_URI.split('@')[-1].split('/')[0]}")
+        logger.info(f"🗄️ Using database: {DB_NAME} ({STORAGE_BACKEND} storage)")
 
-        try:
-            logger.info("🔌 Connecting to MongoDB...")
-            self.mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=10000)
-            self.mongo_client.admin.command('ping') # More reliable connection test
-            self.db = self.mongo_client[DB_NAME]
-            self.using_mongodb = True
-            logger.info(f"✅ Connected to MongoDB successfully (Database: {DB_NAME})")
-        except pymongo.errors.ConnectionFailure as e:
-            logger.critical(f"❌ MongoDB connection failed: {e}")
-            logger.critical("💾 Bot requires MongoDB connection to operate.")
-            raise RuntimeError(f"MongoDB connection failed: {e}")
-        except Exception as e:
-            logger.critical(f"❌ MongoDB setup error: {e}\n{traceback.format_exc()}")
-            logger.critical("💾 Cannot continue without MongoDB connection.")
-            raise RuntimeError(f"MongoDB setup error: {e}")
+        # Creating the backend doesn't block; initialize() does the I/O
+        self.storage = create_storage_backend()
+        # Remote storage can be unreachable, so its writes go through a local journal first
+        self.journal = WriteAheadJournal(JOURNAL_PATH, enabled=self.storage.is_remote)
+        self._ready = asyncio.Event() # Set once initialize() has loaded everything
+        self.aggregate = InventoryAggregate(self) # Derived stock figures for every read path
+        self.stock_alerts = StockAlertEngine(self)
+        self.leaderboard = EarningsLeaderboard()
 
         # Load display names, prices, categories (these seem relatively static)
         self._load_static_data()
+        self.load_config() # Local JSON, cheap
+        self.search_index = ItemSearchIndex()
+        self.item_resolver = ItemResolver()
+        self._set_catalog()
 
-        # Load dynamic data from DB and config
-        self.load_data() # Load from MongoDB first
-        self.load_config() # Load from JSON, potentially overwriting thresholds/emojis
+    def initialize(self) -> None:
+        """Connect to the storage backend and load all shop data.
 
-        self.item_list = list(self.predefined_prices.keys())
+        Blocking I/O: run it off the event loop (see load_shop_data) so the
+        Discord gateway can connect in parallel.
+        """
+        try:
+            logger.info(f"🔌 Connecting to {self.storage.name} storage...")
+            self.storage.connect()
+            logger.info(f"✅ Connected to {self.storage.name} storage successfully (Database: {DB_NAME})")
+        except STORAGE_ERRORS as e:
+            logger.critical(f"❌ {self.storage.name} storage connection failed: {e}")
+            logger.critical("💾 Bot requires its storage to operate.")
+            raise RuntimeError(f"Storage connection failed: {e}")
+        except Exception as e:
+            logger.critical(f"❌ {self.storage.name} storage setup error: {e}\n{traceback.format_exc()}")
+            logger.critical("💾 Cannot continue without storage.")
+            raise RuntimeError(f"Storage setup error: {e}")
+
+        self.load_data()
+        self._set_catalog() # MongoDB may know extra priced items
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def mark_ready(self) -> None:
+        """Open the gate for commands and webhook sales (call on the event loop thread)."""
+        self._ready.set()
+
+    async def wait_until_ready(self) -> None:
+        await self._ready.wait()
 
     # Move this outside of __init__, make it a proper instance method
     def _load_static_data(self):
@@ -2031,89 +3694,716 @@ class ShopData:
         }
 
     def save_data(self) -> None:
+        """Write changed documents to storage using versioned (compare-and-set) updates.
+
+        Only items/settings that differ from what we last read or wrote are sent. If another
+        bot instance updated a document in the meantime, our edits are rebased onto its
+        version and retried instead of overwriting it. With remote storage every change is
+        journaled locally first, so an outage defers the write instead of losing it.
+        """
         try:
-            # --- Save to MongoDB ---
-            # Save items (consider batching updates if performance becomes an issue)
-            for item_name, entries in self.items.items():
-                # Filter out entries with quantity 0 before saving? Optional.
-                valid_entries = [e for e in entries if e.get('quantity', 0) > 0]
-                if valid_entries:
-                    self.db.items.update_one(
-                        {"_id": item_name},
-                        {"$set": {"entries": valid_entries}},
-                        upsert=True
-                    )
+            conflicts = []
+            dirty_items = {}
+            for item_name in set(self.items) | set(self._persisted_items):
+                entries = compact_lots(self.items.get(item_name, [])) # Also drops empty lots
+                if item_name in self.items and len(entries) < len(self.items[item_name]):
+                    metrics.incr("lots.compacted_on_save", len(self.items[item_name]) - len(entries))
+                    self.items[item_name] = entries
+                if entries != self._persisted_items.get(item_name, []):
+                    dirty_items[item_name] = copy.deepcopy(entries)
+            dirty_settings = [key for key in VERSIONED_SETTINGS if getattr(self, key) != self._persisted_settings.get(key)]
+            dirty_profiles = dict(self._dirty_profiles)
+            ops = self._journal_changes(dirty_items, dirty_settings, dirty_profiles)
+
+            # --- Event log first: it is what the state can be rebuilt from ---
+            if self._pending_events:
+                self.storage.append_events(self._pending_events)
+                self._pending_events = []
+                self.journal.resolve("events", "pending")
+
+            # --- Earnings: one idempotent $inc per credit ---
+            if self._pending_earnings:
+                self._flush_earnings()
+                self.journal.resolve("earnings", "pending")
+
+            # --- Items: one document per item, guarded by its version ---
+            for item_name, entries in dirty_items.items():
+                if self._save_item(item_name, entries, ops.get(("items", item_name))):
+                    self.journal.resolve("items", item_name)
                 else:
-                    # If no valid entries left, remove the item document
-                    self.db.items.delete_one({"_id": item_name})
-
-            # Save main settings/collections to the 'settings' collection in MongoDB
-            settings_to_save = {
-                "user_earnings": self.user_earnings,
-                "user_templates": self.user_templates,
-                "user_preferences": self.user_preferences,
-                "predefined_prices": self.predefined_prices  # Save prices to MongoDB
-            }
-            for key, data in settings_to_save.items():
-                self.db.settings.update_one({"_id": key}, {"$set": {"data": data}}, upsert=True)
-
-            # Save limited sale history (limit size to prevent unbounded growth)
-            recent_history = self.sale_history[-1000:] # Keep last 1000 entries
-            self.db.settings.update_one(
-                {"_id": "sale_history"},
-                {"$set": {"data": recent_history}},
-                upsert=True
-            )
-            self.sale_history = recent_history # Update in-memory list to match saved state
+                    conflicts.append(f"items/{item_name}")
 
-            logger.info("💾 Data saved to MongoDB")
+            # --- Settings documents (templates, preferences, prices) ---
+            for key in dirty_settings:
+                if self._save_setting(key, ops.get(("settings", key))):
+                    self.journal.resolve("settings", key)
+                else:
+                    conflicts.append(f"settings/{key}")
+
+            # --- User profiles: only the fields that changed, one document per user ---
+            for user, profile in dirty_profiles.items():
+                if self._save_profile(user, profile, ops.get(("user_profiles", user))):
+                    if self._dirty_profiles.get(user) is profile:
+                        del self._dirty_profiles[user]
+                    self.profile_cache.put(user, profile)
+                    self.journal.resolve("user_profiles", user)
+                else:
+                    conflicts.append(f"user_profiles/{user}")
+
+            # --- Sale history: append-only, so concurrent writers never clobber each other ---
+            if self._pending_history:
+                new_version = self.storage.append_history(self._pending_history, SALE_HISTORY_LIMIT)
+                # Only adopt the new version if nobody else pushed in between (their entries arrive via the change stream)
+                if new_version == self._settings_versions.get("sale_history", 0) + 1:
+                    self._settings_versions["sale_history"] = new_version
+                self._pending_history = []
+                self.journal.resolve("sale_history", "pending")
+            self.sale_history = self.sale_history[-SALE_HISTORY_LIMIT:] # Keep in-memory list aligned with saved state
+            self.journal.compact()
+
+            if conflicts:
+                raise ConcurrentUpdateError(f"Gave up after {MAX_WRITE_ATTEMPTS} attempts on: {', '.join(conflicts)}")
+
+            logger.info(f"💾 Data saved to {self.storage.name} storage")
+            self.write_snapshot()
+        except STORAGE_ERRORS as e:
+            self.journal.compact() # Drop records for the documents that did get written
+            self.write_snapshot() # Keep whatever did get written
+            if not self.journal.enabled:
+                logger.error(f"❌ {self.storage.name} save error: {e}\n{traceback.format_exc()}")
+                raise
+            # The changes are durable in the journal: acknowledge them and retry in the background
+            metrics.incr("journal.deferred_saves")
+            logger.warning(f"⚠️ {self.storage.name} storage unavailable ({e}); {len(self.journal.pending)} change(s) kept in the local journal for replay")
+            self.schedule_journal_replay()
         except Exception as e:
-            logger.error(f"❌ MongoDB save error: {e}\n{traceback.format_exc()}")
-            # In critical failure, maybe attempt a local JSON dump as emergency fallback?
-            # self._emergency_local_save()
+            logger.error(f"❌ {self.storage.name} save error: {e}\n{traceback.format_exc()}")
+            self.write_snapshot() # Keep whatever did get written
             raise # Re-raise to indicate failure
 
+    def _journal_changes(self, dirty_items: Dict[str, List[Dict[str, Any]]], dirty_settings: List[str],
+                         dirty_profiles: Dict[str, Dict[str, Any]]) -> Dict[tuple, str]:
+        """Journal everything this save is about to write (one fsync). Returns op ids per document."""
+        if not self.journal.enabled:
+            return {}
+        changes = [
+            {"collection": "items", "doc_id": name, "data": entries,
+             "base": self._persisted_items.get(name, []), "base_version": self._item_versions.get(name, 0)}
+            for name, entries in dirty_items.items()
+        ]
+        changes += [
+            {"collection": "settings", "doc_id": key, "data": getattr(self, key),
+             "base": self._persisted_settings.get(key), "base_version": self._settings_versions.get(key, 0)}
+            for key in dirty_settings
+        ]
+        changes += [
+            {"collection": "user_profiles", "doc_id": user, "data": profile["data"],
+             "base": profile["base"], "base_version": profile["version"]}
+            for user, profile in dirty_profiles.items()
+        ]
+        # Cumulative: the latest record holds every entry not yet pushed
+        if self._pending_events:
+            changes.append({"collection": "events", "doc_id": "pending", "data": self._pending_events})
+        if self._pending_earnings:
+            changes.append({"collection": "earnings", "doc_id": "pending", "data": self._pending_earnings})
+        if self._pending_history:
+            changes.append({"collection": "sale_history", "doc_id": "pending", "data": self._pending_history})
+        try:
+            return self.journal.record(changes, self.instance_id)
+        except OSError as e:
+            metrics.incr("journal.write_errors")
+            logger.error(f"❌ Could not write the local journal, saving without it: {e}")
+            return {}
+
+    def _versioned_write(self, collection: str, doc_id: str, fields: Dict[str, Any], version: int, op: Optional[str] = None) -> bool:
+        """Compare-and-set a document: only succeeds if it is still at `version` (0 = never written)."""
+        fields = {**fields, "updated_by": self.instance_id}
+        if op:
+            fields["last_op"] = op # Lets a journal replay see that this write already landed
+        return self.storage.apply_change(collection, doc_id, fields, version)
+
+    def _save_item(self, item_name: str, entries: List[Dict[str, Any]], op: Optional[str] = None) -> bool:
+        # Emptied items keep their document (with no entries) so the version never resets
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            version = self._item_versions.get(item_name, 0)
+            if self._versioned_write("items", item_name, {"entries": entries}, version, op):
+                self._item_versions[item_name] = version + 1
+                self._persisted_items[item_name] = copy.deepcopy(entries)
+                return True
+
+            remote_doc = self.storage.get("items", item_name) or {}
+            remote_entries = remote_doc.get("entries") or []
+            logger.warning(f"⚠️ Item '{item_name}' changed in another instance (v{version} → v{remote_doc.get('version', 0)}), rebasing (attempt {attempt + 1})")
+            entries = merge_lots(self._persisted_items.get(item_name, []), entries, remote_entries)
+            self.items[item_name] = entries
+            self._stock_changed(item_name)
+            self._item_versions[item_name] = remote_doc.get("version", 0)
+            self._persisted_items[item_name] = copy.deepcopy(remote_entries)
+        return False
+
+    def _save_setting(self, key: str, op: Optional[str] = None) -> bool:
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            version = self._settings_versions.get(key, 0)
+            data = getattr(self, key)
+            if self._versioned_write("settings", key, {"data": data}, version, op):
+                self._settings_versions[key] = version + 1
+                self._persisted_settings[key] = copy.deepcopy(data)
+                return True
+
+            remote_doc = self.storage.get("settings", key) or {}
+            remote_data = remote_doc.get("data") or {}
+            logger.warning(f"⚠️ Setting '{key}' changed in another instance, rebasing (attempt {attempt + 1})")
+            setattr(self, key, merge_mapping(self._persisted_settings.get(key), data, remote_data))
+            self._settings_versions[key] = remote_doc.get("version", 0)
+            self._persisted_settings[key] = copy.deepcopy(remote_data)
+        return False
+
+    def _save_profile(self, user: str, profile: Dict[str, Any], op: Optional[str] = None) -> bool:
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            changed = {key: copy.deepcopy(profile["data"][key]) for key in PROFILE_FIELDS if profile["data"][key] != profile["base"][key]}
+            if not changed:
+                return True
+            if self._versioned_write("user_profiles", user, changed, profile["version"], op):
+                profile["version"] += 1
+                profile["base"].update(copy.deepcopy(changed))
+                return True
+
+            remote = self._profile_from_doc(self.storage.get("user_profiles", user) or {})
+            logger.warning(f"⚠️ Profile of '{user}' changed in another instance, rebasing (attempt {attempt + 1})")
+            for key in PROFILE_FIELDS:
+                profile["data"][key] = merge_mapping(profile["base"][key], profile["data"][key], remote["data"][key])
+            profile["base"], profile["version"] = remote["base"], remote["version"]
+        return False
+
+    # --- User profiles (templates and preferences, one document per user) ---
+
+    @staticmethod
+    def _profile_from_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+        data = {key: doc.get(key) if isinstance(doc.get(key), dict) else {} for key in PROFILE_FIELDS}
+        return {"version": doc.get("version", 0), "data": data, "base": copy.deepcopy(data)}
+
+    def _profile(self, user: str) -> Dict[str, Any]:
+        """A user's profile: unsaved edits first, then the cache, then storage (may block)."""
+        profile = self._dirty_profiles.get(user) or self.profile_cache.get(user)
+        if profile is None:
+            profile = self._profile_from_doc(self.storage.get("user_profiles", user) or {})
+            self.profile_cache.put(user, profile)
+        return profile
+
+    def _update_profile(self, user: str, key: str) -> Dict[str, Any]:
+        """The profile's `key` mapping, to change in place; marks the profile for the next save."""
+        profile = self._profile(user)
+        self._dirty_profiles[user] = profile
+        if key != "identity":
+            self._save_seen_name(user) # Goes out in the same write
+        return profile["data"][key]
+
+    def _save_seen_name(self, user: str) -> None:
+        """Store the display name user_key saw for `user`, now that they change something anyway."""
+        name = self._seen_names.peek(user)
+        if name is not None:
+            self._seen_names.discard(user)
+            self.remember_name(user, name)
+
+    def _apply_remote_profile(self, user: str, doc: Dict[str, Any]) -> bool:
+        """Drop a cached profile another instance changed; it reloads on next use. Unsaved ones rebase on save."""
+        cached = self.profile_cache.peek(user)
+        if user in self._dirty_profiles or cached is None or doc.get("version", 0) <= cached["version"]:
+            return False
+        return self.profile_cache.discard(user)
+
+    def _migrate_legacy_names(self) -> None:
+        """Move display names out of the old whole-map settings/user_names document (once)."""
+        legacy = self.storage.get("settings", "user_names")
+        if not legacy or not isinstance(legacy.get("data"), dict) or legacy.get("migrated_to"):
+            return
+        for user, name in legacy["data"].items():
+            doc = self.storage.get("user_profiles", user) or {}
+            identity = doc.get("identity") if isinstance(doc.get("identity"), dict) else {}
+            if isinstance(name, str) and not identity.get("display_name"):
+                # Names are only a fallback label: losing a race with another instance is fine
+                self.storage.apply_change("user_profiles", user, {"identity": {**identity, "display_name": name}}, doc.get("version", 0))
+        self.storage.set_fields("settings", "user_names", {"migrated_to": "user_profiles"})
+        logger.info(f"👤 Moved {len(legacy['data'])} display name(s) to per-user profile documents")
+
+    def _migrate_legacy_profiles(self) -> None:
+        """Move templates and preferences out of the old whole-map settings documents (once)."""
+        legacy_docs = {key: self.storage.get("settings", key) for key in LEGACY_PROFILE_SETTINGS}
+        legacy_docs = {key: doc for key, doc in legacy_docs.items()
+                       if doc and isinstance(doc.get("data"), dict) and not doc.get("migrated_to")}
+        if not legacy_docs:
+            return
+        profiles: Dict[str, Dict[str, Any]] = {}
+        for key, doc in legacy_docs.items():
+            for user, value in doc["data"].items():
+                if value:
+                    profiles.setdefault(user, {})[LEGACY_PROFILE_SETTINGS[key]] = value
+        # Version 0 only creates: users who already have a profile document (an interrupted earlier run) are skipped
+        created = sum(self.storage.apply_change("user_profiles", user, fields, 0) for user, fields in profiles.items())
+        for key in legacy_docs:
+            self.storage.set_fields("settings", key, {"migrated_to": "user_profiles"})
+        logger.info(f"👤 Moved templates/preferences of {created} user(s) to per-user profile documents")
+
+    # --- Earnings (one document per user) ---
+
+    def _refresh_earnings(self, user: str) -> None:
+        """Recompute a user's cached balance: the stored one plus credits still queued."""
+        pending = sum(credit["amount"] for credit in self._pending_earnings if credit["user"] == user)
+        self.user_earnings[user] = self._persisted_earnings.get(user, 0) + pending
+
+    def _adopt_earnings_doc(self, user: str, doc: Dict[str, Any]) -> bool:
+        """Take a stored earnings document into the cache unless we already know a newer one."""
+        version = doc.get("version", 0)
+        if version <= self._earnings_versions.get(user, -1):
+            return False
+        self._earnings_versions[user] = version
+        self._persisted_earnings[user] = doc.get("balance", 0)
+        self._refresh_earnings(user)
+        self.leaderboard.update(user, doc)
+        return True
+
+    def _flush_earnings(self) -> None:
+        """Write queued sale credits. Each has its own op id, so a retry never credits twice."""
+        while self._pending_earnings:
+            credit = self._pending_earnings[0]
+            counters = None
+            if credit.get("day"): # Sale credits also count towards the leaderboard
+                counters = {"earned": credit["amount"], f"earned_daily.{credit['day']}": credit["amount"]}
+            doc = self.storage.increment_balance("earnings", credit["user"], credit["amount"], credit["op"], counters=counters)
+            self._pending_earnings.pop(0)
+            if doc:
+                self._adopt_earnings_doc(credit["user"], doc)
+            self._refresh_earnings(credit["user"])
+            metrics.incr("earnings.credits_written")
+
+    def _load_earnings(self) -> None:
+        """Load every earnings document, first moving balances out of the old settings document."""
+        legacy = self.storage.get("settings", "user_earnings")
+        if legacy and isinstance(legacy.get("data"), dict) and not legacy.get("migrated_to"):
+            # The op id is per user, so a migration interrupted half-way can simply run again
+            for user, balance in legacy["data"].items():
+                if balance:
+                    self.storage.increment_balance("earnings", user, balance, "migrate:user_earnings")
+            self.storage.set_fields("settings", "user_earnings", {"migrated_to": "earnings"})
+            logger.info(f"💰 Moved {len(legacy['data'])} balance(s) from settings/user_earnings to per-user earnings documents")
+
+        self.user_earnings, self._earnings_versions, self._persisted_earnings = {}, {}, {}
+        self.leaderboard = EarningsLeaderboard()
+        for doc in self.storage.load("earnings", fields=EARNINGS_FIELDS):
+            self._adopt_earnings_doc(doc["_id"], doc)
+        for credit in self._pending_earnings:
+            self._refresh_earnings(credit["user"])
+
+    def get_earnings(self, user: str) -> float:
+        """A user's balance, from the cache or (first time for this user) from storage. May block."""
+        if user in self.user_earnings:
+            metrics.incr("cache.earnings.hits")
+            return self.user_earnings[user]
+        metrics.incr("cache.earnings.misses")
+        doc = self.storage.get("earnings", user)
+        if doc is None or not self._adopt_earnings_doc(user, doc):
+            self.user_earnings[user] = 0 # Remember "no earnings" too, so the next lookup is a hit
+        return self.user_earnings[user]
+
+    # --- Write-ahead journal replay ---
+
+    def replay_journal(self) -> int:
+        """Re-apply journaled changes that never reached storage (startup, after load_data).
+
+        Blocking. Each record is applied as a delta from the base it was edited on top of
+        the current stored state, skipping writes that landed before the crash.
+        """
+        if not self.journal.pending:
+            return 0
+        replayed = 0
+        for (collection, doc_id), record in sorted(self.journal.pending.items(), key=lambda kv: kv[1]["seq"]):
+            if collection == "events":
+                self._pending_events.extend(record["data"]) # Appending is idempotent per event id
+                replayed += 1
+                continue
+            if collection == "earnings":
+                self._pending_earnings.extend(record["data"]) # Idempotent per op id
+                for credit in record["data"]:
+                    self._refresh_earnings(credit["user"])
+                replayed += 1
+                continue
+            if collection == "sale_history":
+                recent = {json.dumps(entry, sort_keys=True, default=str) for entry in self.sale_history}
+                missing = [entry for entry in record["data"] if json.dumps(entry, sort_keys=True, default=str) not in recent]
+                self._pending_history.extend(missing)
+                self.sale_history.extend(missing)
+                replayed += bool(missing)
+                continue
+
+            stored = self.storage.get(collection, doc_id) or {}
+            if stored.get("last_op") == record["op"]:
+                continue # Written just before the crash, only the journal cleanup was lost
+            if collection == "items":
+                self.items[doc_id] = merge_lots(record["base"] or [], record["data"], self.items.get(doc_id, []))
+            elif collection == "user_profiles":
+                profile = self._profile(doc_id)
+                for key in PROFILE_FIELDS: # Records journaled before a field existed don't have it
+                    profile["data"][key] = merge_mapping(record["base"].get(key), record["data"].get(key), profile["data"][key])
+                self._dirty_profiles[doc_id] = profile
+            elif doc_id in LEGACY_PROFILE_SETTINGS:
+                # Journaled before profiles moved to their own documents: replay each user's change
+                base = record["base"] if isinstance(record["base"], dict) else {}
+                for user in set(base) | set(record["data"]):
+                    if base.get(user) != record["data"].get(user):
+                        current = self._update_profile(user, LEGACY_PROFILE_SETTINGS[doc_id])
+                        merged = merge_mapping(base.get(user), record["data"].get(user), current)
+                        current.clear()
+                        current.update(merged)
+            elif doc_id == "user_earnings":
+                # Journaled before earnings moved to their own documents: replay the deltas as credits
+                base = record["base"] if isinstance(record["base"], dict) else {}
+                for user, balance in record["data"].items():
+                    delta = balance - base.get(user, 0)
+                    if delta:
+                        self._pending_earnings.append({"op": f"{record['op']}:{user}", "user": user, "amount": delta})
+                        self._refresh_earnings(user)
+            elif doc_id in VERSIONED_SETTINGS:
+                setattr(self, doc_id, merge_mapping(record["base"], record["data"], getattr(self, doc_id)))
+            replayed += 1
+        self._stock_changed()
+
+        logger.info(f"📒 Replaying {replayed} journaled change(s) into {self.storage.name} storage (oldest {self.journal.replay_lag():.0f}s old)")
+        self.journal.reset() # save_data() journals the merged state afresh
+        self.save_data()
+        metrics.incr("journal.replayed", replayed)
+        return replayed
+
+    def schedule_journal_replay(self) -> None:
+        """Keep retrying journaled writes in the background until storage is back."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return # Not on the event loop (startup/shutdown); the next save or restart replays
+        if self._journal_replay_task and not self._journal_replay_task.done():
+            return
+        self._journal_replay_task = loop.create_task(self._retry_journal())
+
+    async def _retry_journal(self) -> None:
+        retry_delay = 1
+        while self.journal.pending:
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
+            try:
+                await asyncio.to_thread(self.storage.connect)
+            except STORAGE_ERRORS:
+                metrics.set_gauge("journal.replay_lag_seconds", round(self.journal.replay_lag(), 1))
+                continue
+            logger.info(f"🔌 {self.storage.name} storage reachable again, flushing {len(self.journal.pending)} journaled change(s)")
+            try:
+                self.save_data() # Memory still holds the changes; this writes them and clears the journal
+            except Exception:
+                pass # Logged by save_data
+        metrics.set_gauge("journal.replay_lag_seconds", 0)
+
     def load_data(self) -> None:
         try:
-            # --- Load from MongoDB ---
+            # --- Load from storage ---
             # Load items
             self.items = {} # Clear existing memory first
-            for item_doc in self.db.items.find():
+            self._item_versions = {}
+            self._persisted_items = {}
+            for item_doc in self.storage.load("items"):
                 item_id = item_doc.get("_id")
                 entries = item_doc.get("entries")
                 # Basic validation
                 if isinstance(item_id, str) and isinstance(entries, list):
                     # Further validation of entries if needed
                     self.items[item_id] = entries
+                    self._item_versions[item_id] = item_doc.get("version", 0)
+                    self._persisted_items[item_id] = copy.deepcopy(entries)
 
             # Load settings from the 'settings' collection
-            settings_keys = ["user_earnings", "user_templates", "user_preferences", "sale_history", "predefined_prices"]
-            for key in settings_keys:
-                doc = self.db.settings.find_one({"_id": key})
+            for key in VERSIONED_SETTINGS + ["sale_history"]:
+                doc = self.storage.get("settings", key)
                 if doc and "data" in doc:
-                    # Load into the correct attribute
-                    if key == "user_earnings": self.user_earnings = doc["data"]
-                    elif key == "user_templates": self.user_templates = doc["data"]
-                    elif key == "user_preferences": self.user_preferences = doc["data"]
-                    elif key == "sale_history": self.sale_history = doc["data"]
-                    # Special handling for predefined_prices to maintain static defaults
-                    elif key == "predefined_prices":
-                        # Get MongoDB prices
-                        mongodb_prices = doc["data"]
-                        # Update prices from MongoDB, but keep missing prices from static data
-                        # This ensures new items added to _load_static_data are preserved
-                        for item, price in mongodb_prices.items():
-                            self.predefined_prices[item] = price
-                        # Now self.predefined_prices has both static defaults and MongoDB saved prices
-
-            logger.info("📂 Data loaded from MongoDB")
+                    self._apply_setting_doc(key, doc)
+            self._load_earnings()
+            self._migrate_legacy_profiles()
+            self._migrate_legacy_names()
+            self.profile_cache.clear() # Reloaded lazily; unsaved edits stay pinned in _dirty_profiles
+
+            self._stock_changed()
+            logger.info(f"📂 Data loaded from {self.storage.name} storage")
 
         except Exception as e:
-            logger.error(f"❌ MongoDB load error: {e}\n{traceback.format_exc()}")
+            logger.error(f"❌ {self.storage.name} load error: {e}\n{traceback.format_exc()}")
             # Consider loading from a local emergency backup if DB load fails?
             # self._try_load_emergency_local()
             raise # Re-raise error if critical data cannot be loaded
 
+    def _apply_setting_doc(self, key: str, doc: Dict[str, Any]) -> None:
+        """Load a settings document into memory, keeping any unsaved local edits on top."""
+        data = doc["data"]
+        self._settings_versions[key] = doc.get("version", 0)
+
+        if key == "sale_history":
+            # Remote list already contains everything we pushed; re-append what we haven't yet
+            self.sale_history = list(data) + self._pending_history
+            return
+
+        base = self._persisted_settings.get(key)
+        local = getattr(self, key)
+        self._persisted_settings[key] = copy.deepcopy(data)
+
+        if key == "predefined_prices":
+            # Update prices from MongoDB, but keep missing prices from static data
+            # This ensures new items added to _load_static_data are preserved
+            if base is not None and local != base:
+                data = merge_mapping(base, local, data)
+            for item, price in data.items():
+                self.predefined_prices[item] = price
+            self._stock_changed()
+        elif base is not None and local != base:
+            setattr(self, key, merge_mapping(base, local, data))
+        else:
+            setattr(self, key, copy.deepcopy(data))
+
+    # --- Multi-instance sync (MongoDB change stream) ---
+
+    def start_change_stream(self, loop: asyncio.AbstractEventLoop, on_change=None) -> None:
+        """Follow MongoDB's change stream so writes from other bot instances reach memory.
+
+        Requires a replica set (a single-node one is enough). Changes are applied on the
+        event loop thread; `on_change(collection, doc_id)` is called after each one.
+        """
+        if self._change_stream_thread and self._change_stream_thread.is_alive():
+            return
+        if not self.storage.supports_change_stream:
+            logger.info(f"The {self.storage.name} backend is single-instance; not watching for remote changes.")
+            return
+        self._on_remote_change = on_change
+        self._change_stream_thread = Thread(target=self._watch_changes, args=(loop,), daemon=True, name="mongo-change-stream")
+        self._change_stream_thread.start()
+
+    def _watch_changes(self, loop: asyncio.AbstractEventLoop) -> None:
+        pipeline = [{"$match": {"ns.coll": {"$in": ["items", "settings", "earnings", "user_profiles"]}}}]
+        retry_delay = 1
+        while not loop.is_closed():
+            try:
+                with self.storage.watch(pipeline, resume_after=self._change_stream_resume_token) as stream:
+                    logger.info("👀 Watching MongoDB change stream for updates from other instances")
+                    retry_delay = 1
+                    for change in stream:
+                        self._change_stream_resume_token = stream.resume_token
+                        loop.call_soon_threadsafe(self._apply_remote_change, change)
+            except pymongo.errors.OperationFailure as e:
+                if e.code == 40573: # "The $changeStream stage is only supported on replica sets"
+                    logger.warning("⚠️ MongoDB is not a replica set - change streams disabled. Only run one bot instance against this database.")
+                    return
+                if e.code == 286: # ChangeStreamHistoryLost: resume token fell off the oplog
+                    logger.error("❌ Change stream history lost, reloading all data from MongoDB")
+                    self._change_stream_resume_token = None
+                    loop.call_soon_threadsafe(self.load_data)
+                else:
+                    logger.error(f"❌ Change stream error: {e}")
+            except RuntimeError:
+                return # Event loop closed while handing over a change
+            except Exception as e:
+                logger.error(f"❌ Change stream error: {e}\n{traceback.format_exc()}")
+            logger.info(f"Reconnecting change stream in {retry_delay}s...")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
+
+    def _apply_remote_change(self, change: Dict[str, Any]) -> None:
+        """Apply one change stream event (runs on the event loop thread)."""
+        try:
+            collection = change.get("ns", {}).get("coll")
+            doc_id = change.get("documentKey", {}).get("_id")
+            doc = change.get("fullDocument")
+            if change.get("operationType") == "delete":
+                doc = {"_id": doc_id, "entries": [], "version": self._item_versions.get(doc_id, 0) + 1}
+            elif doc is None:
+                return # Document was deleted before the update lookup ran; the delete event follows
+
+            if collection == "items":
+                applied = self._apply_remote_item(doc_id, doc)
+            elif collection == "settings" and doc_id in VERSIONED_SETTINGS + ["sale_history"] and "data" in doc:
+                applied = doc.get("version", 0) > self._settings_versions.get(doc_id, 0)
+                if applied:
+                    self._apply_setting_doc(doc_id, doc)
+            elif collection == "earnings" and "balance" in doc:
+                applied = self._adopt_earnings_doc(doc_id, doc)
+            elif collection == "user_profiles":
+                applied = self._apply_remote_profile(doc_id, doc)
+            else:
+                return
+
+            if applied:
+                logger.info(f"🔄 Applied remote change to {collection}/{doc_id} (v{doc.get('version', 0)}, by {doc.get('updated_by', 'unknown')})")
+                if self._on_remote_change:
+                    self._on_remote_change(collection, doc_id)
+        except Exception as e:
+            logger.error(f"❌ Failed to apply remote change: {e}\n{traceback.format_exc()}")
+
+    def _apply_remote_item(self, item_name: str, doc: Dict[str, Any]) -> bool:
+        remote_version = doc.get("version", 0)
+        if remote_version <= self._item_versions.get(item_name, 0):
+            return False # Our own write echoing back, or an older event
+
+        remote_entries = doc.get("entries") or []
+        base = self._persisted_items.get(item_name, [])
+        local = [e for e in self.items.get(item_name, []) if isinstance(e, dict) and e.get('quantity', 0) > 0]
+        if local != base:
+            # Unsaved local edits: keep them on top of the remote state
+            self.items[item_name] = merge_lots(base, local, remote_entries)
+        else:
+            self.items[item_name] = copy.deepcopy(remote_entries)
+        self._stock_changed(item_name)
+        self._item_versions[item_name] = remote_version
+        self._persisted_items[item_name] = copy.deepcopy(remote_entries)
+        return True
+
+    # --- Local snapshot (warm starts) ---
+
+    def write_snapshot(self) -> None:
+        """Write the state last confirmed by MongoDB, with document versions, to SNAPSHOT_PATH.
+
+        Only persisted state goes in (never unsaved edits), so the versions in the file
+        always describe exactly what it contains. Never raises: the snapshot is a cache.
+        """
+        if not self.storage.is_remote:
+            return # Local storage already loads quickly
+        started = time.perf_counter()
+        try:
+            saved_history = self.sale_history[:len(self.sale_history) - len(self._pending_history)]
+            snapshot = {
+                "format": SNAPSHOT_FORMAT,
+                "database": DB_NAME,
+                "written_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "items": {
+                    name: {"version": self._item_versions.get(name, 0), "entries": entries}
+                    for name, entries in self._persisted_items.items()
+                },
+                "settings": {
+                    key: {"version": self._settings_versions.get(key, 0), "data": self._persisted_settings[key]}
+                    for key in VERSIONED_SETTINGS if key in self._persisted_settings
+                },
+                "sale_history": {"version": self._settings_versions.get("sale_history", 0), "data": saved_history},
+                "earnings": {
+                    user: {"version": self._earnings_versions.get(user, 0), "balance": balance, **self.leaderboard.counters(user)}
+                    for user, balance in self._persisted_earnings.items()
+                }
+            }
+            os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+            temp_path = f"{SNAPSHOT_PATH}.tmp"
+            with gzip.open(temp_path, "wt", encoding="utf-8", compresslevel=1) as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+            os.replace(temp_path, SNAPSHOT_PATH) # Atomic: a crash mid-write leaves the previous snapshot intact
+            metrics.observe("snapshot.write", time.perf_counter() - started)
+            metrics.set_gauge("snapshot.bytes", os.path.getsize(SNAPSHOT_PATH))
+        except Exception as e:
+            metrics.incr("snapshot.write_errors")
+            logger.error(f"❌ Failed to write local snapshot: {e}\n{traceback.format_exc()}")
+
+    def load_snapshot(self) -> bool:
+        """Load SNAPSHOT_PATH into memory. Returns False if there is no usable snapshot."""
+        if not self.storage.is_remote:
+            return False
+        started = time.perf_counter()
+        try:
+            with gzip.open(SNAPSHOT_PATH, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            logger.info("📂 No local snapshot found, doing a full load from MongoDB")
+            return False
+        except Exception as e:
+            logger.warning(f"⚠️ Local snapshot unreadable, ignoring it: {e}")
+            return False
+
+        if snapshot.get("format") != SNAPSHOT_FORMAT or snapshot.get("database") != DB_NAME:
+            logger.warning(f"⚠️ Local snapshot is for another format/database ({snapshot.get('format')}/{snapshot.get('database')}), ignoring it")
+            return False
+
+        try:
+            self.items, self._item_versions, self._persisted_items = {}, {}, {}
+            for name, doc in snapshot["items"].items():
+                self.items[name] = copy.deepcopy(doc["entries"])
+                self._item_versions[name] = doc["version"]
+                self._persisted_items[name] = doc["entries"]
+            for key, doc in snapshot["settings"].items():
+                if key in VERSIONED_SETTINGS:
+                    self._apply_setting_doc(key, doc)
+            self._apply_setting_doc("sale_history", snapshot["sale_history"])
+            self.user_earnings, self._earnings_versions, self._persisted_earnings = {}, {}, {}
+            self.leaderboard = EarningsLeaderboard()
+            for user, doc in snapshot["earnings"].items():
+                self._adopt_earnings_doc(user, doc)
+            self._set_catalog()
+            self._stock_changed()
+        except (KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"⚠️ Local snapshot is malformed, ignoring it: {e}")
+            return False
+
+        metrics.observe("snapshot.load", time.perf_counter() - started)
+        logger.info(f"📂 Loaded local snapshot from {snapshot.get('written_at')} ({len(self.items)} items) in {time.perf_counter() - started:.3f}s")
+        return True
+
+    def fetch_remote_changes(self) -> List[tuple]:
+        """Find documents whose MongoDB version differs from the one held in memory.
+
+        Blocking (run off the event loop). Only `_id`/`version` are read for unchanged
+        documents, so reconciling a warm start costs two small queries. Returns
+        `(collection, doc_id, doc, local_version)` tuples for `apply_remote_changes`.
+        """
+        changes = []
+
+        remote_item_versions = {doc["_id"]: doc.get("version", 0) for doc in self.storage.load("items", fields=["version"])}
+        stale_items = [name for name, version in remote_item_versions.items() if version != self._item_versions.get(name)]
+        if stale_items:
+            for doc in self.storage.load("items", ids=stale_items):
+                changes.append(("items", doc["_id"], doc, self._item_versions.get(doc["_id"])))
+        for name in set(self._item_versions) - set(remote_item_versions):
+            # Removed from MongoDB by hand: treat as emptied
+            changes.append(("items", name, {"_id": name, "entries": [], "version": 0}, self._item_versions.get(name)))
+
+        setting_keys = VERSIONED_SETTINGS + ["sale_history"]
+        remote_setting_versions = {
+            doc["_id"]: doc.get("version", 0)
+            for doc in self.storage.load("settings", ids=setting_keys, fields=["version"])
+        }
+        stale_settings = [key for key, version in remote_setting_versions.items() if version != self._settings_versions.get(key)]
+        if stale_settings:
+            for doc in self.storage.load("settings", ids=stale_settings):
+                if "data" in doc:
+                    changes.append(("settings", doc["_id"], doc, self._settings_versions.get(doc["_id"])))
+
+        remote_earnings_versions = {doc["_id"]: doc.get("version", 0) for doc in self.storage.load("earnings", fields=["version"])}
+        stale_earnings = [user for user, version in remote_earnings_versions.items() if version != self._earnings_versions.get(user)]
+        if stale_earnings:
+            for doc in self.storage.load("earnings", ids=stale_earnings, fields=EARNINGS_FIELDS):
+                changes.append(("earnings", doc["_id"], doc, self._earnings_versions.get(doc["_id"])))
+        return changes
+
+    def apply_remote_changes(self, changes: List[tuple]) -> int:
+        """Apply `fetch_remote_changes` results on the event loop thread. Returns how many were applied.
+
+        A document whose version moved since the fetch (saved by us, or updated by the
+        change stream) is skipped: it is already newer than what was fetched.
+        """
+        applied = 0
+        for collection, doc_id, doc, fetched_against in changes:
+            if collection == "items":
+                if self._item_versions.get(doc_id) != fetched_against:
+                    continue
+                self._item_versions[doc_id] = -1 # Force _apply_remote_item to take it, even if the version went backwards
+                self._apply_remote_item(doc_id, doc)
+            elif collection == "earnings":
+                if self._earnings_versions.get(doc_id) != fetched_against:
+                    continue
+                self._earnings_versions[doc_id] = -1
+                self._adopt_earnings_doc(doc_id, doc)
+            else:
+                if self._settings_versions.get(doc_id) != fetched_against:
+                    continue
+                self._apply_setting_doc(doc_id, doc)
+            applied += 1
+        return applied
+
 
     def load_config(self) -> None:
         """Load configuration from config.json"""
@@ -2121,6 +4411,7 @@ class ShopData:
             with open(CONFIG_FILE, "r") as f:
                 config = json.load(f)
                 self.stock_message_ids = config.get("stock_message_ids", [])
+                self.stock_board_slots = config.get("stock_board_slots", {})
                 # Load thresholds and emojis, falling back to defaults if missing/invalid
                 loaded_thresholds = config.get("low_stock_thresholds", self._default_thresholds)
                 self.low_stock_thresholds = loaded_thresholds if isinstance(loaded_thresholds, dict) else self._default_thresholds
@@ -2132,25 +4423,30 @@ class ShopData:
         except FileNotFoundError:
             logger.warning(f"📝 Config file '{CONFIG_FILE}' not found. Using defaults and creating file on next save.")
             self.stock_message_ids = None
+            self.stock_board_slots = {}
             self.low_stock_thresholds = self._default_thresholds.copy()
             self.category_emojis = self._default_emojis.copy()
         except json.JSONDecodeError:
              logger.error(f"❌ Error decoding '{CONFIG_FILE}'. Please check its format. Using defaults.")
              self.stock_message_ids = None
+             self.stock_board_slots = {}
              self.low_stock_thresholds = self._default_thresholds.copy()
              self.category_emojis = self._default_emojis.copy()
         except Exception as e:
             logger.error(f"❌ Error loading config '{CONFIG_FILE}': {e}\n{traceback.format_exc()}")
             # Fallback to defaults in case of other errors
             self.stock_message_ids = None
+            self.stock_board_slots = {}
             self.low_stock_thresholds = self._default_thresholds.copy()
             self.category_emojis = self._default_emojis.copy()
+        self._stock_changed() # Thresholds and emojis feed the status flags
 
     def save_config(self) -> None:
         """Save configuration to config.json"""
         try:
             config_data = {
                 "stock_message_ids": self.stock_message_ids,
+                "stock_board_slots": self.stock_board_slots,
                 "low_stock_thresholds": self.low_stock_thresholds,
                 "category_emojis": self.category_emojis
             }
@@ -2161,97 +4457,168 @@ class ShopData:
             logger.error(f"❌ Error saving config '{CONFIG_FILE}': {e}\n{traceback.format_exc()}")
 
     def get_total_quantity(self, item_name: str) -> int:
-        if item_name not in self.items:
-            return 0
-        # Ensure entries are valid dicts with 'quantity' key
-        return sum(entry.get('quantity', 0) for entry in self.items[item_name] if isinstance(entry, dict))
+        return self.aggregate.quantity(item_name)
 
     def get_user_quantity(self, item_name: str, user: str) -> int:
-        if item_name not in self.items:
-            return 0
-        # Ensure entries are valid dicts with 'quantity' and 'person' keys
-        return sum(entry.get('quantity', 0) for entry in self.items[item_name]
-                   if isinstance(entry, dict) and entry.get('person') == user)
+        return self.aggregate.user_quantity(item_name, user)
 
     def get_all_items(self) -> List[str]:
         return self.item_list
 
+    def _set_catalog(self) -> None:
+        """Refresh the list of sellable items and the lookups built over it."""
+        self.item_list = list(self.predefined_prices.keys())
+        self.search_index.rebuild(self.item_list, self.display_names)
+        self.item_resolver.rebuild(self.item_list, self.display_names)
+
     def add_item(self, item_name: str, quantity: int, user: str) -> bool:
         # Assumes item_name is valid and quantity > 0 (checked by callers)
-        price = self.predefined_prices.get(item_name, 0)
-        date_str = str(datetime.date.today()) # Use consistent date format
-
-        if item_name not in self.items:
-            self.items[item_name] = []
-
-        # Append new stock entry
-        self.items[item_name].append({
-            "person": user,
-            "quantity": quantity,
-            "date": date_str,
-            "price": price # Store the price at time of adding
-        })
+        self.apply_event(InventoryEvent(
+            "add", item=item_name, user=user, quantity=quantity,
+            price=self.predefined_prices.get(item_name, 0), # Store the price at time of adding
+            date=str(datetime.date.today()) # Use consistent date format
+        ))
         # Note: save_data() is called by the command handler after potentially multiple adds
         return True
 
     def remove_item(self, item_name: str, quantity_to_remove: int, user: str) -> bool:
-        """Removes a specific quantity of an item from a user's stock."""
+        """Removes a specific quantity of an item from a user's stock (oldest lots first)."""
         if item_name not in self.items or quantity_to_remove <= 0:
             return False
 
-        user_entries = [
-            (index, entry) for index, entry in enumerate(self.items[item_name])
-            if isinstance(entry, dict) and entry.get('person') == user and entry.get('quantity', 0) > 0
-        ]
-
-        # Check total available *before* sorting/removing
-        total_available = sum(entry['quantity'] for _, entry in user_entries)
+        total_available = self.get_user_quantity(item_name, user)
         if total_available < quantity_to_remove:
             logger.warning(f"User '{user}' has only {total_available} of {item_name}, tried to remove {quantity_to_remove}")
             return False # Not enough stock
 
-        # Sort user's entries by date (oldest first) to ensure FIFO removal for the user
-        user_entries.sort(key=lambda x: x[1].get('date', '9999-99-99'))
-
-        removed_count = 0
-        indices_to_update = [] # Store (original_index, new_quantity)
-
-        for original_index, entry in user_entries:
-            if removed_count >= quantity_to_remove:
-                break
-
-            can_remove_from_this = entry['quantity']
-            remove_amount = min(can_remove_from_this, quantity_to_remove - removed_count)
-
-            new_quantity = entry['quantity'] - remove_amount
-            indices_to_update.append((original_index, new_quantity))
-            removed_count += remove_amount
-
-        if removed_count != quantity_to_remove:
-            # This suggests an internal logic error or race condition if total check passed
-            logger.error(f"remove_item internal mismatch: Expected {quantity_to_remove}, removed {removed_count} for {item_name} / {user}")
-            # Should we revert? For now, proceed but log error.
-            # return False # Option to fail the operation entirely
-
-        # Apply the updates to the main items list
-        for index, new_qty in indices_to_update:
-             self.items[item_name][index]['quantity'] = new_qty
-
-        # Clean up entries with zero quantity (optional, can be done in save_data too)
-        # self.items[item_name] = [entry for entry in self.items[item_name] if entry.get('quantity', 0) > 0]
+        self.apply_event(InventoryEvent("remove", item=item_name, user=user, quantity=quantity_to_remove))
         # Note: save_data() is called by the command handler
+        return True
+
+    def apply_stock_batch(self, user: str, deltas: List[Tuple[str, int]], action: str) -> StockBatchResult:
+        """Add (positive) or remove (negative) stock for `user` across several items, all or nothing.
+
+        Every delta is validated against current stock first; if any fails nothing is applied.
+        Otherwise the changes, their history entries and a single save_data() go through together.
+        """
+        merged: Dict[str, int] = {}
+        for item_name, quantity in deltas:
+            merged[item_name] = merged.get(item_name, 0) + quantity
+
+        errors = []
+        for item_name, quantity in merged.items():
+            display_name = self.display_names.get(item_name, item_name)
+            if not self.is_valid_item(item_name):
+                errors.append(f"Unknown item: `{item_name}`")
+            elif quantity == 0:
+                errors.append(f"Quantity must be non-zero for `{display_name}`")
+            elif quantity < 0 and self.get_user_quantity(item_name, user) < -quantity:
+                errors.append(f"Not enough `{display_name}` (Have: {self.get_user_quantity(item_name, user)}, Need: {-quantity})")
+        if errors:
+            return StockBatchResult(applied=False, errors=errors)
+
+        result = StockBatchResult(applied=True)
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat() # One time for the whole batch
+        for item_name, quantity in merged.items():
+            price = self.predefined_prices.get(item_name, 0)
+            if quantity > 0:
+                self.add_item(item_name, quantity, user)
+            else:
+                self.remove_item(item_name, -quantity, user)
+            result.lines.append((item_name, quantity, abs(quantity) * price))
+            self.add_to_history(action, item_name, abs(quantity), price if quantity > 0 else 0, user, timestamp=timestamp) # Price 0 for removal history
+        metrics.incr("batches.applied")
+        self.save_data()
+        return result
+
+    def compact_all_lots(self) -> Tuple[int, int]:
+        """Compact every item's lots in memory. Returns the number of entries before and after."""
+        before = after = 0
+        for item_name, entries in self.items.items():
+            compacted = compact_lots(entries)
+            before += len(entries)
+            after += len(compacted)
+            if len(compacted) < len(entries):
+                self.items[item_name] = compacted
+        return before, after
+
+    def record_sale(self, item_name: str, quantity: int, price_each: int, sale_id: Optional[str] = None) -> Dict[str, float]:
+        """Sell stock FIFO across contributors. Returns the earnings credited to each (empty if not enough stock).
+
+        `sale_id` (e.g. derived from the webhook message) becomes the event id, so the event
+        log entry and each credit's op id are the same wherever the sale is applied.
+        """
+        sellable = self.aggregate.sellable(item_name)
+        if quantity <= 0 or sellable < quantity:
+            return {}
+        event = InventoryEvent("sale", item=item_name, user="customer", quantity=quantity, price=price_each)
+        if sale_id:
+            event.id = sale_id
+        return self.apply_event(event)
+
+    def set_stock(self, item_name: str, user: str, quantity: int, price: int) -> None:
+        """Replace all of `user`'s lots of an item with a single lot (none if quantity is 0)."""
+        self.apply_event(InventoryEvent("set", item=item_name, user=user, quantity=quantity, price=price, date=str(datetime.date.today())))
+
+    def clear_stock(self, item_name: Optional[str] = None, user: Optional[str] = None) -> None:
+        """Drop lots of one item (or every item), for one user (or everyone)."""
+        self.apply_event(InventoryEvent("clear", item=item_name, user=user))
+
+    def change_price(self, item_name: str, new_price: int, update_existing: bool = False) -> None:
+        self.apply_event(InventoryEvent("price_change", item=item_name, price=new_price, update_existing=update_existing))
+
+    def payout(self, user: str, amount: float) -> bool:
+        """Deduct a cash-out from a user's earnings. Returns False if the stored balance doesn't cover it.
+
+        Blocking. The balance check and the deduction are one conditional write, so two
+        payouts racing (here or in another instance) can never overdraw the balance.
+        """
+        self._flush_earnings() # Credits still queued count towards the balance
+        event = InventoryEvent("payout", user=user, amount=amount)
+        doc = self.storage.increment_balance("earnings", user, -amount, f"{event.id}:{user}", min_balance=0)
+        if doc is None:
+            metrics.incr("earnings.payouts_refused")
+            current = self.storage.get("earnings", user)
+            if current:
+                self._adopt_earnings_doc(user, current) # Our cached balance was stale
+            return False
+        self.apply_event(event)
+        self._adopt_earnings_doc(user, doc)
+        self._refresh_earnings(user) # The reducer deducted from the cache too; the document is the truth
+        return True
 
-        return True # Indicate successful removal attempt
+    def _stock_changed(self, item_name: Optional[str] = None) -> None:
+        """Stock, prices or thresholds changed for one item (every item with no name)."""
+        self.aggregate.invalidate(item_name)
+        self.stock_alerts.observe(item_name)
+
+    def apply_event(self, event: InventoryEvent) -> Dict[str, float]:
+        """Apply an event to the live state and queue it for the event log (written by save_data)."""
+        result = apply_inventory_event(self, event)
+        for user, amount in result.items(): # Sale credits, written by save_data
+            self._pending_earnings.append({"op": f"{event.id}:{user}", "user": user, "amount": amount, "day": event.ts[:10]})
+        if event.type != "payout":
+            self._stock_changed(event.item) # No item: every item was cleared
+        if event.item and event.user and event.type in ("add", "remove", "set"):
+            self.search_index.note_use(event.user, event.item) # Ranks it higher in their autocomplete
+        if event.user and event.type in ("add", "remove", "set", "payout"):
+            self._save_seen_name(event.user)
+        doc = event.to_doc()
+        if result:
+            doc["credits"] = result # For statements; replay recomputes credits from the lots
+        self._pending_events.append(doc)
+        metrics.incr(f"events.{event.type}")
+        return result
 
 
     def is_valid_item(self, item_name: str) -> bool:
         return item_name in self.predefined_prices
 
-    def add_to_history(self, action: str, item: str, quantity: int, price: int, user: str) -> None:
-        """Adds an event to the sale/action history."""
+    def add_to_history(self, action: str, item: str, quantity: int, price: int, user: str, timestamp: Optional[str] = None) -> None:
+        """Adds an event to the sale/action history (at `timestamp`, e.g. one shared by a batch, or now)."""
         try:
             # Use UTC time for consistency
-            timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            timestamp = timestamp or datetime.datetime.now(datetime.timezone.utc).isoformat()
             history_entry = {
                 "timestamp": timestamp,
                 "action": action, # e.g., "add", "remove", "sale", "payout", "set", "clear", "price_change"
@@ -2261,9 +4628,10 @@ class ShopData:
                 "user": user # Can be user ID string, "customer", "all", etc.
             }
             self.sale_history.append(history_entry)
+            self._pending_history.append(history_entry) # Pushed to MongoDB on next save_data()
             # Limit history size in memory immediately after adding
-            if len(self.sale_history) > 1100: # Keep slightly more than save limit
-                 self.sale_history = self.sale_history[-1000:]
+            if len(self.sale_history) > SALE_HISTORY_LIMIT + 100: # Keep slightly more than save limit
+                 self.sale_history = self.sale_history[-SALE_HISTORY_LIMIT:]
         except Exception as e:
             logger.error(f"Failed to add entry to history: {e}")
 
@@ -2281,38 +4649,525 @@ class ShopData:
         return threshold > 0 and quantity <= threshold # Only trigger if threshold is positive
 
     def save_template(self, user: str, template_name: str, items: Dict[str, int]) -> bool:
-        # This method seems redundant if template saving is handled directly in commands/views
-        # Let's keep it for now, assuming it might be used internally
-        if user not in self.user_templates:
-            self.user_templates[user] = {}
-        # Filter out 0 quantity items before saving?
-        self.user_templates[user][template_name] = {k: v for k, v in items.items() if v > 0}
-        self.save_data() # Should this save all data? Maybe just templates?
+        """Create or replace a template (zero quantities dropped) and save."""
+        self._update_profile(user, "templates")[template_name] = {k: v for k, v in items.items() if v > 0}
+        self.save_data() # Only this user's templates field is written
         return True
 
+    def set_template_item(self, user: str, template_name: str, item_name: str, quantity: int) -> None:
+        self._update_profile(user, "templates").setdefault(template_name, {})[item_name] = quantity
+        self.save_data()
+
+    def rename_template(self, user: str, old_name: str, new_name: str) -> bool:
+        """Returns False if there is no template `old_name`."""
+        if old_name not in self.get_user_templates(user):
+            return False
+        templates = self._update_profile(user, "templates")
+        templates[new_name] = templates.pop(old_name)
+        self.save_data()
+        return True
+
+    def delete_template(self, user: str, template_name: str) -> bool:
+        """Returns False if there is no such template."""
+        if template_name not in self.get_user_templates(user):
+            return False
+        del self._update_profile(user, "templates")[template_name]
+        self.save_data()
+        return True
+
+    def load_alert_state(self) -> List[str]:
+        """Items the last low-stock digest reported as low. Blocking."""
+        return (self.storage.get("settings", "stock_alerts") or {}).get("notified", [])
+
+    def save_alert_state(self) -> None:
+        self.storage.set_fields("settings", "stock_alerts", {"notified": sorted(self.stock_alerts.notified)})
+
+    def get_command_sync_hash(self, scope: str) -> Optional[str]:
+        """Hash of the command tree last synced to Discord for `scope` (e.g. 'global', 'guild:123')."""
+        doc = self.storage.get("settings", "command_sync") or {}
+        return doc.get("hashes", {}).get(scope)
+
+    def set_command_sync_hash(self, scope: str, tree_hash: str) -> None:
+        doc = self.storage.get("settings", "command_sync") or {}
+        self.storage.set_fields("settings", "command_sync", {"hashes": {**doc.get("hashes", {}), scope: tree_hash}})
+
+    def user_key(self, user: Union[discord.User, discord.Member]) -> str:
+        """Storage key for a Discord user: their ID, which survives username changes.
+
+        Notes their display name in memory only; it is stored with the user's next own
+        change (stock, payout, templates, preferences), so read-only commands never write.
+        """
+        key = str(user.id)
+        self._seen_names.put(key, user.display_name)
+        return key
+
+    def remember_name(self, user: str, name: str) -> None:
+        """Keep `name` as the user's last known display name (written with the next save, if it changed)."""
+        if self._profile(user)["data"]["identity"].get("display_name") != name:
+            self._update_profile(user, "identity")["display_name"] = name
+
+    def last_known_name(self, user: str) -> Optional[str]:
+        """Last display name the shop saw for `user`, from memory only (never blocks).
+
+        None when the user's profile isn't loaded; load_names() fetches a batch of them first.
+        """
+        name = self._seen_names.peek(user)
+        if name is None:
+            profile = self._dirty_profiles.get(user) or self.profile_cache.peek(user)
+            name = profile["data"]["identity"].get("display_name") if profile else None
+        return name
+
+    def load_names(self, users: Iterable[str]) -> None:
+        """Load the profiles of `users` that aren't in memory, in one read, for last_known_name(). Blocking."""
+        missing = [user for user in set(users) if user not in self._dirty_profiles and self.profile_cache.peek(user) is None]
+        if not missing:
+            return
+        for doc in self.storage.load("user_profiles", ids=missing):
+            if doc["_id"] not in self._dirty_profiles and self.profile_cache.peek(doc["_id"]) is None: # Not cached meanwhile
+                self.profile_cache.put(doc["_id"], self._profile_from_doc(doc))
+
+    # --- One-off migration from username keys to user IDs ---
+
+    def collect_user_keys(self) -> Set[str]:
+        """Every user key in storage that is still a username rather than an ID. Blocking."""
+        keys: Set[Any] = set()
+        for doc in self.storage.load("items"):
+            keys.update(entry.get("person") for entry in doc.get("entries") or [] if isinstance(entry, dict))
+        keys.update(doc["_id"] for doc in self.storage.load("earnings", fields=["version"]))
+        keys.update(doc["_id"] for doc in self.storage.load("user_profiles", fields=["version"]))
+        keys.update(doc.get("user") for doc in self.storage.load("events", fields=["user"]))
+        keys.update(entry.get("user") for entry in self.sale_history if isinstance(entry, dict))
+        return {key for key in keys if isinstance(key, str) and not key.isdigit() and key not in NON_USER_KEYS}
+
+    def migrate_user_keys(self, mapping: Dict[str, str], backup_dir: str) -> Dict[str, int]:
+        """Rewrite every stored document (and local backup file) from username keys to user IDs.
+
+        Blocking, and not safe against concurrent writes: call it with nothing unsaved and
+        reload afterwards. Returns how many documents/files were rewritten per collection.
+        """
+        counts: Dict[str, int] = {}
+
+        def rewrite(collection: str, docs: List[Dict[str, Any]], delete_ids: List[Any] = ()) -> None:
+            for doc in docs:
+                if "version" in doc:
+                    doc["version"] += 1 # Anyone holding the old version rebases instead of overwriting
+            self.storage.rewrite(collection, docs, list(delete_ids))
+            if docs or delete_ids:
+                counts[collection] = len(docs)
+
+        rewrite("items", [doc for doc in self.storage.load("items") if rekey_lots(doc.get("entries"), mapping)])
+        rewrite("events", [doc for doc in self.storage.load("events")
+                           if rekey_history([doc], mapping) + rekey_mapping(doc.get("credits") or {}, mapping)])
+        rewrite("event_snapshots", [doc for doc in self.storage.load("event_snapshots") if rekey_snapshot(doc.get("state") or {}, mapping)])
+        rewrite("backups", [doc for doc in self.storage.load("backups") if isinstance(doc.get("data"), dict) and rekey_snapshot(doc["data"], mapping)])
+        settings = []
+        for doc in self.storage.load("settings", ids=["sale_history", "user_earnings", *LEGACY_PROFILE_SETTINGS]):
+            data = doc.get("data")
+            if rekey_history(data, mapping) if doc["_id"] == "sale_history" else isinstance(data, dict) and rekey_mapping(data, mapping):
+                settings.append(doc)
+        rewrite("settings", settings)
+
+        # Per-user documents change _id: fold each into the ID-keyed document (if the user already has one)
+        earnings = {doc["_id"]: doc for doc in self.storage.load("earnings")}
+        merged: Dict[str, Dict[str, Any]] = {}
+        for old_id in [doc_id for doc_id in earnings if doc_id in mapping]:
+            old, new_id = earnings[old_id], mapping[old_id]
+            target = merged.get(new_id) or earnings.get(new_id) or {"_id": new_id, "balance": 0, "version": 0, "ops": []}
+            target["balance"] = target.get("balance", 0) + old.get("balance", 0)
+            target["earned"] = target.get("earned", 0) + old.get("earned", 0)
+            daily = target.setdefault("earned_daily", {})
+            for day, amount in (old.get("earned_daily") or {}).items():
+                daily[day] = daily.get(day, 0) + amount
+            target["ops"] = (old.get("ops", []) + target.get("ops", []))[-BALANCE_OPS_KEPT:]
+            target["version"] = max(target.get("version", 0), old.get("version", 0))
+            merged[new_id] = target
+        rewrite("earnings", list(merged.values()), [doc_id for doc_id in earnings if doc_id in mapping])
+
+        profiles = {doc["_id"]: doc for doc in self.storage.load("user_profiles")}
+        merged = {}
+        for old_id in [doc_id for doc_id in profiles if doc_id in mapping]:
+            old, new_id = profiles[old_id], mapping[old_id]
+            target = merged.get(new_id) or profiles.get(new_id) or {"_id": new_id, "version": 0}
+            for key in PROFILE_FIELDS:
+                target[key] = {**(old.get(key) or {}), **(target.get(key) or {})}
+            target["version"] = max(target.get("version", 0), old.get("version", 0))
+            merged[new_id] = target
+        rewrite("user_profiles", list(merged.values()), [doc_id for doc_id in profiles if doc_id in mapping])
+
+        counts["backup files"] = self.rekey_backup_files(backup_dir, mapping)
+        return counts
+
+    def rekey_backup_files(self, directory: str, mapping: Dict[str, str]) -> int:
+        """Rewrite local JSON backups to user ID keys, keeping their timestamps (pruning goes by mtime)."""
+        rewritten = 0
+        for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if not isinstance(data, dict) or not rekey_snapshot(data, mapping):
+                    continue
+                stat = os.stat(path)
+                temp_path = f"{path}.tmp"
+                with open(temp_path, "w") as f:
+                    json.dump(data, f, indent=2)
+                os.replace(temp_path, path)
+                os.utime(path, (stat.st_atime, stat.st_mtime))
+                rewritten += 1
+            except (OSError, ValueError) as e:
+                logger.warning(f"⚠️ Could not rekey backup file {filename}: {e}")
+        return rewritten
+
     def get_user_templates(self, user: str) -> Dict[str, Dict[str, int]]:
-        return self.user_templates.get(user, {})
+        """The user's templates (read-only: change them through save/rename/delete_template)."""
+        return self._profile(user)["data"]["templates"]
 
     def get_user_preference(self, user: str, preference: str, default: Any = None) -> Any:
-        return self.user_preferences.get(user, {}).get(preference, default)
+        return self._profile(user)["data"]["preferences"].get(preference, default)
 
     def set_user_preference(self, user: str, preference: str, value: Any) -> None:
-        if user not in self.user_preferences:
-            self.user_preferences[user] = {}
-        self.user_preferences[user][preference] = value
-        self.save_data() # Save immediately when preferences change
+        if self.get_user_preference(user, preference) == value:
+            return # Nothing to write
+        self._update_profile(user, "preferences")[preference] = value
+        self.save_data() # Save immediately when preferences change; only this user's preferences are written
 
 
 # Instantiate ShopData AFTER the class is defined
 shop_data = ShopData()
 
+
+############### LEADER ELECTION ###############
+class LeaderLease:
+    """Lease-based leader election stored in a storage backend document.
+
+    Only the lease holder runs singleton jobs (automatic backups, stock board upkeep).
+    The holder renews every `renew_seconds`; if it dies, a follower takes over at most
+    `ttl_seconds + renew_seconds` later. With MongoDB, expiry is checked against the
+    server clock ($$NOW), so clock skew between hosts doesn't matter.
+    """
+    def __init__(self, storage: StorageBackend, name: str, holder_id: str, ttl_seconds: int, renew_seconds: int):
+        self.storage = storage
+        self.name = name
+        self.holder_id = holder_id
+        self.ttl_seconds = ttl_seconds
+        self.renew_seconds = renew_seconds
+        self.term = 0 # Incremented in storage every time leadership changes hands
+        self._is_leader = False
+        self._valid_until = 0.0 # Monotonic deadline after which we stop trusting our lease
+        self._stop = threading.Event()
+        self._thread: Optional[Thread] = None
+        self._on_elected = None
+
+    @property
+    def is_leader(self) -> bool:
+        # Step down locally before the lease can expire if renewals are failing
+        return self._is_leader and time.monotonic() < self._valid_until
+
+    def try_acquire(self) -> bool:
+        """Acquire the lease if it is free or expired, or renew it if we already hold it."""
+        started = time.monotonic()
+        try:
+            doc = self.storage.acquire_lease(self.name, self.holder_id, self.ttl_seconds)
+            acquired = bool(doc) and doc.get("holder") == self.holder_id
+            if acquired:
+                self.term = doc.get("term", 0)
+                self._valid_until = started + self.ttl_seconds - self.renew_seconds
+        except STORAGE_ERRORS as e:
+            logger.warning(f"⚠️ Could not renew leader lease '{self.name}': {e}")
+            metrics.incr("leader.renew_errors")
+            acquired = self.is_leader # Keep leading only until our last lease would run out
+
+        self._set_leader(acquired)
+        return acquired
+
+    def _set_leader(self, leader: bool) -> None:
+        if leader and not self._is_leader:
+            logger.info(f"👑 Instance {self.holder_id} is now the leader for '{self.name}' (term {self.term})")
+            metrics.incr("leader.elected")
+            self._is_leader = True
+            if self._on_elected:
+                try:
+                    self._on_elected()
+                except Exception as e:
+                    logger.error(f"Error in leader election callback: {e}\n{traceback.format_exc()}")
+        elif not leader and self._is_leader:
+            logger.warning(f"⚠️ Instance {self.holder_id} is no longer the leader for '{self.name}' (term {self.term})")
+            metrics.incr("leader.lost")
+            self._is_leader = False
+        metrics.set_gauge("leader.is_leader", 1 if self._is_leader else 0)
+        metrics.set_gauge("leader.term", self.term)
+
+    def start(self, on_elected=None) -> None:
+        """Try once synchronously (so startup knows its role), then keep renewing in the background."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._on_elected = on_elected
+        self._stop.clear()
+        self.try_acquire()
+        self._thread = Thread(target=self._run, daemon=True, name="leader-lease")
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.renew_seconds):
+            self.try_acquire()
+
+    def release(self) -> None:
+        """Stop renewing and hand the lease back so a follower can take over immediately."""
+        self._stop.set()
+        if self._is_leader:
+            try:
+                self.storage.release_lease(self.name, self.holder_id)
+                logger.info(f"Released leader lease '{self.name}'")
+            except STORAGE_ERRORS as e:
+                logger.warning(f"Could not release leader lease '{self.name}': {e}")
+        self._set_leader(False)
+
+
+leader_lease = LeaderLease(
+    shop_data.storage,
+    name="singleton_jobs",
+    holder_id=shop_data.instance_id,
+    ttl_seconds=LEADER_LEASE_SECONDS,
+    renew_seconds=LEADER_RENEW_SECONDS
+)
+
+# Commands that never touch shop data and may run while it is still loading
+DATA_FREE_COMMANDS = {"help", "botstats"}
+
+class ShopCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        """Hold back commands until shop data has loaded (the gateway connects before that)."""
+        if shop_data.is_ready or interaction.type == discord.InteractionType.autocomplete:
+            return True
+        if interaction.command and interaction.command.qualified_name in DATA_FREE_COMMANDS:
+            return True
+        metrics.incr("startup.rejected_interactions")
+        try:
+            await interaction.response.send_message(
+                "⏳ The bot is still starting up and loading shop data. Please try again in a few seconds.",
+                ephemeral=True
+            )
+        except Exception: pass
+        return False
+
 # Instantiate Bot AFTER ShopData might be needed by decorators/UI elements
 # (Though typically decorators are evaluated later, it's safer this way)
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = commands.Bot(command_prefix="!", intents=intents, tree_cls=ShopCommandTree)
+
+
+############### DISCORD OUTBOX ###############
+
+class _RouteBucket:
+    """Fixed-window request budget for one route, tightened by the rate-limit headers of 429s."""
+    def __init__(self, capacity: int, window: float):
+        self.capacity = capacity
+        self.window = window
+        self.remaining = capacity
+        self.reset_at = 0.0
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        if now >= self.reset_at:
+            self.remaining, self.reset_at = self.capacity, now + self.window
+        if self.remaining <= 0:
+            wait = self.reset_at - now
+            metrics.observe("outbox.bucket_wait", wait)
+            await asyncio.sleep(wait) # Exactly until the window resets
+            self.remaining, self.reset_at = self.capacity, time.monotonic() + self.window
+        self.remaining -= 1
+
+    def rate_limited(self, error: discord.HTTPException) -> float:
+        """Learn from a 429 response; returns how long the route is blocked."""
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        retry_after = float(headers.get("Retry-After") or headers.get("X-RateLimit-Reset-After") or getattr(error, "retry_after", 0) or 1.0)
+        if str(headers.get("X-RateLimit-Limit", "")).isdigit():
+            self.capacity = max(1, int(headers["X-RateLimit-Limit"]))
+        self.remaining, self.reset_at = 0, time.monotonic() + retry_after
+        return retry_after
+
+
+class _OutboxJob:
+    __slots__ = ("kind", "call", "priority", "key", "enqueued", "futures", "attempts")
+
+    def __init__(self, kind: str, call: Callable[[], Awaitable[Any]], priority: int, key: Optional[tuple]):
+        self.kind = kind
+        self.call = call
+        self.priority = priority
+        self.key = key
+        self.enqueued = time.monotonic()
+        self.futures: List[asyncio.Future] = []
+        self.attempts = 0
+
+
+class DiscordOutbox:
+    """Central queue for Discord REST calls made outside interaction responses.
+
+    Calls are grouped by route (channel messages, channel deletes, reactions, DMs), each
+    paced by its own bucket and drained highest priority first. An edit of a message that
+    still has an edit queued replaces it instead of adding another request.
+    """
+    HIGH, NORMAL, LOW = 0, 1, 2
+    MAX_ATTEMPTS = 3
+    # Discord's documented per-route limits: (requests, per seconds)
+    ROUTE_LIMITS = {"message": (5, 5.0), "delete": (5, 1.0), "reaction": (1, 0.25), "dm": (5, 5.0)}
 
+    def __init__(self):
+        self._queues: Dict[str, list] = {} # route: heap of (priority, seq, job)
+        self._buckets: Dict[str, _RouteBucket] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._pending: Dict[tuple, _OutboxJob] = {} # coalesce key: queued job
+        self._seq = itertools.count()
+
+    def submit(self, route: str, kind: str, call: Callable[[], Awaitable[Any]], priority: int = NORMAL,
+               coalesce_key: Optional[tuple] = None, wait: bool = True) -> Optional[asyncio.Future]:
+        """Queue `call` on `route`. Returns a future for its result (None with wait=False; errors are logged)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if wait else None
+        job = self._pending.get(coalesce_key) if coalesce_key else None
+        if job:
+            job.call = call # Superseded: only the latest content gets sent
+            job.priority = min(job.priority, priority)
+            metrics.incr("outbox.coalesced")
+        else:
+            job = _OutboxJob(kind, call, priority, coalesce_key)
+            if coalesce_key:
+                self._pending[coalesce_key] = job
+            heapq.heappush(self._queues.setdefault(route, []), (priority, next(self._seq), job))
+        if future:
+            job.futures.append(future)
+
+        if route not in self._buckets:
+            self._buckets[route] = _RouteBucket(*self.ROUTE_LIMITS[route.split(":", 1)[0]])
+        if route not in self._workers:
+            self._workers[route] = loop.create_task(self._drain(route))
+        metrics.set_gauge("outbox.pending", sum(len(q) for q in self._queues.values()))
+        return future
+
+    async def _drain(self, route: str) -> None:
+        queue, bucket = self._queues[route], self._buckets[route]
+        try:
+            while queue:
+                _, _, job = heapq.heappop(queue)
+                if job.key:
+                    self._pending.pop(job.key, None)
+                await bucket.acquire()
+                metrics.observe("outbox.queue_delay", time.monotonic() - job.enqueued)
+                try:
+                    result = await job.call()
+                except discord.HTTPException as e:
+                    job.attempts += 1
+                    if e.status == 429 and job.attempts < self.MAX_ATTEMPTS:
+                        retry_after = bucket.rate_limited(e)
+                        metrics.incr("outbox.rate_limited")
+                        logger.warning(f"⏳ Rate limited on {route} ({job.kind}), retrying in {retry_after:.2f}s")
+                        if job.key and job.key not in self._pending:
+                            self._pending[job.key] = job
+                        heapq.heappush(queue, (job.priority, next(self._seq), job))
+                        continue
+                    self._finish(route, job, error=e)
+                except Exception as e:
+                    self._finish(route, job, error=e)
+                else:
+                    self._finish(route, job, result=result)
+        finally:
+            self._workers.pop(route, None)
+            if not queue:
+                self._queues.pop(route, None)
+            metrics.set_gauge("outbox.pending", sum(len(q) for q in self._queues.values()))
+
+    def _finish(self, route: str, job: _OutboxJob, result: Any = None, error: Optional[BaseException] = None) -> None:
+        metrics.incr(f"outbox.{job.kind}" if error is None else "outbox.failed")
+        if error is not None and not job.futures:
+            logger.warning(f"⚠️ Discord {job.kind} on {route} failed: {error}")
+        for future in job.futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    # --- Convenience wrappers ---
+
+    async def send(self, channel: discord.abc.Messageable, content: str, priority: int = NORMAL) -> discord.Message:
+        return await self.submit(f"message:{channel.id}", "send", lambda: channel.send(content), priority)
+
+    async def edit(self, message: Union[discord.Message, discord.PartialMessage], content: str, priority: int = NORMAL):
+        return await self.submit(f"message:{message.channel.id}", "edit", lambda: message.edit(content=content),
+                                 priority, coalesce_key=("edit", message.id))
+
+    async def delete(self, message: Union[discord.Message, discord.PartialMessage], priority: int = LOW) -> None:
+        await self.submit(f"delete:{message.channel.id}", "delete", message.delete, priority, coalesce_key=("delete", message.id))
+
+    def react(self, message: discord.Message, emoji: str) -> None:
+        """Fire-and-forget reaction (failures are logged)."""
+        self.submit(f"reaction:{message.channel.id}", "reaction", lambda: message.add_reaction(emoji), self.HIGH, wait=False)
+
+    async def dm(self, user: Union[discord.User, discord.Member], content: str = None, priority: int = LOW, **kwargs) -> discord.Message:
+        return await self.submit(f"dm:{user.id}", "dm", lambda: user.send(content, **kwargs), priority)
+
+outbox = DiscordOutbox()
 
 ################ HELPER FUNCTIONS ###############
 #ar
+# Display names of guild members, filled from the gateway (member chunks and member/user
+# update events) so rendering a list of users never needs a REST call per row.
+MEMBER_NAME_CACHE_SIZE = 5000
+MEMBER_NAME_TTL = 6 * 3600 # Seconds; update events normally refresh a name long before this
+member_names = LRUCache("member_names", MEMBER_NAME_CACHE_SIZE, ttl=MEMBER_NAME_TTL)
+_member_names_task: Optional[asyncio.Task] = None
+
+
+def remember_member(member: discord.Member) -> None:
+    member_names.put(str(member.id), member.display_name)
+
+
+async def warm_member_names() -> None:
+    """Chunk every guild's member list (members intent) into the member-name cache."""
+    for guild in bot.guilds:
+        try:
+            if not guild.chunked:
+                await guild.chunk()
+            for member in guild.members:
+                remember_member(member)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not load the member list of {guild.name}: {e}")
+    logger.info(f"👥 Member-name cache holds {len(member_names)} name(s)")
+
+
+def user_label(user_key: str) -> str:
+    """Display name for a stored user key, without any REST call or storage read.
+
+    IDs go through the member-name cache, then discord.py's gateway member cache, then the
+    last name the shop saw (call load_user_labels() first to have it for users who left);
+    placeholders ("customer") and old username keys show as they are.
+    """
+    if not user_key.isdigit():
+        return user_key
+    name = member_names.get(user_key)
+    if name is None:
+        member = next((m for guild in bot.guilds if (m := guild.get_member(int(user_key)))), None)
+        if member is None:
+            return shop_data.last_known_name(user_key) or f"<@{user_key}>" # Left every guild: last known name
+        remember_member(member)
+        name = member.display_name
+    return name
+
+
+async def load_user_labels(user_keys: Iterable[str]) -> None:
+    """Fetch the stored names of users no member cache knows, in one read, before rendering user_label()s."""
+    unknown = [key for key in set(user_keys) if key.isdigit() and member_names.get(key) is None
+               and not any(guild.get_member(int(key)) for guild in bot.guilds)]
+    if not unknown:
+        return
+    try:
+        await asyncio.to_thread(shop_data.load_names, unknown)
+    except STORAGE_ERRORS as e:
+        logger.warning(f"⚠️ Could not load stored names for {len(unknown)} user(s): {e}") # Shown as mentions
+
+
 async def is_admin(interaction: discord.Interaction) -> bool:
     """Checks if the interaction user has administrator permissions."""
     if not isinstance(interaction.user, discord.Member): # Check in DMs or user left?
@@ -2323,10 +5178,123 @@ async def is_admin(interaction: discord.Interaction) -> bool:
     # logger.info(f"Admin check for {interaction.user} in guild {interaction.guild.id}: {has_admin}") # Debug logging
     return has_admin
 
+def render_board_category(totals: CategoryTotals) -> str:
+    """One category's section of the stock board (header, table and a blank line)."""
+    item_lines = []
+    for row in totals.rows:
+        # Warning for low stock, high stock indicator, checkmark otherwise (or with no threshold)
+        warning = {"low": "⚠️", "high": "📈"}.get(row.status, "✅")
+        formatted_price = f"${row.price:,}" if row.price else "N/A"
+        formatted_value = f"${row.value:,}" if row.price else "N/A"
+        # Use Discord code block for fixed-width formatting
+        item_lines.append(f"`{row.display_name[:18]:<18} {row.quantity:>7,} {formatted_price:>9} {formatted_value:>11} {warning}`\n")
+
+    category_header = f"## {totals.emoji} {totals.category.upper()} (Total Value: ${totals.value:,})\n\n"
+    if not item_lines:
+        return category_header + "No items currently in stock.\n\n"
+    category_table_header = f"`Item                Quantity    Price      Value       Status`\n"
+    category_table_header += f"`------------------ --------- --------- ----------- --------`\n"
+    return category_header + category_table_header + "".join(item_lines) + "\n"
+
+
+# --- Partitioned stock board (STOCK_BOARD_LAYOUT=category) ---
+stock_board_lock = asyncio.Lock() # One board update at a time, so slots aren't posted twice
+board_slot_totals: Dict[str, tuple] = {} # slot key: category totals it was last rendered from
+
+
+def board_slots() -> List[Tuple[str, List[str]]]:
+    """[(slot key, categories)] in display order. Categories missing from STOCK_BOARD_GROUPS get their own slot."""
+    groups = [[c for c in group if c in shop_data.item_categories] for group in STOCK_BOARD_GROUPS]
+    groups = [group for group in groups if group]
+    grouped = {c for group in groups for c in group}
+    groups += [[c] for c in shop_data.item_categories if c not in grouped]
+    return [("+".join(group), group) for group in groups]
+
+
+def render_board_slot(index: int, totals: tuple) -> str:
+    content = "# 📊 Current Shop Stock\n\n" if index == 0 else ""
+    content += "".join(render_board_category(t) for t in totals)
+    content += f"-# Updated <t:{int(datetime.datetime.now().timestamp())}:R>"
+    if len(content) > 1990:
+        content = content[:1950] + "\n… (too long, split this group in STOCK_BOARD_GROUPS)"
+    return content
+
+
+async def delete_board_messages(channel: discord.TextChannel, message_ids: List[int]) -> None:
+    for msg_id in message_ids:
+        try:
+            await outbox.delete(channel.get_partial_message(msg_id))
+        except discord.NotFound:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to delete stock board message {msg_id}: {e}")
+
+
+async def update_partitioned_board(channel: discord.TextChannel) -> None:
+    """Edit only the slots whose categories changed since they were last rendered.
+
+    If the slot layout changed or a slot message went missing, the whole board is
+    reposted so slots stay in order.
+    """
+    try:
+        slots = board_slots()
+        slot_totals = {key: tuple(shop_data.aggregate.category(c) for c in categories) for key, categories in slots}
+        if list(shop_data.stock_board_slots) != [key for key, _ in slots]:
+            await repost_partitioned_board(channel, slots, slot_totals)
+            return
+
+        for index, (key, _) in enumerate(slots):
+            if board_slot_totals.get(key) == slot_totals[key]:
+                continue # Nothing in this slot changed
+            try:
+                await outbox.edit(channel.get_partial_message(shop_data.stock_board_slots[key]), render_board_slot(index, slot_totals[key]))
+                board_slot_totals[key] = slot_totals[key]
+                metrics.incr("board.slot_edits")
+                logger.info(f"Updated stock board slot '{key}'")
+            except discord.NotFound:
+                logger.warning(f"Stock board message for slot '{key}' was deleted, reposting the board")
+                await repost_partitioned_board(channel, slots, slot_totals)
+                return
+    except Exception as e:
+        logger.error(f"Error updating partitioned stock board: {e}\n{traceback.format_exc()}")
+
+
+async def repost_partitioned_board(channel: discord.TextChannel, slots: List[Tuple[str, List[str]]], slot_totals: Dict[str, tuple]) -> None:
+    """Replace every board message (either layout) with one message per slot, in order."""
+    await delete_board_messages(channel, list(shop_data.stock_board_slots.values()) + list(shop_data.stock_message_ids or []))
+    shop_data.stock_message_ids = []
+    shop_data.stock_board_slots = {}
+    board_slot_totals.clear()
+    for index, (key, _) in enumerate(slots):
+        msg = await outbox.send(channel, render_board_slot(index, slot_totals[key]))
+        shop_data.stock_board_slots[key] = msg.id
+        board_slot_totals[key] = slot_totals[key]
+    shop_data.save_config()
+    metrics.incr("board.reposts")
+    logger.info(f"📝 Posted stock board with {len(slots)} slot(s): {list(shop_data.stock_board_slots)}")
+
+
+board_cleanup_pending = True # Sweep leftover board posts on the first update (and after /refreshboard)
+
+
+async def cleanup_untracked_board_messages(channel: discord.TextChannel) -> None:
+    """Delete our own board posts that aren't tracked any more (e.g. left over from a crash)."""
+    tracked = set(shop_data.stock_message_ids or []) | set(shop_data.stock_board_slots.values())
+    try:
+        async for message in channel.history(limit=20):  # Adjust limit as needed
+            if message.author == bot.user and message.id not in tracked and "Current Shop Stock" in message.content:
+                await outbox.delete(message)
+                logger.info(f"Deleted untracked stock message: {message.id}")
+    except Exception as e:
+        logger.error(f"Error cleaning up stock messages: {e}")
+
+
 async def update_stock_message() -> None:
     """Updates the persistent stock message in the designated channel."""
     if not STOCK_CHANNEL_ID:
         return
+    if not leader_lease.is_leader:
+        return # The leader maintains the board; it sees our writes through the change stream
 
     channel = bot.get_channel(STOCK_CHANNEL_ID)
     if not isinstance(channel, discord.TextChannel):
@@ -2341,6 +5309,25 @@ async def update_stock_message() -> None:
         logger.error(f"❌ Bot lacks Send Messages, Read History, or Manage Messages permission in channel {STOCK_CHANNEL_ID}")
         return
 
+    global board_cleanup_pending
+    # Both layouts and the sweep run under the lock, so an update never races another one's posts
+    async with stock_board_lock:
+        if board_cleanup_pending:
+            board_cleanup_pending = False
+            await cleanup_untracked_board_messages(channel)
+        if STOCK_BOARD_LAYOUT == "category":
+            await update_partitioned_board(channel)
+        else:
+            await update_packed_board(channel)
+
+
+async def update_packed_board(channel: discord.TextChannel) -> None:
+    """Pack every category into as few messages as fit, editing the tracked posts in place."""
+    if shop_data.stock_board_slots:
+        await delete_board_messages(channel, list(shop_data.stock_board_slots.values())) # Switched back from the category layout
+        shop_data.stock_board_slots = {}
+        shop_data.save_config()
+
     try:
         # First generate the content to display
         messages_content = []
@@ -2352,61 +5339,20 @@ async def update_stock_message() -> None:
         current_message = header
 
         # Process items by category
-        categories_with_stock = {}
-        for category, items in shop_data.item_categories.items():
-            category_content = ""
-            item_lines = []
-            category_value = 0
-            has_items = False
-            
-            # Sort items within category for consistent display
-            sorted_items = sorted(items, key=lambda x: shop_data.display_names.get(x, x))
-            
-            for item_name in sorted_items:
-                # No need to check shop_data.items - get_total_quantity handles it
-                total_quantity = shop_data.get_total_quantity(item_name)
-                if total_quantity > 0:
-                    has_items = True
-                    price = shop_data.predefined_prices.get(item_name, 0) # Use 0 if price somehow missing
-                    item_value = total_quantity * price
-                    category_value += item_value
-                    display_name = shop_data.display_names.get(item_name, item_name)
-                    low_threshold = shop_data.low_stock_thresholds.get(category, 0)
-                    
-                    # Determine warning symbol based on thresholds
-                    if low_threshold > 0:
-                        if total_quantity <= low_threshold:
-                            warning = "⚠️" # Warning for low stock
-                        elif total_quantity >= low_threshold * 3:
-                            warning = "📈" # High stock indicator
-                        else:
-                            warning = "✅" # Normal stock level
-                    else:
-                        warning = "✅" # Default to checkmark if no threshold set
-                    
-                    formatted_price = f"${price:,}" if price else "N/A"
-                    formatted_value = f"${item_value:,}" if price else "N/A"
-                    
-                    # Use Discord code block for fixed-width formatting
-                    item_line = f"`{display_name[:18]:<18} {total_quantity:>7,} {formatted_price:>9} {formatted_value:>11} {warning}`\n"
-                    item_lines.append(item_line)
-            
-            if has_items:
-                category_emoji = shop_data.category_emojis.get(category, "📦")  # Use emoji from config
-                category_header = f"## {category_emoji} {category.upper()} (Total Value: ${category_value:,})\n\n"
-                category_table_header = f"`Item                Quantity    Price      Value       Status`\n"
-                category_table_header += f"`------------------ --------- --------- ----------- --------`\n"
-                
-                category_content = category_header + category_table_header + "".join(item_lines) + "\n"
-                
-                # Check if adding this category would exceed message limit
-                if len(current_message + category_content) > char_limit:
-                    # Save current message and start a new one
-                    messages_content.append(current_message)
-                    current_message = header  # Start with header again
-                
-                current_message += category_content
-        
+        for category in shop_data.item_categories:
+            totals = shop_data.aggregate.category(category)
+            if not totals.rows:
+                continue
+            category_content = render_board_category(totals)
+
+            # Check if adding this category would exceed message limit
+            if len(current_message + category_content) > char_limit:
+                # Save current message and start a new one
+                messages_content.append(current_message)
+                current_message = header  # Start with header again
+
+            current_message += category_content
+
         # Add the last message if not empty
         if current_message != header:
             messages_content.append(current_message)
@@ -2415,79 +5361,282 @@ async def update_stock_message() -> None:
         if not messages_content:
             messages_content = [header + "No items currently in stock."]
 
-        # Now handle message management
+        # Now handle message management. Tracked posts are edited through partial message
+        # handles, so a steady-state update costs only the edits themselves.
         new_message_ids = []
-        existing_messages = []
-        
-        # First, clean up existing stock messages that might be left from previous runs
+        tracked_ids = list(shop_data.stock_message_ids or [])
+
+        # Update existing messages or create new ones
+        for i, content in enumerate(messages_content):
+            if i < len(tracked_ids):
+                # Update existing message
+                try:
+                    await outbox.edit(channel.get_partial_message(tracked_ids[i]), content)
+                    new_message_ids.append(tracked_ids[i])
+                    logger.info(f"Updated stock message part {i+1}/{len(messages_content)}")
+                    continue
+                except discord.NotFound:
+                    logger.warning(f"Stock message {tracked_ids[i]} not found, sending a new one.")
+                except Exception as e:
+                    logger.error(f"Failed to edit stock message part {i+1}: {e}")
+            # Send new message (also when the tracked one was deleted or couldn't be edited)
+            try:
+                msg = await outbox.send(channel, content)
+                new_message_ids.append(msg.id)
+                logger.info(f"Sent new stock message part {i+1}/{len(messages_content)}")
+            except Exception as e:
+                logger.error(f"Failed to send stock message part {i+1}: {e}")
+
+        # Delete any extra old messages
+        extra_ids = tracked_ids[len(messages_content):]
+        if extra_ids:
+            await delete_board_messages(channel, extra_ids)
+            logger.info(f"Deleted {len(extra_ids)} extra stock message part(s)")
+
+        # Save the updated message IDs
+        if shop_data.stock_message_ids != new_message_ids:
+            shop_data.stock_message_ids = new_message_ids
+            shop_data.save_config()
+            logger.info(f"📝 Updated stock message IDs: {new_message_ids}")
+            
+    except Exception as e:
+        logger.error(f"Error updating stock message: {e}\n{traceback.format_exc()}")
+
+
+def command_tree_hash(tree: app_commands.CommandTree, guild: Optional[discord.abc.Snowflake] = None) -> str:
+    """Stable hash of the registered app commands (names, options, choices, descriptions)."""
+    payload = []
+    for command in tree.get_commands(guild=guild):
+        try:
+            payload.append(command.to_dict(tree)) # discord.py >= 2.4 needs the tree
+        except TypeError:
+            payload.append(command.to_dict())
+    payload.sort(key=lambda c: (c.get("type", 1), c.get("name", "")))
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+async def resolve_usernames(names: Set[str]) -> Dict[str, str]:
+    """Map old username keys to user IDs through the member lists of the bot's guilds.
+
+    Member lists arrive from the gateway in chunks (members intent), so this costs no REST
+    calls per name. Names nobody in the guilds has any more stay unresolved.
+    """
+    resolved: Dict[str, str] = {}
+    for guild in bot.guilds:
+        if not guild.chunked:
+            await guild.chunk()
+        for member in guild.members:
+            remember_member(member)
+            for name in (str(member), member.name): # "name#1234" from before the username change, then plain names
+                if name in names:
+                    resolved.setdefault(name, str(member.id))
+    return resolved
+
+
+async def sync_command_tree() -> None:
+    """Upload app commands only when they changed since the last sync for that scope.
+
+    Syncs globally, or to each guild in SYNC_GUILD_IDS (instant, handy in development).
+    """
+    targets: List[Optional[discord.Object]] = [discord.Object(id=g) for g in SYNC_GUILD_IDS] or [None]
+    for guild in targets:
+        if guild:
+            bot.tree.copy_global_to(guild=guild)
+        scope = f"{bot.application_id}:{'guild:' + str(guild.id) if guild else 'global'}"
+        tree_hash = command_tree_hash(bot.tree, guild=guild)
+
+        # Storage runs off the loop: this happens in on_ready, possibly while the database is unreachable
+        try:
+            last_hash = None if FORCE_COMMAND_SYNC else await asyncio.to_thread(shop_data.get_command_sync_hash, scope)
+        except STORAGE_ERRORS as e:
+            last_hash = None # Can't tell, so sync: an unneeded upload beats stale commands
+            logger.warning(f"⚠️ Could not read the last command sync for {scope}, syncing anyway: {e}")
+        if last_hash == tree_hash:
+            logger.info(f"⏭️ Command tree unchanged for {scope}, skipping sync.")
+            metrics.incr("commands.sync_skipped")
+            continue
+
+        started = time.perf_counter()
+        synced = await bot.tree.sync(guild=guild)
+        metrics.observe("commands.sync", time.perf_counter() - started)
+        metrics.incr("commands.synced")
+        logger.info(f"✅ Synced {len(synced)} application commands to {scope}.")
+        try:
+            await asyncio.to_thread(shop_data.set_command_sync_hash, scope, tree_hash)
+        except STORAGE_ERRORS as e:
+            logger.warning(f"⚠️ Could not record the command sync for {scope} (the next start syncs again): {e}")
+
+
+_stock_refresh_task: Optional[asyncio.Task] = None
+
+def schedule_stock_refresh(collection: Optional[str] = None, doc_id: Optional[str] = None) -> None:
+    """Refresh the stock board once after a burst of remote changes or a leadership change."""
+    global _stock_refresh_task
+    if collection in ("earnings", "user_profiles") or (collection == "settings" and doc_id != "predefined_prices"):
+        return # Earnings/templates/preferences/history don't appear on the board
+    if _stock_refresh_task and not _stock_refresh_task.done():
+        return # A refresh is already queued and will pick this change up
+
+    async def _refresh():
+        await bot.wait_until_ready() # May be scheduled (e.g. on leader election) before we connect
+        await asyncio.sleep(2) # Let the other documents from the same save arrive first
+        await update_stock_message()
+
+    _stock_refresh_task = asyncio.get_running_loop().create_task(_refresh())
+
+
+async def send_stock_alert_digest() -> None:
+    """Post one message listing every low-stock crossing since the last digest (leader only)."""
+    if not LOW_STOCK_ALERT_CHANNEL_ID or not leader_lease.is_leader or not shop_data.is_ready:
+        return
+    alerts = shop_data.stock_alerts
+    try:
+        if alerts.primed_term != leader_lease.term:
+            # First digest of this leadership term: pick up what the previous leader reported,
+            # which may be newer than our own state if we led before and lost the lease
+            term = leader_lease.term
+            alerts.prime(await asyncio.to_thread(shop_data.load_alert_state))
+            alerts.primed_term = term
+        went_low, restocked = alerts.pending()
+        if not went_low and not restocked:
+            return
+        channel = bot.get_channel(LOW_STOCK_ALERT_CHANNEL_ID)
+        if channel is None:
+            logger.warning(f"⚠️ Low-stock alert channel {LOW_STOCK_ALERT_CHANNEL_ID} not found")
+            return
+
+        entries: List[Tuple[str, Optional[str], bool]] = [] # (line, item it reports, went low)
+        if went_low:
+            entries.append(("## ⚠️ Low stock", None, True))
+            for item in went_low:
+                row = shop_data.aggregate.row(item)
+                threshold = shop_data.low_stock_thresholds.get(shop_data.aggregate.category_of(item), 0)
+                entries.append((f"- **{row.display_name}**: {row.quantity:,} left (threshold {threshold:,})", item, True))
+        if restocked:
+            entries.append(("## ✅ Restocked", None, False))
+            for item in restocked:
+                row = shop_data.aggregate.row(item)
+                entries.append((f"- **{row.display_name}**: {row.quantity:,} in stock", item, False))
+
+        # As many messages as it takes to stay under Discord's 2000 characters
+        messages: List[List[Tuple[str, Optional[str], bool]]] = [[]]
+        size = 0
+        for entry in entries:
+            if messages[-1] and size + len(entry[0]) + 1 > 2000:
+                messages.append([])
+                size = 0
+            messages[-1].append(entry)
+            size += len(entry[0]) + 1
+
+        try:
+            for message in messages:
+                await outbox.send(channel, "\n".join(line for line, _, _ in message))
+                # Only what was actually posted counts as reported
+                alerts.mark_notified([item for _, item, low in message if item and low],
+                                     [item for _, item, low in message if item and not low])
+        finally:
+            await asyncio.to_thread(shop_data.save_alert_state)
+        metrics.incr("alerts.digests_sent")
+        logger.info(f"📣 Low-stock digest: {len(went_low)} low, {len(restocked)} restocked")
+    except Exception as e:
+        logger.error(f"❌ Low-stock digest failed: {e}\n{traceback.format_exc()}")
+
+
+class SaleDigests:
+    """Sale credits per contributor, collected until the next digest.
+
+    Those who opted in get one DM per SALE_DIGEST_MINUTES however many sales landed. Pending credits
+    live in memory only; the earnings themselves are already saved, so a restart at
+    worst loses one notification.
+    """
+    PREFERENCE = "sale_digest"
+
+    def __init__(self):
+        self._pending: Dict[str, Dict[str, List[float]]] = {} # user: {item: [credited, sales]}
+
+    def record(self, item_name: str, credits: Dict[str, float]) -> None:
+        """Add a sale's credits. Only counts in memory: flush() checks who opted in."""
+        for user, amount in credits.items():
+            if amount <= 0 or not user.isdigit():
+                continue
+            entry = self._pending.setdefault(user, {}).setdefault(item_name, [0.0, 0])
+            entry[0] += amount
+            entry[1] += 1
+
+    def _render(self, user: str, items: Dict[str, List[float]]) -> str:
+        total = sum(credited for credited, _ in items.values())
+        lines = [f"💰 **You earned ${total:,.2f}** from sales in the last {SALE_DIGEST_MINUTES} minutes"]
+        for item, (credited, sales) in sorted(items.items(), key=lambda kv: -kv[1][0]):
+            name = shop_data.display_names.get(item, item)
+            lines.append(f"- **{name}**: ${credited:,.2f} ({sales} sale{'s' if sales != 1 else ''})")
+        lines.append(f"Balance: **${shop_data.get_earnings(user):,.2f}** · `/payout` to cash out · `/saledigest` to turn these off")
+        content = "\n".join(lines)
+        return content if len(content) <= 2000 else content[:1990].rsplit("\n", 1)[0] + "\n…"
+
+    async def _send(self, user: str, content: str) -> None:
         try:
-            # Delete any existing messages except the ones in our current tracking list
-            async for message in channel.history(limit=20):  # Adjust limit as needed
-                if message.author == bot.user and message.id not in shop_data.stock_message_ids:
-                    # Check if it looks like a stock message
-                    if "Current Shop Stock" in message.content:
-                        await message.delete()
-                        logger.info(f"Deleted untracked stock message: {message.id}")
-                        await asyncio.sleep(0.5)  # Rate limit prevention
-            
-            # Now fetch our tracked messages
-            for msg_id in shop_data.stock_message_ids:
-                try:
-                    msg = await channel.fetch_message(msg_id)
-                    existing_messages.append(msg)
-                except discord.NotFound:
-                    logger.warning(f"Stock message {msg_id} not found.")
-                except Exception as e:
-                    logger.error(f"Error fetching stock message {msg_id}: {e}")
+            member = bot.get_user(int(user)) or await bot.fetch_user(int(user))
+            await outbox.dm(member, content)
+            metrics.incr("sale_digests.sent")
+        except Exception as e: # DMs closed, user gone; the next digest tries again
+            metrics.incr("sale_digests.failed")
+            logger.warning(f"⚠️ Could not DM the sale digest to {user_label(user)}: {e}")
+
+    async def flush(self) -> None:
+        """DM every pending digest (queued through the outbox, so DM rate limits are respected)."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            pending = {user: items for user, items in pending.items() # Only users who opted in (may load profiles)
+                       if shop_data.get_user_preference(user, self.PREFERENCE, False)}
+            await asyncio.gather(*(self._send(user, self._render(user, items)) for user, items in pending.items()))
+            logger.info(f"📨 Sent sale digests to {len(pending)} contributor(s)")
         except Exception as e:
-            logger.error(f"Error cleaning up stock messages: {e}")
-            existing_messages = []
+            logger.error(f"❌ Sale digests failed: {e}\n{traceback.format_exc()}")
 
-        # Update existing messages or create new ones
-        for i, content in enumerate(messages_content):
-            if i < len(existing_messages):
-                # Update existing message
-                try:
-                    await existing_messages[i].edit(content=content)
-                    new_message_ids.append(existing_messages[i].id)
-                    logger.info(f"Updated stock message part {i+1}/{len(messages_content)}")
-                except Exception as e:
-                    logger.error(f"Failed to edit stock message part {i+1}: {e}")
-                    # If edit fails, try to send a new message
-                    try:
-                        msg = await channel.send(content)
-                        new_message_ids.append(msg.id)
-                    except Exception:
-                        logger.error(f"Also failed to send new message for part {i+1}")
-            else:
-                # Send new message
-                try:
-                    # Add rate limit handling
-                    if i > 0:
-                        await asyncio.sleep(1.1)
-                    msg = await channel.send(content)
-                    new_message_ids.append(msg.id)
-                    logger.info(f"Sent new stock message part {i+1}/{len(messages_content)}")
-                except Exception as e:
-                    logger.error(f"Failed to send stock message part {i+1}: {e}")
+sale_digests = SaleDigests()
 
-        # Delete any extra old messages
-        for i in range(len(messages_content), len(existing_messages)):
-            try:
-                await existing_messages[i].delete()
-                logger.info(f"Deleted extra stock message part {i+1}")
-            except Exception:
-                logger.warning(f"Failed to delete extra message {existing_messages[i].id}")
 
-        # Save the updated message IDs
-        if shop_data.stock_message_ids != new_message_ids:
-            shop_data.stock_message_ids = new_message_ids
-            shop_data.save_config()
-            logger.info(f"📝 Updated stock message IDs: {new_message_ids}")
-            
-    except Exception as e:
-        logger.error(f"Error updating stock message: {e}\n{traceback.format_exc()}")
-        return  # Return early on error
+STATEMENT_COLUMNS = ["time_utc", "type", "item", "quantity", "price_each", "amount", "event_id"]
+
+
+def statement_rows(user: str, events: Iterator[Dict[str, Any]]) -> Iterator[List[Any]]:
+    """CSV rows of a user's statement: their stock changes, sale credits (+amount) and payouts (-amount)."""
+    for event in events:
+        kind, item, price = event.get("type"), event.get("item"), event.get("price") or ""
+        if kind == "sale":
+            credit = (event.get("credits") or {}).get(user)
+            if credit is None:
+                continue
+            # Their share of the sale: credits are proportional to the quantity taken from their lots
+            quantity = round(credit / event["price"]) if event.get("price") else ""
+            row = ["sale_credit", item, quantity, price, round(credit, 2)]
+        elif kind == "payout":
+            row = ["payout", "", "", "", -round(event.get("amount", 0), 2)]
+        elif kind == "clear":
+            row = ["clear", item or "all", "", "", ""]
+        elif kind in ("add", "remove", "set"):
+            row = [kind, item, event.get("quantity", 0), price if kind != "remove" else "", ""]
+        else:
+            continue
+        yield [event.get("ts", "")[:19].replace("T", " "), *row, event.get("id", "")]
+
+
+def next_statement_part(rows: Iterator[List[Any]], limit: int = STATEMENT_PART_BYTES) -> Optional[bytes]:
+    """Write rows into one CSV (with header) until it reaches `limit` bytes. None when no rows are left. Blocking."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(STATEMENT_COLUMNS)
+    header_size = buffer.tell()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= limit - 1024: # Leave room: tell() counts characters, and a row is well under 1KB
+            break
+    if buffer.tell() == header_size:
+        return None
+    return buffer.getvalue().encode("utf-8")
 
 
 async def process_sale(item_name: str, quantity_sold: int, sale_price_per_item: int) -> bool:
@@ -2497,7 +5646,7 @@ async def process_sale(item_name: str, quantity_sold: int, sale_price_per_item:
     
     # Rest of the function...
     
-async def process_sale(item_name: str, quantity_sold: int, sale_price_per_item: int) -> bool:
+async def process_sale(item_name: str, quantity_sold: int, sale_price_per_item: int, sale_id: Optional[str] = None) -> bool:
     """Processes a sale, removing stock FIFO globally and crediting users based on actual sale price."""
     display_name = shop_data.display_names.get(item_name, item_name)
     logger.info(f"🛒 PROCESSING SALE: {quantity_sold}x {display_name} @ ${sale_price_per_item:,} each")
@@ -2511,125 +5660,37 @@ async def process_sale(item_name: str, quantity_sold: int, sale_price_per_item:
         logger.error(f"❌ Sale failed: Not enough stock for {display_name} (Need: {quantity_sold}, Have: {total_stock})")
         return False
 
-    # Get all stock entries for this item
-    stock_entries = [dict(entry) for entry in shop_data.items.get(item_name, []) 
-                     if isinstance(entry, dict) and entry.get('quantity', 0) > 0]
-
-    if not stock_entries:
-        logger.error(f"❌ Sale failed: No valid stock entries found for {display_name}")
-        return False
-
-    # Sort entries by date (oldest first) for FIFO
-    stock_entries.sort(key=lambda x: x.get('date', '9999-99-99'))
-
-    remaining_to_sell = quantity_sold
-    processed_indices = set()
-    earnings_updates = {}
-    
     # Calculate total sale value from webhook price
     total_sale_value = quantity_sold * sale_price_per_item
     logger.info(f"💰 Total sale value from webhook: ${total_sale_value:,}")
-    
-    # Find original indices
-    original_indices = {}
-    for i, entry in enumerate(shop_data.items.get(item_name, [])):
-        if isinstance(entry, dict):
-            key = (entry.get('person'), entry.get('date'), entry.get('price'), entry.get('quantity'))
-            original_indices[key] = i
-
-    # Track total quantity being sold to calculate proportions
-    total_quantity_processed = 0
-    proportional_earnings = {}
-
-    # First pass: Calculate proportion of each user's contribution
-    for entry in stock_entries:
-        if remaining_to_sell <= 0:
-            break
-
-        sell_amount = min(entry['quantity'], remaining_to_sell)
-        user = entry.get('person')
-        if not user:
-            logger.warning(f"Stock entry missing 'person' field: {entry}. Skipping.")
-            continue
-
-        # Track this user's proportion of the sale
-        proportional_earnings[user] = proportional_earnings.get(user, 0) + sell_amount
-        total_quantity_processed += sell_amount
-        remaining_to_sell -= sell_amount
-
-    # Reset and process again to update quantities
-    remaining_to_sell = quantity_sold
-    
-    # Second pass: Update quantities and distribute earnings by proportion
-    for entry in stock_entries:
-        if remaining_to_sell <= 0:
-            break
-
-        key = (entry.get('person'), entry.get('date'), entry.get('price'), entry.get('quantity'))
-        original_index = original_indices.get(key)
-        if original_index is None:
-            continue
-
-        sell_amount = min(entry['quantity'], remaining_to_sell)
-        user = entry.get('person')
-        if not user:
-            continue
-
-        # Update quantity in original list
-        shop_data.items[item_name][original_index]['quantity'] -= sell_amount
-        processed_indices.add(original_index)
-        
-        # Calculate earnings based on proportion of total sale value
-        user_proportion = proportional_earnings[user] / total_quantity_processed
-        user_earnings = total_sale_value * (sell_amount / total_quantity_processed)
-        
-        # Debug logging for this specific sale proportion
-        logger.debug(f"DEBUG: Earnings calculation for {user}")
-        logger.debug(f"DEBUG: - sale_price_per_item: ${sale_price_per_item:,}")
-        logger.debug(f"DEBUG: - sell_amount: {sell_amount}")
-        logger.debug(f"DEBUG: - total_quantity_processed: {total_quantity_processed}")
-        logger.debug(f"DEBUG: - proportion: {sell_amount}/{total_quantity_processed} = {sell_amount/total_quantity_processed}")
-        logger.debug(f"DEBUG: - user_earnings: ${user_earnings:,.2f}")
-        
-        earnings_updates[user] = earnings_updates.get(user, 0) + user_earnings
-        logger.info(f"💰 Crediting ${user_earnings:,.2f} to {user} for {sell_amount}x {display_name}")
 
-        remaining_to_sell -= sell_amount
+    # FIFO removal and proportional crediting happen in the 'sale' event (see _sell_lots)
+    earnings_updates = shop_data.record_sale(item_name, quantity_sold, sale_price_per_item, sale_id)
+    if not earnings_updates:
+        logger.error(f"❌ Sale logic error: Could not fulfill sale of {quantity_sold}x {display_name}")
+        return False
 
-    # Update global earnings and clean up
-    if remaining_to_sell == 0:
-        for user, amount in earnings_updates.items():
-            shop_data.user_earnings[user] = shop_data.user_earnings.get(user, 0) + amount
+    for user, amount in earnings_updates.items():
+        logger.info(f"💰 Crediting ${amount:,.2f} to {user_label(user)} for {display_name}")
 
-        # Clean up zero quantity entries
-        shop_data.items[item_name] = [
-            entry for entry in shop_data.items.get(item_name, [])
-            if entry.get('quantity', 0) > 0
-        ]
+    # Record the sale in history with the actual webhook price
+    shop_data.add_to_history("sale", item_name, quantity_sold, sale_price_per_item, "customer")
+    shop_data.save_data()
+    try:
+        sale_digests.record(item_name, earnings_updates)
+    except Exception as e: # Notifications must never fail a sale that already happened
+        logger.warning(f"⚠️ Could not queue sale digests for {display_name}: {e}")
 
-        # Record the sale in history with the actual webhook price
-        shop_data.add_to_history("sale", item_name, quantity_sold, sale_price_per_item, "customer")
-        shop_data.save_data()
-        
-        await update_stock_message()
-        logger.info(f"✅ Sale completed: {quantity_sold}x {display_name} at ${sale_price_per_item:,} each")
-        return True
-    else:
-        logger.error(f"❌ Sale logic error: Could not fulfill sale of {quantity_sold}x {display_name}")
-        return False
+    await update_stock_message()
+    logger.info(f"✅ Sale completed: {quantity_sold}x {display_name} at ${sale_price_per_item:,} each")
+    return True
 
     
 async def item_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
-    """Autocomplete for item names based on display name."""
-    choices = []
-    current_lower = current.lower()
-    for item_id in shop_data.item_list:
-        display_name = shop_data.display_names.get(item_id, item_id)
-        if current_lower in display_name.lower() or current_lower in item_id.lower():
-            choices.append(app_commands.Choice(name=display_name, value=item_id))
-        if len(choices) >= 25:
-            break
-    return choices
+    """Autocomplete for item names, ranked by how well they match and by the user's own use."""
+    user = shop_data.user_key(interaction.user)
+    matches = shop_data.search_index.search(current, user, shop_data.aggregate.user_holdings(user))
+    return [app_commands.Choice(name=shop_data.display_names.get(item_id, item_id), value=item_id) for item_id in matches]
 
 
 async def add_stock_internal(
@@ -2655,7 +5716,7 @@ async def add_stock_internal(
              return False
 
     # Add using ShopData method
-    user = str(interaction.user)
+    user = shop_data.user_key(interaction.user)
     shop_data.add_item(item, quantity, user)
     shop_data.add_to_history("add", item, quantity, price, user)
 
@@ -2748,10 +5809,10 @@ async def add_large_quantity(
 
     # --- User confirmed ---
     # Add the stock using the main method
-    add_success = shop_data.add_item(normalized_item, quantity, str(interaction.user))
+    add_success = shop_data.add_item(normalized_item, quantity, shop_data.user_key(interaction.user))
 
     if add_success:
-        shop_data.add_to_history("add_large", normalized_item, quantity, price, str(interaction.user)) # Specific action
+        shop_data.add_to_history("add_large", normalized_item, quantity, price, shop_data.user_key(interaction.user)) # Specific action
         shop_data.save_data()
         await update_stock_message()
 
@@ -2819,7 +5880,10 @@ async def help_cmd(interaction: discord.Interaction):
 
         finance_commands = [
             "`/earnings` - Check your current earnings balance",
-            "`/payout` - Request to cash out your earnings"
+            "`/payout` - Request to cash out your earnings",
+            "`/statement` - Download your stock changes, sale credits and payouts as CSV",
+            "`/leaderboard` - Top earners from sales (all time, 30 or 7 days)",
+            "`/saledigest` - Get a DM summary of your sales every so often"
         ]
         embed.add_field(name="💰 Financial", value="\n".join(finance_commands), inline=False)
 
@@ -2833,7 +5897,10 @@ async def help_cmd(interaction: discord.Interaction):
                 "`/history` - View recent transaction history",
                 "`/analytics` - View basic shop analytics",
                 "`/backup` - Create a manual backup to local JSON file",
-                "`/dmbackup` - Create a backup and send it to your Discord DMs"
+                "`/dmbackup` - Create a backup and send it to your Discord DMs",
+                "`/botstats` - View instance role and internal metrics",
+                "`/refreshboard` - Redraw the stock board and remove leftover posts\n"
+                "`/migrateuserids` - Re-key old username-keyed data to user IDs"
             ]
             embed.add_field(name="⚙️ Admin Commands", value="\n".join(admin_commands), inline=False)
 
@@ -2880,8 +5947,8 @@ async def stock_cmd(interaction: discord.Interaction):
 async def check_earnings(interaction: discord.Interaction):
     """Check your current earnings balance."""
     try:
-        user = str(interaction.user)
-        earnings = shop_data.user_earnings.get(user, 0)
+        user = shop_data.user_key(interaction.user)
+        earnings = shop_data.get_earnings(user)
 
         embed = discord.Embed(title="💰 Your Earnings", color=COLORS['WARNING']) # Gold/Yellow color
         if earnings > 0:
@@ -2902,6 +5969,119 @@ async def check_earnings(interaction: discord.Interaction):
         except Exception: pass
 
 
+@bot.tree.command(name="statement")
+@app_commands.describe(
+    start="First day, YYYY-MM-DD (default: 30 days before the end)",
+    end="Last day, YYYY-MM-DD (default: today, UTC)",
+    user="Export another user's statement (admin only)"
+)
+async def statement(interaction: discord.Interaction, start: Optional[str] = None, end: Optional[str] = None,
+                    user: Optional[discord.Member] = None):
+    """Download your adds, removals, sale credits and payouts as CSV."""
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        if user and not await is_admin(interaction):
+            await interaction.followup.send("❌ Only administrators can export another user's statement.", ephemeral=True)
+            return
+        try:
+            end_day = datetime.date.fromisoformat(end) if end else datetime.datetime.now(datetime.timezone.utc).date()
+            start_day = datetime.date.fromisoformat(start) if start else end_day - datetime.timedelta(days=29)
+        except ValueError:
+            await interaction.followup.send("❌ Dates must look like `2025-01-31`.", ephemeral=True)
+            return
+        if start_day > end_day:
+            await interaction.followup.send("❌ The start date is after the end date.", ephemeral=True)
+            return
+
+        target = user or interaction.user
+        user_key = shop_data.user_key(target)
+        shop_data.save_data() # Include events still waiting to be written
+        events = shop_data.storage.stream_user_events(user_key, start_day.isoformat(), (end_day + datetime.timedelta(days=1)).isoformat())
+        rows = statement_rows(user_key, events)
+
+        # One part in memory at a time: build it off the loop, send it, then build the next
+        name = f"statement_{user_key}_{start_day}_{end_day}"
+        parts = 0
+        while parts < STATEMENT_MAX_PARTS:
+            data = await asyncio.to_thread(next_statement_part, rows)
+            if data is None:
+                break
+            parts += 1
+            await interaction.followup.send(file=discord.File(io.BytesIO(data), filename=f"{name}_part{parts}.csv"), ephemeral=True)
+            metrics.observe("statement.part_bytes", len(data))
+
+        period = f"{start_day} to {end_day}"
+        if parts == 0:
+            await interaction.followup.send(f"📄 No activity for {user_label(user_key)} from {period}.", ephemeral=True)
+        elif await asyncio.to_thread(next, rows, None) is not None:
+            await interaction.followup.send(
+                f"⚠️ The statement for {period} is longer than {STATEMENT_MAX_PARTS} files; only the start was sent. "
+                f"Export a shorter range to get the rest.", ephemeral=True)
+        else:
+            await interaction.followup.send(f"📄 Statement for {user_label(user_key)}, {period}: {parts} file(s).", ephemeral=True)
+        metrics.incr("statement.exports")
+        logger.info(f"📄 Exported a {parts}-part statement for {user_label(user_key)} ({period}) for {interaction.user}")
+    except Exception as e:
+        logger.error(f"Error in statement command: {e}\n{traceback.format_exc()}")
+        try:
+            await interaction.followup.send("❌ Error exporting the statement.", ephemeral=True)
+        except Exception: pass
+
+
+@bot.tree.command(name="leaderboard")
+@app_commands.describe(window="Period to rank sale earnings over", top="How many contributors to show")
+@app_commands.choices(window=[
+    app_commands.Choice(name="All time", value="all"),
+    app_commands.Choice(name="Last 30 days", value="30d"),
+    app_commands.Choice(name="Last 7 days", value="7d")
+])
+async def leaderboard(interaction: discord.Interaction, window: str = "all", top: app_commands.Range[int, 1, 25] = 10):
+    """Show the contributors who earned the most from sales."""
+    await interaction.response.defer(ephemeral=True) # Names of past contributors may need a storage read
+    try:
+        board = shop_data.leaderboard
+        titles = {"all": "All Time", "30d": "Last 30 Days", "7d": "Last 7 Days"}
+        embed = discord.Embed(title=f"🏆 Top Earners — {titles[window]}", color=COLORS['INFO'])
+        rows = board.top(window, top)
+        medals = ["🥇", "🥈", "🥉"]
+        await load_user_labels(user for user, _ in rows)
+        lines = [f"{medals[i] if i < 3 else f'`#{i + 1}`'} **{user_label(user)}** — ${amount:,.2f}" for i, (user, amount) in enumerate(rows)]
+        embed.description = "\n".join(lines) if lines else "No sales in this period yet."
+
+        me = shop_data.user_key(interaction.user)
+        position = board.position(window, me)
+        if position and position[0] > len(rows):
+            embed.add_field(name="Your Rank", value=f"`#{position[0]}` of {board.size(window)} — ${position[1]:,.2f}", inline=False)
+        embed.set_footer(text="Earnings from sales credited to your stock (payouts don't count)")
+        await interaction.followup.send(embed=embed, ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error in leaderboard command: {e}\n{traceback.format_exc()}")
+        try:
+            await interaction.followup.send("❌ Error loading the leaderboard.", ephemeral=True)
+        except Exception: pass
+
+
+@bot.tree.command(name="saledigest")
+@app_commands.describe(enabled="Receive a periodic DM summarising your sales (leave empty to toggle)")
+async def sale_digest(interaction: discord.Interaction, enabled: Optional[bool] = None):
+    """Turn the periodic DM summary of your sales on or off."""
+    try:
+        user = shop_data.user_key(interaction.user)
+        if enabled is None:
+            enabled = not shop_data.get_user_preference(user, SaleDigests.PREFERENCE, False)
+        shop_data.set_user_preference(user, SaleDigests.PREFERENCE, enabled)
+        if enabled:
+            message = f"📨 Sale digests **on**: you'll get at most one DM every {SALE_DIGEST_MINUTES} minutes when your stock sells."
+        else:
+            message = "🔕 Sale digests **off**."
+        await interaction.response.send_message(message, ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error in saledigest command: {e}\n{traceback.format_exc()}")
+        try:
+            await interaction.response.send_message("❌ Error updating your sale digest setting.", ephemeral=True)
+        except Exception: pass
+
+
 @bot.tree.command(name="add")
 @app_commands.describe(
     quantity="Amount to add (positive number)",
@@ -2922,7 +6102,7 @@ async def add_stock(
     await interaction.response.defer(ephemeral=True)
     try:
         target_user_obj = user if user else interaction.user
-        target_user_str = str(target_user_obj)
+        target_user_str = shop_data.user_key(target_user_obj)
         is_admin_user = await is_admin(interaction)
 
         # Permission checks
@@ -2998,7 +6178,7 @@ async def remove_stock(interaction: discord.Interaction, quantity: int, item: st
     """Remove items from your personal stock contribution."""
     await interaction.response.defer(ephemeral=True)
     try:
-        user = str(interaction.user)
+        user = shop_data.user_key(interaction.user)
         display_name = shop_data.display_names.get(item, item)
 
         if not shop_data.is_valid_item(item):
@@ -3068,7 +6248,7 @@ async def set_stock(
     """ADMIN: Set a user's stock for an item, overwriting previous entries."""
     await interaction.response.defer(ephemeral=True)
     try:
-        target_user_str = str(user)
+        target_user_str = shop_data.user_key(user)
 
         if not shop_data.is_valid_item(item):
             await interaction.followup.send(f"❌ Invalid item specified: `{item}`.", ephemeral=True)
@@ -3087,23 +6267,8 @@ async def set_stock(
         # Get previous quantity for logging/display
         previous_quantity = shop_data.get_user_quantity(item, target_user_str)
 
-        # Remove existing entries for this specific user and item
-        if item in shop_data.items:
-            shop_data.items[item] = [
-                entry for entry in shop_data.items[item]
-                if entry.get('person') != target_user_str
-            ]
-
-        # Add the new single entry if quantity > 0
-        if quantity > 0:
-            if item not in shop_data.items: # Ensure item key exists if list was empty
-                 shop_data.items[item] = []
-            shop_data.items[item].append({
-                "person": target_user_str,
-                "quantity": quantity,
-                "date": str(datetime.date.today()),
-                "price": final_price
-            })
+        # Replace this user's entries for the item with a single one (none if quantity is 0)
+        shop_data.set_stock(item, target_user_str, quantity, final_price)
 
         shop_data.add_to_history("set", item, quantity, final_price, target_user_str)
         shop_data.save_data()
@@ -3153,7 +6318,7 @@ async def clear_stock(
     """ADMIN: Clear stock entries (use with caution!)."""
     await interaction.response.defer(ephemeral=True)
     try:
-        target_user_str = str(user) if user else None
+        target_user_str = shop_data.user_key(user) if user else None
         cleared_items = []
         cleared_users = "all users" if not target_user_str else f"user {user.display_name}"
 
@@ -3167,15 +6332,7 @@ async def clear_stock(
             display_name = shop_data.display_names.get(item, item)
 
             if item in shop_data.items:
-                original_entries = shop_data.items[item]
-                if target_user_str:
-                    shop_data.items[item] = [e for e in original_entries if e.get('person') != target_user_str]
-                else:
-                    shop_data.items[item] = [] # Clear all for this item
-
-                # Remove item key entirely if list becomes empty
-                if not shop_data.items[item]:
-                     del shop_data.items[item]
+                shop_data.clear_stock(item, target_user_str) # Removes the item key entirely if nothing is left
 
                 cleared_items.append(display_name)
                 embed.description = f"Cleared **{display_name}** stock for **{cleared_users}**."
@@ -3185,24 +6342,9 @@ async def clear_stock(
                 embed.color = COLORS['WARNING']
         else:
             # Clear all items for specified user(s)
-            items_to_remove_keys = []
-            for item_key, entries in shop_data.items.items():
-                if target_user_str:
-                    original_count = len(entries)
-                    shop_data.items[item_key] = [e for e in entries if e.get('person') != target_user_str]
-                    if len(shop_data.items[item_key]) < original_count:
-                         cleared_items.append(shop_data.display_names.get(item_key, item_key))
-                    if not shop_data.items[item_key]:
-                         items_to_remove_keys.append(item_key) # Mark for deletion if empty
-                else:
-                    # Clearing all for everyone
-                    cleared_items.append(shop_data.display_names.get(item_key, item_key))
-                    items_to_remove_keys.append(item_key) # Mark all for deletion
-
-            # Perform deletions
-            for key_to_del in items_to_remove_keys:
-                 if key_to_del in shop_data.items:
-                      del shop_data.items[key_to_del]
+            holdings = shop_data.aggregate.user_holdings(target_user_str) if target_user_str else shop_data.aggregate.stocked_items()
+            cleared_items.extend(shop_data.display_names.get(item_key, item_key) for item_key in holdings)
+            shop_data.clear_stock(None, target_user_str)
 
             if not cleared_items:
                  embed.description = f"No stock found for **{cleared_users}** to clear."
@@ -3274,6 +6416,7 @@ async def view_history(interaction: discord.Interaction, limit: app_commands.Ran
         else:
             # Get the most recent 'limit' entries
             recent_history = shop_data.sale_history[-limit:]
+            await load_user_labels(str(entry.get("user", "?")) for entry in recent_history if isinstance(entry, dict))
             description_lines = []
 
             for entry in reversed(recent_history): # Show newest first
@@ -3294,7 +6437,7 @@ async def view_history(interaction: discord.Interaction, limit: app_commands.Ran
                     quantity = entry.get("quantity", 0)
                     price = entry.get("price", 0)
                     user = entry.get("user", "?")
-                    user_display = f"<@{user}>" if user.isdigit() else user # Attempt to mention if ID
+                    user_display = user_label(user)
 
                     line = f"**{action}** [{time_display}]"
                     details = []
@@ -3452,10 +6595,11 @@ async def user_info(interaction: discord.Interaction, user: discord.Member):
     """ADMIN: View a user's stock contributions and earnings."""
     await interaction.response.defer(ephemeral=True)
     try:
-        target_user_str = str(user)
+        target_user_str = shop_data.user_key(user)
+        remember_member(user)
 
         embed = discord.Embed(
-            title=f"👤 User Info: {user.display_name}",
+            title=f"👤 User Info: {user_label(target_user_str)}",
             color=COLORS['INFO'],
             timestamp=datetime.datetime.now(datetime.timezone.utc)
         )
@@ -3463,7 +6607,7 @@ async def user_info(interaction: discord.Interaction, user: discord.Member):
         embed.add_field(name="User", value=f"{user.mention} ({target_user_str})", inline=False)
 
         # Get earnings
-        earnings = shop_data.user_earnings.get(target_user_str, 0)
+        earnings = shop_data.get_earnings(target_user_str)
         embed.add_field(name="💰 Available Earnings", value=f"${earnings:,}", inline=True)
 
         # Get stock information
@@ -3471,16 +6615,12 @@ async def user_info(interaction: discord.Interaction, user: discord.Member):
         total_stock_value = 0
         total_item_count = 0
 
-        # Iterate through all known items to check user's quantity
-        for item_name in shop_data.item_list:
-             user_qty = shop_data.get_user_quantity(item_name, target_user_str)
-             if user_qty > 0:
-                  price = shop_data.predefined_prices.get(item_name, 0) # Use current price for value estimate
-                  value = user_qty * price
-                  total_stock_value += value
-                  total_item_count += user_qty
-                  display_name = shop_data.display_names.get(item_name, item_name)
-                  stock_details.append(f"{display_name}: {user_qty:,} (~${value:,})") # Indicate value is estimate
+        for item_name, user_qty in shop_data.aggregate.user_holdings(target_user_str).items():
+             row = shop_data.aggregate.row(item_name) # Current price for the value estimate
+             value = user_qty * row.price
+             total_stock_value += value
+             total_item_count += user_qty
+             stock_details.append(f"{row.display_name}: {user_qty:,} (~${value:,})") # Indicate value is estimate
 
         embed.add_field(name="📊 Total Stock Value (Est.)", value=f"${total_stock_value:,}", inline=True)
         embed.add_field(name="📦 Total Items Stocked", value=f"{total_item_count:,}", inline=True)
@@ -3527,8 +6667,8 @@ async def payout(interaction: discord.Interaction, amount: str):
     """Cash out your available earnings."""
     await interaction.response.defer(ephemeral=True)
     try:
-        user = str(interaction.user)
-        current_balance = shop_data.user_earnings.get(user, 0)
+        user = shop_data.user_key(interaction.user)
+        current_balance = shop_data.get_earnings(user)
 
         if current_balance <= 0:
             embed = discord.Embed(title="ℹ️ No Earnings", description="You have no earnings available to cash out.", color=COLORS['INFO'])
@@ -3554,15 +6694,28 @@ async def payout(interaction: discord.Interaction, amount: str):
                 await interaction.followup.send(embed=embed, ephemeral=True)
                 return
 
-            # Process payout
-            shop_data.user_earnings[user] = current_balance - payout_amount
+            # Process payout: storage re-checks the balance atomically, the cached one may be stale
+            try:
+                paid = shop_data.payout(user, payout_amount)
+            except STORAGE_ERRORS as e:
+                logger.error(f"❌ Payout for {user} failed, storage unavailable: {e}")
+                await interaction.followup.send("❌ Earnings storage is unavailable right now, nothing was paid out. Please try again later.", ephemeral=True)
+                return
+            if not paid:
+                embed = discord.Embed(
+                    title="⚠️ Insufficient Balance",
+                    description=f"You only have **${shop_data.get_earnings(user):,}** available.\nCannot cash out ${payout_amount:,}.",
+                    color=COLORS['WARNING']
+                )
+                await interaction.followup.send(embed=embed, ephemeral=True)
+                return
             shop_data.add_to_history("payout", "earnings", payout_amount, 0, user) # Store amount paid out
             shop_data.save_data()
 
             embed = discord.Embed(title="💸 Payout Processed", color=COLORS['SUCCESS'])
             embed.add_field(
                 name="Details",
-                value=f"```ml\nAmount Cashed Out: ${payout_amount:,}\nRemaining Balance: ${shop_data.user_earnings[user]:,}```",
+                value=f"```ml\nAmount Cashed Out: ${payout_amount:,}\nRemaining Balance: ${shop_data.get_earnings(user):,}```",
                 inline=False
             )
             embed.set_footer(text="Payout recorded. Ensure you receive the funds through appropriate channels.")
@@ -3613,7 +6766,7 @@ async def template_create(interaction: discord.Interaction):
 async def template_use(interaction: discord.Interaction):
     """Apply a saved template to quickly add items to your stock."""
     try:
-        user_str = str(interaction.user)
+        user_str = shop_data.user_key(interaction.user)
         templates = shop_data.get_user_templates(user_str)
 
         if not templates:
@@ -3640,7 +6793,7 @@ async def template_use(interaction: discord.Interaction):
 async def template_list(interaction: discord.Interaction):
     """View your saved restock templates."""
     try:
-        user_str = str(interaction.user)
+        user_str = shop_data.user_key(interaction.user)
         templates = shop_data.get_user_templates(user_str)
 
         if not templates:
@@ -3688,7 +6841,7 @@ async def template_list(interaction: discord.Interaction):
 async def template_delete(interaction: discord.Interaction):
     """Delete one of your saved templates."""
     try:
-        user_str = str(interaction.user)
+        user_str = shop_data.user_key(interaction.user)
         templates = shop_data.get_user_templates(user_str)
 
         if not templates:
@@ -3717,7 +6870,7 @@ async def template_delete(interaction: discord.Interaction):
 async def template_edit(interaction: discord.Interaction):
     """Edit an existing restock template using the visual editor."""
     try:
-        user_str = str(interaction.user)
+        user_str = shop_data.user_key(interaction.user)
         templates = shop_data.get_user_templates(user_str)
 
         if not templates:
@@ -3770,15 +6923,12 @@ async def change_price(
         display_name = shop_data.display_names.get(item, item)
         old_price = shop_data.predefined_prices.get(item, "N/A")
 
-        # Update the predefined price dictionary
-        shop_data.predefined_prices[item] = new_price
-
         updated_stock_count = 0
-        if update_existing and item in shop_data.items:
-            for entry in shop_data.items[item]:
-                if isinstance(entry, dict): # Basic type check
-                    entry["price"] = new_price # Update the stored price
-                    updated_stock_count += entry.get("quantity", 0)
+        if update_existing:
+            updated_stock_count = shop_data.get_total_quantity(item)
+
+        # Update the default price (and optionally the stored price of existing stock)
+        shop_data.change_price(item, new_price, update_existing)
 
         # Save changes - this now persists prices to MongoDB
         shop_data.save_data()
@@ -3794,7 +6944,7 @@ async def change_price(
             embed.add_field(name="Existing Stock", value="Price for existing items in stock remains unchanged.", inline=False)
         embed.set_footer(text="Future stock additions will use the new default price.")
 
-        shop_data.add_to_history("price_change", item, new_price, 0, str(interaction.user)) # Store new price in 'quantity' field for history
+        shop_data.add_to_history("price_change", item, new_price, 0, shop_data.user_key(interaction.user)) # Store new price in 'quantity' field for history
 
         await interaction.followup.send(embed=embed, ephemeral=True)
 
@@ -3829,16 +6979,8 @@ async def analytics(interaction: discord.Interaction):
         embed = discord.Embed(title="📊 Shop Analytics", color=COLORS['INFO'])
 
         # --- Inventory Stats ---
-        total_value = 0
-        total_items_count = 0
-        item_counts_stock = {}
-        for item, entries in shop_data.items.items():
-            qty = sum(entry.get('quantity', 0) for entry in entries if isinstance(entry, dict))
-            if qty > 0:
-                 total_items_count += qty
-                 price = shop_data.predefined_prices.get(item, 0)
-                 total_value += qty * price
-                 item_counts_stock[item] = qty
+        total_items_count, total_value = shop_data.aggregate.totals()
+        item_counts_stock = shop_data.aggregate.stocked_items()
 
         embed.add_field(name="Total Inventory Value", value=f"${total_value:,}", inline=True)
         embed.add_field(name="Total Items in Stock", value=f"{total_items_count:,}", inline=True)
@@ -3897,6 +7039,16 @@ async def analytics(interaction: discord.Interaction):
                  inline=False
              )
 
+        # Top Contributors by current stock value (names from the member cache, one read for the rest)
+        top_contributors = heapq.nlargest(5, shop_data.aggregate.contributors().items(), key=lambda x: x[1])
+        await load_user_labels(user for user, _ in top_contributors)
+        if top_contributors:
+            embed.add_field(
+                name="Top Contributors (Current Stock Value)",
+                value="```\n" + "\n".join(f"{user_label(user)[:20]}: ${value:,}" for user, value in top_contributors) + "```",
+                inline=False
+            )
+
         await interaction.followup.send(embed=embed, ephemeral=True)
 
     except Exception as e:
@@ -3918,24 +7070,157 @@ async def analytics_error(interaction: discord.Interaction, error: app_commands.
                await interaction.response.send_message("❌ An unexpected error occurred.", ephemeral=True)
 
 
+@bot.tree.command(name="botstats")
+@app_commands.checks.has_permissions(administrator=True)
+async def bot_stats(interaction: discord.Interaction):
+    """ADMIN: View this instance's role and internal metrics."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        metrics.set_gauge("journal.replay_lag_seconds", round(shop_data.journal.replay_lag(), 1)) # Grows while storage is down
+        snapshot = metrics.snapshot()
+        embed = discord.Embed(
+            title="🩺 Bot Instance Stats",
+            color=COLORS['INFO'],
+            timestamp=datetime.datetime.now(datetime.timezone.utc)
+        )
+        role = "👑 Leader" if leader_lease.is_leader else "Follower"
+        embed.add_field(name="Instance", value=f"`{shop_data.instance_id}`", inline=False)
+        embed.add_field(name="Role", value=f"{role} (term {leader_lease.term})", inline=True)
+        embed.add_field(name="Lease", value=f"{leader_lease.ttl_seconds}s, renewed every {leader_lease.renew_seconds}s", inline=True)
+
+        if snapshot["counters"]:
+            lines = [f"{name}: {value:,}" for name, value in sorted(snapshot["counters"].items())]
+            embed.add_field(name="Counters", value="```\n" + "\n".join(lines)[:1000] + "```", inline=False)
+        if snapshot["gauges"]:
+            lines = [f"{name}: {value:,.2f}".rstrip('0').rstrip('.') for name, value in sorted(snapshot["gauges"].items())]
+            embed.add_field(name="Gauges", value="```\n" + "\n".join(lines)[:1000] + "```", inline=False)
+        if snapshot["timings"]:
+            lines = [
+                f"{name}: n={t['count']:,} avg={t['avg'] * 1000:.1f}ms max={t['max'] * 1000:.1f}ms"
+                for name, t in sorted(snapshot["timings"].items())
+            ]
+            embed.add_field(name="Timings", value="```\n" + "\n".join(lines)[:1000] + "```", inline=False)
+
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    except Exception as e:
+        logger.error(f"Error in botstats command: {e}\n{traceback.format_exc()}")
+        try:
+            await interaction.followup.send("❌ An unexpected error occurred fetching bot stats.", ephemeral=True)
+        except Exception: pass
+
+@bot_stats.error # Catch permission errors
+async def bot_stats_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+     if isinstance(error, app_commands.MissingPermissions):
+          if not interaction.response.is_done():
+               await interaction.response.send_message("❌ You do not have permission to use this command.", ephemeral=True)
+          else:
+               await interaction.followup.send("❌ You do not have permission to use this command.", ephemeral=True)
+     else:
+          logger.error(f"Unhandled error in botstats command: {error}\n{traceback.format_exc()}")
+          if not interaction.response.is_done():
+               await interaction.response.send_message("❌ An unexpected error occurred.", ephemeral=True)
+
+
+@bot.tree.command(name="refreshboard")
+@app_commands.checks.has_permissions(administrator=True)
+async def refresh_board(interaction: discord.Interaction):
+    """ADMIN: Redraw the stock board and delete leftover board posts in its channel."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        if not leader_lease.is_leader:
+            await interaction.followup.send("ℹ️ This instance isn't the leader; the leader maintains the stock board.", ephemeral=True)
+            return
+        global board_cleanup_pending
+        board_cleanup_pending = True
+        board_slot_totals.clear() # Re-render every slot of the category layout
+        await update_stock_message()
+        await interaction.followup.send("✅ Stock board refreshed.", ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error in refreshboard command: {e}\n{traceback.format_exc()}")
+        try:
+            await interaction.followup.send("❌ An unexpected error occurred refreshing the board.", ephemeral=True)
+        except Exception: pass
+
+@refresh_board.error # Catch permission errors
+async def refresh_board_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+     if isinstance(error, app_commands.MissingPermissions):
+          if not interaction.response.is_done():
+               await interaction.response.send_message("❌ You do not have permission to use this command.", ephemeral=True)
+          else:
+               await interaction.followup.send("❌ You do not have permission to use this command.", ephemeral=True)
+     else:
+          logger.error(f"Unhandled error in refreshboard command: {error}\n{traceback.format_exc()}")
+          if not interaction.response.is_done():
+               await interaction.response.send_message("❌ An unexpected error occurred.", ephemeral=True)
+
+
+@bot.tree.command(name="migrateuserids")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(apply="Rewrite the data (default: only report what would change)")
+async def migrate_user_ids(interaction: discord.Interaction, apply: bool = False):
+    """ADMIN: Re-key stock, earnings, templates and history from usernames to Discord user IDs."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        if not leader_lease.is_leader:
+            await interaction.followup.send("ℹ️ Run this on the leader instance.", ephemeral=True)
+            return
+        names = await asyncio.to_thread(shop_data.collect_user_keys)
+        if not names:
+            await interaction.followup.send("✅ All data is already keyed by user ID.", ephemeral=True)
+            return
+        mapping = await resolve_usernames(names)
+        unresolved = sorted(names - set(mapping))
+        lines = [f"Found **{len(names)}** username key(s); **{len(mapping)}** match a server member."]
+        if unresolved:
+            shown = ", ".join(f"`{name}`" for name in unresolved[:20])
+            lines.append(f"Not found (left the server or renamed since): {shown}{' …' if len(unresolved) > 20 else ''}")
+
+        if apply and mapping:
+            shop_data.save_data()
+            if shop_data.journal.pending:
+                await interaction.followup.send("❌ Storage has unsaved changes queued; try again once it is reachable.", ephemeral=True)
+                return
+            # Runs on the event loop on purpose: no command can change data half-way through the rewrite
+            counts = shop_data.migrate_user_keys(mapping, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backups"))
+            shop_data.load_data()
+            shop_data.load_names(mapping.values())
+            for name, user_id in mapping.items():
+                if not shop_data.last_known_name(user_id):
+                    shop_data.remember_name(user_id, name)
+            shop_data.save_data()
+            lines.append("✅ Rewrote " + (", ".join(f"{count} {collection}" for collection, count in counts.items() if count) or "nothing"))
+            logger.info(f"🪪 Migrated {len(mapping)} username key(s) to user IDs: {counts}")
+        elif mapping:
+            lines.append("Run again with `apply: True` to rewrite the data.")
+        await interaction.followup.send("\n".join(lines), ephemeral=True)
+    except Exception as e:
+        logger.error(f"Error in migrateuserids command: {e}\n{traceback.format_exc()}")
+        try:
+            await interaction.followup.send("❌ An unexpected error occurred during the migration.", ephemeral=True)
+        except Exception: pass
+
+@migrate_user_ids.error # Catch permission errors
+async def migrate_user_ids_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+     if isinstance(error, app_commands.MissingPermissions):
+          if not interaction.response.is_done():
+               await interaction.response.send_message("❌ You do not have permission to use this command.", ephemeral=True)
+          else:
+               await interaction.followup.send("❌ You do not have permission to use this command.", ephemeral=True)
+     else:
+          logger.error(f"Unhandled error in migrateuserids command: {error}\n{traceback.format_exc()}")
+          if not interaction.response.is_done():
+               await interaction.response.send_message("❌ An unexpected error occurred.", ephemeral=True)
+
+
 @bot.tree.command(name="backup")
 @app_commands.checks.has_permissions(administrator=True)
 async def backup_data(interaction: discord.Interaction):
     """ADMIN: Create a manual backup of shop data to a local JSON file."""
     await interaction.response.defer(ephemeral=True)
     try:
-        backup_data_content = {}
-        # Backup items
-        backup_data_content["items"] = {}
-        for item_doc in shop_data.db.items.find():
-            if "_id" in item_doc and "entries" in item_doc:
-                backup_data_content["items"][item_doc["_id"]] = item_doc["entries"]
-
-        # Backup settings collection
-        backup_data_content["settings"] = {}
-        for setting_doc in shop_data.db.settings.find():
-            if "_id" in setting_doc and "data" in setting_doc:
-                backup_data_content["settings"][setting_doc["_id"]] = setting_doc["data"]
+        # Backup items and settings straight from storage
+        backup_data_content = shop_data.storage.snapshot()
 
         # Backup config file content too
         try:
@@ -4002,7 +7287,7 @@ async def bulk_remove_cmd(interaction: discord.Interaction):
 @app_commands.describe(category="Category of items to add")
 # Use choices based on item_categories keys
 @app_commands.choices(category=[
-    app_commands.Choice(name=cat.title(), value=cat) for cat in ShopData().item_categories.keys() # Temp instance OK here
+    app_commands.Choice(name=cat.title(), value=cat) for cat in shop_data.item_categories.keys()
 ])
 async def bulk_add_visual(interaction: discord.Interaction, category: app_commands.Choice[str]):
     """Add multiple items to your stock contribution using visual selection."""
@@ -4029,7 +7314,7 @@ async def bulk_add_visual(interaction: discord.Interaction, category: app_comman
 @app_commands.describe(category="Category of items to add")
 # Use choices based on item_categories keys
 @app_commands.choices(category=[
-    app_commands.Choice(name=cat.title(), value=cat) for cat in ShopData().item_categories.keys() # Temp instance OK here
+    app_commands.Choice(name=cat.title(), value=cat) for cat in shop_data.item_categories.keys()
 ])
 async def bulk_add_visual(interaction: discord.Interaction, category: app_commands.Choice[str]):
     """Add multiple items to your stock contribution using visual selection."""
@@ -4090,16 +7375,7 @@ async def dm_backup(interaction: discord.Interaction):
 
     try:
         # Export all collections to a structured backup
-        backup_data = {}
-        backup_data["items"] = {}
-        for item_doc in shop_data.db.items.find():
-            if "_id" in item_doc and "entries" in item_doc:
-                backup_data["items"][item_doc["_id"]] = item_doc["entries"]
-
-        backup_data["settings"] = {}
-        for setting_doc in shop_data.db.settings.find():
-            if "_id" in setting_doc and "data" in setting_doc:
-                backup_data["settings"][setting_doc["_id"]] = setting_doc["data"]
+        backup_data = shop_data.storage.snapshot()
 
         # Include config file content in DM backup too? Optional but maybe useful.
         try:
@@ -4225,7 +7501,7 @@ async def on_message(message: discord.Message):
                     item_name = item_pattern.group(2).lower()
                 else:
                     logger.warning(f"Could not extract item name from webhook message: {message_text[:200]}...")
-                    await message.add_reaction("⚠️")  # Add warning reaction if parsing failed
+                    outbox.react(message, "⚠️")  # Add warning reaction if parsing failed
                     return
             else:
                 item_name = item_pattern.group(1).lower()
@@ -4246,7 +7522,7 @@ async def on_message(message: discord.Message):
             
             if not profit_pattern:
                 logger.warning(f"Could not extract profit amount from webhook message: {message_text[:200]}...")
-                await message.add_reaction("⚠️")  # Add warning reaction if parsing failed
+                outbox.react(message, "⚠️")  # Add warning reaction if parsing failed
                 return
                 
             # Handle commas in profit number
@@ -4257,21 +7533,37 @@ async def on_message(message: discord.Message):
             sale_price_per_item = total_profit // quantity
             
             logger.info(f"Parsed sale: {quantity}x {item_name} for ${total_profit:,} (${sale_price_per_item:,} each)")
+
+            # Sales arriving during startup wait for the data load instead of being rejected
+            await shop_data.wait_until_ready()
             
+            # Every instance receives the webhook: only the one that claims the message applies it
+            sale_id = f"webhook:{message.id}"
+            try:
+                claimed = await asyncio.to_thread(shop_data.storage.claim, sale_id, shop_data.instance_id)
+            except STORAGE_ERRORS as e:
+                # Storage is down for every instance alike; the sale id keeps credits and the event log once-only
+                claimed = True
+                logger.warning(f"⚠️ Could not claim webhook sale {message.id}, processing it anyway: {e}")
+            if not claimed:
+                metrics.incr("sales.duplicate_webhooks")
+                logger.info(f"⏭️ Webhook sale {message.id} already processed by another instance")
+                return
+
             # Process the sale with the actual sale price from webhook
-            success = await process_sale(item_name, quantity, sale_price_per_item)
+            success = await process_sale(item_name, quantity, sale_price_per_item, sale_id)
             
             if success:
                 logger.info(f"✅ Successfully processed webhook sale of {quantity}x {item_name}")
-                await message.add_reaction("✅")  # Add checkmark reaction for successful sale
+                outbox.react(message, "✅")  # Add checkmark reaction for successful sale
             else:
                 logger.error(f"❌ Failed to process webhook sale of {quantity}x {item_name}")
-                await message.add_reaction("❌")  # Add X reaction for failed sale
+                outbox.react(message, "❌")  # Add X reaction for failed sale
                 
         except Exception as e:
             logger.error(f"Error processing webhook sale: {e}\n{traceback.format_exc()}")
             try:
-                await message.add_reaction("⚠️")  # Add warning reaction for errors
+                outbox.react(message, "⚠️")  # Add warning reaction for errors
             except Exception:
                 pass  # Silently ignore if adding reaction fails after error
     
@@ -4279,6 +7571,28 @@ async def on_message(message: discord.Message):
         # Process normal commands
         await bot.process_commands(message)
 
+_on_ready_done = False # on_ready fires again after every reconnect
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    remember_member(member)
+
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.display_name != after.display_name:
+        remember_member(after)
+
+
+@bot.event
+async def on_user_update(before: discord.User, after: discord.User):
+    # Username/global name changes arrive once per user, not per guild
+    for guild in bot.guilds:
+        member = guild.get_member(after.id)
+        if member:
+            remember_member(member)
+
+
 @bot.event
 async def on_ready():
     """Called when the bot is ready and connected."""
@@ -4289,25 +7603,36 @@ async def on_ready():
     # for guild in bot.guilds: logger.info(f" - {guild.name} (ID: {guild.id})")
     logger.info(f"-----------------")
 
+    global _on_ready_done
+    if _on_ready_done:
+        logger.info("Reconnected to Discord; startup tasks already done.")
+        return
+    _on_ready_done = True
+    startup_timer.mark("gateway_ready")
+
     try:
-        # Sync commands globally (or specify guilds if needed)
-        # Syncing should generally only be needed once or when commands change,
-        # but doing it on ready ensures they are available after restarts.
+        # Only upload commands when their definitions changed (global sync is slow and rate-limited)
         try:
-            synced = await bot.tree.sync()
-            logger.info(f"✅ Synced {len(synced)} application commands.")
+            await sync_command_tree()
         except discord.errors.Forbidden:
              logger.error("❌ Failed to sync commands: Bot lacks 'application.commands' scope or permissions.")
         except Exception as e:
             logger.error(f"❌ Failed to sync commands: {e}\n{traceback.format_exc()}")
 
+        global _member_names_task
+        _member_names_task = asyncio.create_task(warm_member_names()) # Chunking big guilds takes a while; nothing waits on it
+
+        # The board needs the shop data, which loads in parallel with the gateway connection
+        await shop_data.wait_until_ready()
+
         # Update stock display after syncing and connecting
         try:
-            await update_stock_message()
+            with startup_timer.phase("initial_board"):
+                await update_stock_message()
         except Exception as e:
             logger.error(f"❌ Failed initial stock message update on ready: {e}\n{traceback.format_exc()}")
 
-        logger.info("✅ Bot startup complete.")
+        logger.info(f"✅ Bot startup complete ({startup_timer.summary()}).")
 
     except Exception as e:
         logger.error(f"❌ Error during on_ready tasks: {e}\n{traceback.format_exc()}")
@@ -4317,25 +7642,14 @@ async def on_ready():
 
 def create_automatic_backup():
     """Creates a timestamped backup of MongoDB data locally and stores a copy in DB."""
+    if not leader_lease.is_leader:
+        logger.info("Skipping automatic backup: another instance holds the leader lease.")
+        metrics.incr("backup.skipped_not_leader")
+        return
     logger.info("Attempting automatic backup...")
     try:
-        backup_data_content = {}
-        # Backup items
-        backup_data_content["items"] = {}
-        for item_doc in shop_data.db.items.find():
-             # Basic validation
-             item_id = item_doc.get("_id")
-             entries = item_doc.get("entries")
-             if isinstance(item_id, str) and isinstance(entries, list):
-                  backup_data_content["items"][item_id] = entries
-
-        # Backup settings collection
-        backup_data_content["settings"] = {}
-        for setting_doc in shop_data.db.settings.find():
-             setting_id = setting_doc.get("_id")
-             data = setting_doc.get("data")
-             if isinstance(setting_id, str) and data is not None: # Allow various data types
-                  backup_data_content["settings"][setting_id] = data
+        # Backup items and settings collections
+        backup_data_content = shop_data.storage.snapshot()
 
         # Backup config file content
         try:
@@ -4357,7 +7671,7 @@ def create_automatic_backup():
             json.dump(backup_data_content, dest, indent=2)
         logger.info(f"🔄 Automatic local backup created: {backup_filename_local}")
 
-        # --- Store backup in MongoDB ---
+        # --- Store backup in the storage backend too ---
         try:
              # Use BSON compatible datetime
              backup_timestamp_utc = datetime.datetime.now(datetime.timezone.utc)
@@ -4368,27 +7682,14 @@ def create_automatic_backup():
                  "local_filename": os.path.basename(backup_filename_local), # Store only filename
                  "data": backup_data_content # Store the actual data
              }
-             # Limit size? MongoDB has document size limits (16MB). Check size if data can be huge.
-             # import bson
-             # data_size = len(bson.encode(db_backup_entry))
-             # if data_size > 15 * 1024 * 1024: # Example: limit near 15MB
-             #     logger.error("Backup data exceeds MongoDB document size limit. Skipping DB backup.")
-             # else:
-             shop_data.db.backups.insert_one(db_backup_entry)
-             logger.info(f"🔄 Stored automatic backup copy in MongoDB collection 'backups'.")
-
-             # --- Optional: Prune old backups in MongoDB ---
-             retention_days = 7 # Keep 7 days of auto backups in DB
-             cutoff_date = backup_timestamp_utc - datetime.timedelta(days=retention_days)
-             delete_result = shop_data.db.backups.delete_many({
-                 "backup_type": "automatic",
-                 "timestamp_utc": {"$lt": cutoff_date}
-             })
-             if delete_result.deleted_count > 0:
-                  logger.info(f"Pruned {delete_result.deleted_count} old automatic backups from MongoDB.")
+             retention_days = 7 # Keep 7 days of auto backups in the store
+             pruned = shop_data.storage.store_backup(db_backup_entry, retention_days)
+             logger.info(f"🔄 Stored automatic backup copy in {shop_data.storage.name} storage ('backups').")
+             if pruned > 0:
+                  logger.info(f"Pruned {pruned} old automatic backups from {shop_data.storage.name} storage.")
 
         except Exception as db_backup_e:
-             logger.error(f"❌ Failed to store automatic backup in MongoDB: {db_backup_e}\n{traceback.format_exc()}")
+             logger.error(f"❌ Failed to store automatic backup in {shop_data.storage.name} storage: {db_backup_e}\n{traceback.format_exc()}")
 
         # --- Optional: Prune old local backup files ---
         try:
@@ -4416,6 +7717,114 @@ def create_automatic_backup():
     except Exception as e:
         logger.error(f"❌ Automatic backup process failed: {e}\n{traceback.format_exc()}")
 
+def _lot_totals(items: Dict[str, List[Dict[str, Any]]]) -> Dict[tuple, int]:
+    totals: Dict[tuple, int] = {}
+    for item_name, entries in items.items():
+        for entry in entries:
+            if isinstance(entry, dict) and entry.get('quantity', 0) > 0:
+                key = (item_name, entry.get('person'))
+                totals[key] = totals.get(key, 0) + entry['quantity']
+    return totals
+
+
+def create_event_snapshot():
+    """Roll the event log up into a new snapshot and check it against the stored state (leader only)."""
+    if not leader_lease.is_leader:
+        return
+    started = time.perf_counter()
+    try:
+        storage = shop_data.storage
+        if storage.latest_event_snapshot() is None:
+            # Genesis: the log starts from whatever is stored right now (data from before event sourcing)
+            events = storage.load_events(0)
+            stored = storage.snapshot()
+            state = InventoryState(
+                items=stored["items"],
+                user_earnings=stored["settings"].get("user_earnings", {}),
+                predefined_prices={**dict(shop_data.predefined_prices), **stored["settings"].get("predefined_prices", {})}
+            )
+            last_seq = events[-1]["seq"] if events else 0
+            storage.store_event_snapshot({"seq": last_seq, "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                                          "events_applied": 0, "state": asdict(state)}, EVENT_SNAPSHOTS_KEPT)
+            logger.info(f"📸 Created genesis event snapshot at seq {last_seq}")
+            return
+
+        state, last_seq, applied = rebuild_inventory(storage)
+        rebuild_seconds = time.perf_counter() - started
+        metrics.observe("events.rebuild", rebuild_seconds)
+        if applied:
+            storage.store_event_snapshot({"seq": last_seq, "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                                          "events_applied": applied, "state": asdict(state)}, EVENT_SNAPSHOTS_KEPT)
+            logger.info(f"📸 Event snapshot at seq {last_seq}: replayed {applied:,} events in {rebuild_seconds:.2f}s")
+
+        # The rebuilt state should match the stored documents; report where it doesn't
+        stored = storage.snapshot()
+        rebuilt_lots, stored_lots = _lot_totals(state.items), _lot_totals(stored["items"])
+        drifted = [f"{item}/{person}" for item, person in set(rebuilt_lots) | set(stored_lots)
+                   if rebuilt_lots.get((item, person), 0) != stored_lots.get((item, person), 0)]
+        stored_earnings = stored["settings"].get("user_earnings", {})
+        drifted += [f"earnings/{user}" for user in set(state.user_earnings) | set(stored_earnings)
+                    if abs(state.user_earnings.get(user, 0) - stored_earnings.get(user, 0)) > 0.01]
+        metrics.set_gauge("events.drifted_keys", len(drifted))
+        if drifted:
+            logger.warning(f"⚠️ Event log and stored state disagree on {len(drifted)} key(s): {', '.join(sorted(drifted)[:10])}")
+    except Exception as e:
+        logger.error(f"❌ Event snapshot failed: {e}\n{traceback.format_exc()}")
+
+def prune_earned_daily():
+    """Drop earned_daily keys older than the longest leaderboard window from earnings documents (leader only)."""
+    if not leader_lease.is_leader:
+        return
+    try:
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        oldest = EarningsLeaderboard._cutoff(today, LEADERBOARD_DAYS_KEPT)
+        pruned = 0
+        for doc in shop_data.storage.load("earnings", fields=["earned_daily"]):
+            stale = [f"earned_daily.{day}" for day in (doc.get("earned_daily") or {}) if day < oldest]
+            if stale:
+                shop_data.storage.unset_fields("earnings", doc["_id"], stale) # No version bump: readers already ignore these days
+                pruned += len(stale)
+        metrics.incr("leaderboard.days_pruned", pruned)
+        if pruned:
+            logger.info(f"🧹 Pruned {pruned} day(s) of earnings older than {oldest} from the leaderboard counters")
+    except Exception as e:
+        logger.error(f"❌ Pruning leaderboard counters failed: {e}\n{traceback.format_exc()}")
+
+def run_lot_compaction():
+    """Compact stock lots and save (leader only, runs on the event loop)."""
+    if not leader_lease.is_leader or not shop_data.is_ready:
+        return
+    try:
+        before, after = shop_data.compact_all_lots()
+        metrics.set_gauge("lots.entries_before_compaction", before)
+        metrics.set_gauge("lots.entries", after)
+        if after < before:
+            shop_data.save_data()
+            logger.info(f"🧹 Lot compaction: {before:,} → {after:,} stock entries")
+        else:
+            logger.info(f"🧹 Lot compaction: {after:,} stock entries, nothing to merge")
+    except Exception as e:
+        logger.error(f"❌ Lot compaction failed: {e}\n{traceback.format_exc()}")
+
+def schedule_lot_compaction():
+    # Shop data belongs to the event loop, so hand the job over instead of running it on the scheduler thread
+    try:
+        bot.loop.call_soon_threadsafe(run_lot_compaction)
+    except Exception as e:
+        logger.warning(f"Could not schedule lot compaction: {e}")
+
+def schedule_stock_alert_digest():
+    try:
+        bot.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(send_stock_alert_digest()))
+    except Exception as e:
+        logger.warning(f"Could not schedule the low-stock digest: {e}")
+
+def schedule_sale_digests():
+    try:
+        bot.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(sale_digests.flush()))
+    except Exception as e:
+        logger.warning(f"Could not schedule sale digests: {e}")
+
 # Scheduler function
 def run_scheduler():
     logger.info("Scheduler thread started.")
@@ -4424,6 +7833,12 @@ def run_scheduler():
     # Schedule more frequent backups (e.g., every 4 hours)
     schedule.every(4).hours.do(create_automatic_backup)
     logger.info(f"Scheduled daily backup at 03:00 and every 4 hours.")
+    schedule.every(EVENT_SNAPSHOT_HOURS).hours.do(create_event_snapshot)
+    schedule.every(LOT_COMPACTION_HOURS).hours.do(schedule_lot_compaction)
+    schedule.every(6).hours.do(prune_earned_daily) # Storage only, so it runs on this thread
+    if LOW_STOCK_ALERT_CHANNEL_ID:
+        schedule.every(LOW_STOCK_ALERT_MINUTES).minutes.do(schedule_stock_alert_digest)
+    schedule.every(SALE_DIGEST_MINUTES).minutes.do(schedule_sale_digests)
 
     while True:
         try:
@@ -4435,6 +7850,79 @@ def run_scheduler():
 
 
 ############### MAIN EXECUTION ###############
+async def reconcile_shop_data() -> None:
+    """Bring memory up to date with MongoDB after a warm start, retrying until it's reachable."""
+    retry_delay = 1
+    while True:
+        try:
+            changes = await asyncio.to_thread(shop_data.fetch_remote_changes)
+            applied = shop_data.apply_remote_changes(changes)
+            metrics.incr("snapshot.reconciled_docs", applied)
+            if applied:
+                logger.info(f"🔄 Reconciled {applied} document(s) that changed since the local snapshot")
+                shop_data.write_snapshot()
+                schedule_stock_refresh()
+            else:
+                logger.info("✅ Local snapshot is up to date with MongoDB")
+            return
+        except Exception as e:
+            metrics.incr("snapshot.reconcile_errors")
+            logger.error(f"❌ Reconciling with MongoDB failed, serving from the local snapshot (retry in {retry_delay}s): {e}")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
+
+async def load_shop_data():
+    """Staged startup that runs alongside the gateway connection.
+
+    Serves from the local snapshot when there is one (falling back to a full MongoDB
+    load), opens the command gate, then reconciles with MongoDB, joins the leader
+    election and kicks off the startup backup, so none of it delays serving commands.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        # Unflushed journal entries must be replayed against the stored state, so load it fully
+        warm_start = False
+        if not shop_data.journal.pending:
+            with startup_timer.phase("snapshot_load"):
+                warm_start = await asyncio.to_thread(shop_data.load_snapshot)
+        if not warm_start:
+            with startup_timer.phase("data_load"):
+                await asyncio.to_thread(shop_data.initialize)
+        if shop_data.journal.pending:
+            with startup_timer.phase("journal_replay"):
+                await asyncio.to_thread(shop_data.replay_journal)
+            shop_data.schedule_journal_replay() # Still pending if storage dropped out again
+
+        shop_data.mark_ready()
+        startup_timer.mark("data_ready")
+
+        # Follow other instances' writes before reconciling, so nothing slips in between
+        shop_data.start_change_stream(loop, on_change=schedule_stock_refresh)
+        if shop_data.storage.is_remote:
+            with startup_timer.phase("reconcile"):
+                await reconcile_shop_data() # Cheap version check; also covers the gap before the stream started
+        if not warm_start:
+            shop_data.write_snapshot() # Next restart can start warm
+
+        # A newly elected leader takes over the stock board
+        with startup_timer.phase("leader_election"):
+            await asyncio.to_thread(
+                leader_lease.start,
+                lambda: loop.call_soon_threadsafe(schedule_stock_refresh)
+            )
+
+        # Create an initial backup at startup after data loaded (leader only)
+        if leader_lease.is_leader:
+            logger.info("Performing initial startup backup in the background...")
+            with startup_timer.phase("startup_backup"):
+                await asyncio.to_thread(create_automatic_backup)
+            # Starts the event log with a genesis snapshot on first run
+            await asyncio.to_thread(create_event_snapshot)
+
+    except Exception as e:
+        logger.critical(f"❌ Startup failed while loading shop data: {e}\n{traceback.format_exc()}")
+        await bot.close() # Can't operate without data; ends bot.start() in main()
+
 async def main():
     try:
         # Instantiate ShopData early - loads data & connects to DB
@@ -4447,9 +7935,8 @@ async def main():
         scheduler_thread.start()
         logger.info("🔄 Automatic backup scheduler thread started.")
 
-        # Create an initial backup at startup after data loaded
-        logger.info("Performing initial startup backup...")
-        create_automatic_backup()
+        # Load data, elect a leader and back up in the background while the gateway connects
+        startup_task = asyncio.create_task(load_shop_data()) # Keep a reference so it isn't garbage collected
 
         logger.info("Starting bot connection...")
         await bot.start(TOKEN)
@@ -4466,6 +7953,9 @@ async def main():
         logger.critical(f"❌ Unhandled exception during bot execution: {e}\n{traceback.format_exc()}")
     finally:
         logger.info("Initiating bot shutdown sequence...")
+        leader_lease.release()
+        if shop_data.is_ready:
+            shop_data.write_snapshot() # Warm start next time
         if bot and not bot.is_closed():
             await bot.close()
             logger.info("Discord bot connection closed.")
@@ -4473,6 +7963,8 @@ async def main():
         # scheduler_thread.join(timeout=5) # Optional wait
         logger.info("Bot shutdown complete.")
 
+startup_timer.mark("module_loaded")
+
 if __name__ == "__main__":
     logger.info("--- Script Starting ---")
     # Ensure ShopData and bot are instantiated before main runs